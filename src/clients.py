@@ -0,0 +1,224 @@
+#coding: UTF-8
+"""
+AWS(DynamoDB/S3/Rekognition/EventBridge Scheduler/Lambda)・Slackのクライアントと、HTTPセッションを生成するモジュール
+
+いずれもコンテナごとに1回だけ、初めて使う時に生成し、ウォームスタートの実行では使い回す。
+boto3/requests/slackのimportも初めて使う時まで遅らせるので、
+早期リターンする実行(署名NG・対象外チャンネルなど)ではコールドスタートが軽くなる。
+接続プール・タイムアウト・リトライはここでまとめて設定する。
+非同期で呼び出すSlackクライアントは、コンテナごとのイベントループに紐づけて使い回す。
+AWSの呼び出し回数とDynamoDBの消費キャパシティは、セッションのイベントでtracingに記録する。
+"""
+import os
+import threading
+
+from src import tracing
+
+MAX_POOL_CONNECTIONS = 10
+HTTP_TIMEOUT = (3.05,10) # (接続,読み込み)のタイムアウト秒
+
+_lock = threading.RLock()
+_session = None
+_clients = {}
+_dynamodb = None
+_tables = {}
+_http_session = None
+_slack_clients = {}
+_event_loop = None
+
+#ReturnConsumedCapacityを指定できるDynamoDBの操作
+CONSUMED_CAPACITY_OPERATIONS = {
+    'GetItem','PutItem','UpdateItem','DeleteItem','Query','Scan',
+    'BatchGetItem','BatchWriteItem','TransactGetItems','TransactWriteItems',
+}
+
+
+def _aws_config():
+    from botocore.config import Config
+
+    return Config(
+        connect_timeout=3,
+        read_timeout=10,
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        retries={'max_attempts':3,'mode':'standard'},
+    )
+
+
+def _boto3_session():
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                import boto3
+                session = boto3.session.Session()
+                session.events.register('before-parameter-build.dynamodb',_return_consumed_capacity)
+                session.events.register('after-call',_trace_aws_call)
+                _session = session
+    return _session
+
+
+def _return_consumed_capacity(params,model,**kwargs):
+    #消費キャパシティを計測するため、DynamoDBの読み書きは消費キャパシティを返させる
+    if model.name in CONSUMED_CAPACITY_OPERATIONS:
+        params.setdefault('ReturnConsumedCapacity','TOTAL')
+
+
+def _trace_aws_call(model,parsed,**kwargs):
+    service_name = model.service_model.service_name
+    tracing.count(f'{service_name}.{model.name}')
+    if service_name == 'dynamodb' and isinstance(parsed,dict):
+        tracing.add_consumed_capacity(parsed.get('ConsumedCapacity'))
+
+
+def _client(service_name):
+    client = _clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = _boto3_session().client(service_name,config=_aws_config())
+                _clients[service_name] = client
+    return client
+
+
+def s3():
+    """
+    S3のクライアントを返す
+    """
+    return _client('s3')
+
+
+def rekognition():
+    """
+    Rekognitionのクライアントを返す
+    """
+    return _client('rekognition')
+
+
+def scheduler():
+    """
+    EventBridge Schedulerのクライアントを返す
+    """
+    return _client('scheduler')
+
+
+def lambda_client():
+    """
+    Lambdaのクライアントを返す
+    """
+    return _client('lambda')
+
+
+def dynamodb():
+    """
+    DynamoDBのリソースを返す
+    """
+    global _dynamodb
+    if _dynamodb is None:
+        with _lock:
+            if _dynamodb is None:
+                _dynamodb = _boto3_session().resource('dynamodb',config=_aws_config())
+    return _dynamodb
+
+
+def table(name):
+    """
+    DynamoDBのテーブルを返す
+
+    引数  :  name     str     テーブル名
+    戻り値:  table    Table   テーブル
+    """
+    t = _tables.get(name)
+    if t is None:
+        t = dynamodb().Table(name)
+        _tables[name] = t
+    return t
+
+
+def http_session():
+    """
+    keep-aliveで接続を使い回すHTTPセッションを返す(タイムアウトは呼び出し側でHTTP_TIMEOUTを指定する)
+    """
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=MAX_POOL_CONNECTIONS,
+                    pool_maxsize=MAX_POOL_CONNECTIONS,
+                    max_retries=2,
+                )
+                session.mount('https://',adapter)
+                session.mount('http://',adapter)
+                _http_session = session
+    return _http_session
+
+
+def _slack(token_env):
+    client = _slack_clients.get(token_env)
+    if client is None:
+        with _lock:
+            client = _slack_clients.get(token_env)
+            if client is None:
+                import slack
+                client = slack.WebClient(token=os.environ[token_env])
+                _slack_clients[token_env] = client
+    return client
+
+
+def slack_client():
+    """
+    SlackのWebClient(ユーザートークン)を返す
+    """
+    return _slack('SLACK_API_TOKEN')
+
+
+def slack_bot_client():
+    """
+    SlackのWebClient(botトークン)を返す
+    """
+    return _slack('SLACK_BOT_API_TOKEN')
+
+
+def event_loop():
+    """
+    コンテナごとのイベントループを返す(非同期のSlackクライアントはこのループに紐づく)
+    """
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        with _lock:
+            if _event_loop is None or _event_loop.is_closed():
+                import asyncio
+                _event_loop = asyncio.new_event_loop()
+    return _event_loop
+
+
+def _slack_async(token_env):
+    key = token_env + ':async'
+    client = _slack_clients.get(key)
+    if client is None:
+        with _lock:
+            client = _slack_clients.get(key)
+            if client is None:
+                import slack
+                client = slack.WebClient(token=os.environ[token_env],run_async=True,loop=event_loop())
+                _slack_clients[key] = client
+    return client
+
+
+def slack_async_client():
+    """
+    SlackのWebClient(ユーザートークン、非同期)を返す。APIの戻り値はawaitして使う
+    """
+    return _slack_async('SLACK_API_TOKEN')
+
+
+def slack_async_bot_client():
+    """
+    SlackのWebClient(botトークン、非同期)を返す。APIの戻り値はawaitして使う
+    """
+    return _slack_async('SLACK_BOT_API_TOKEN')
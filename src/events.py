@@ -0,0 +1,148 @@
+#coding: UTF-8
+"""
+SlackのEvents APIの受付(すぐに応答を返し、画像の処理はmainに任せる)
+
+Slackは3秒以内に応答がないイベントを再送する(X-Slack-Retry-Num/X-Slack-Retry-Reasonヘッダー付き)。
+ここでは署名の検証・受付済みかどうかの確認だけを行い、mainを非同期で呼び出してすぐに応答する。
+API GatewayとはLambdaプロキシ統合でつなぐので、応答はstatusCode/headers/bodyの形で返す。
+  - 受付済みのevent_idは、コンテナ内のLRUと、idempotencyテーブルのevent:<event_id>で覚えておく
+  - 再送されたイベントが受付済みの場合は、何もせずに応答する(mainは1回しか実行されない)
+  - ゲーム中でないチャンネルのイベントは、受付の登録もmainの呼び出しもせずに応答する
+  - mainの呼び出しに失敗した場合は、登録を消してエラーを返す(Slackに再送してもらう)
+"""
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
+
+from src import clients,slack_request,tracing
+from src.repository import Repository
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+loghandler = StreamHandler()
+loghandler.setFormatter(Formatter("%(asctime)s %(name)s %(levelname)8s %(message)s"))
+logger.addHandler(loghandler)
+
+main_function_arn = os.environ.get('MAIN_FUNCTION_ARN') #画像を処理するmainのARN
+EVENT_TTL = 60 * 60 # event_idを覚えておく秒数(Slackの再送は最後が5分後なので余裕を持っている)
+MAX_ACCEPTED_EVENTS = 1024 # コンテナ内で覚えておくevent_idの数
+HANDLED_EVENT_TYPES = ('file_shared',) # mainに渡すイベントの種類
+
+_accepted = OrderedDict() # 受付済みのevent_id(コンテナ内のLRU)
+
+
+def response(body,status_code=200):
+    """
+    API Gatewayのプロキシ統合の応答を作る
+
+    引数  :  body          dict   応答のbody(JSONにする)
+             status_code   int    HTTPのステータスコード
+    戻り値:  response      dict   Lambdaの戻り値
+    """
+    return {
+        'statusCode':status_code,
+        'headers':{'Content-Type':'application/json'},
+        'body':json.dumps(body),
+    }
+
+
+ACK = response({'ok':True})
+UNAUTHORIZED = response({'ok':False},401)
+
+
+@slack_request.verified(rejected=UNAUTHORIZED)
+def handler(event, lambda_context):
+    tracing.start('events')
+    try:
+        body = event['body']
+
+        #Slack APIのチャレンジ用(Request URLの設定時)
+        if body.get('type',None) == 'url_verification':
+            return response({'challenge':body.get('challenge')})
+
+        event_id = body.get('event_id')
+        tracing.set_correlation_id(event_id)
+
+        retry_num = slack_request.get_header(event,'x-slack-retry-num')
+        if retry_num:
+            retry_reason = slack_request.get_header(event,'x-slack-retry-reason')
+            logger.info(f'再送されたイベントです:event_id={event_id} retry_num={retry_num} reason={retry_reason}')
+            tracing.count('slack.retry')
+
+        if event_id and is_accepted(event_id):
+            logger.info(f'受付済みのイベントです:{event_id}')
+            tracing.count('events.duplicate')
+            return ACK
+
+        slack_event = body.get('event') or {}
+        if slack_event.get('type') not in HANDLED_EVENT_TYPES:
+            logger.info(f'対象外のイベントです:{slack_event.get("type")}')
+            return ACK
+
+        logger.debug(f'event[body]:{body}')
+
+        #ゲーム中でないチャンネルの投稿は、DynamoDBへの書き込みやmainの呼び出しをせずに捨てる
+        #(channel_idがない古い形式のイベントは、mainがfiles.infoでチャンネルを探す)
+        repo = Repository()
+        channel_id = slack_event.get('channel_id')
+        if channel_id and not repo.is_game_in_progress(channel_id):
+            logger.info(f'ゲーム中でないチャンネルの投稿です:{channel_id}')
+            tracing.count('events.no_game')
+            return ACK
+
+        if event_id and not repo.claim_event(event_id,math.floor(time.time()) + EVENT_TTL):
+            remember(event_id)
+            tracing.count('events.duplicate')
+            return ACK
+
+        try:
+            hand_off(body)
+        except Exception:
+            logger.exception('mainを呼び出せませんでした')
+            if event_id:
+                repo.release_event(event_id)
+            raise
+
+        if event_id:
+            remember(event_id)
+        return ACK
+
+    finally:
+        tracing.emit()
+
+
+def is_accepted(event_id):
+    """
+    コンテナ内のLRUで、受付済みのevent_idかどうかを返す
+    """
+    if event_id not in _accepted:
+        return False
+    _accepted.move_to_end(event_id)
+    return True
+
+
+def remember(event_id):
+    """
+    受付済みのevent_idをコンテナ内のLRUに追加する(古いものから捨てる)
+    """
+    _accepted[event_id] = True
+    _accepted.move_to_end(event_id)
+    while len(_accepted) > MAX_ACCEPTED_EVENTS:
+        _accepted.popitem(last=False)
+
+
+def hand_off(body):
+    """
+    mainを非同期で呼び出して、画像の処理を任せる(mainの完了は待たない)
+
+    引数  :  body   dict   Events APIのリクエストbody(検証済み)
+    """
+    with tracing.span('hand_off'):
+        clients.lambda_client().invoke(
+            FunctionName=main_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps({'body':body}).encode(),
+        )
@@ -0,0 +1,61 @@
+#coding: UTF-8
+"""
+game_id/image_idの採番を行うモジュール
+
+テーブルをscanせずに、時刻順に並ぶ64bitの整数IDを発行する(Snowflake形式)。
+
+    | 41bit:EPOCHからの経過ミリ秒 | 10bit:コンテナ番号 | 12bit:ミリ秒内の連番 |
+
+  - 同じコンテナの中では必ず一意になる(同じミリ秒内は連番、使い切ったら次のミリ秒まで待つ)
+  - コンテナ番号はコンテナ起動時にランダムに決めるので、別コンテナと同じIDになることはほぼない
+    (念のため、書き込み側は attribute_not_exists の条件付きで挿入する)
+  - IDの大小は発行時刻の前後と一致する(チャンネルの最大のgame_idが最新のゲームになる)
+"""
+import random
+import threading
+import time
+
+EPOCH_MS = 1577836800000 # 2020/01/01 00:00:00 UTC
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODE = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = NODE_BITS + SEQUENCE_BITS
+
+_node = random.SystemRandom().randint(0,MAX_NODE)
+_lock = threading.Lock()
+_last_ms = -1
+_sequence = 0
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def new_id():
+    """
+    新しいIDを発行する
+
+    引数  :  なし
+    戻り値:  new_id    int    時刻順に並ぶ一意なID
+    """
+    global _last_ms,_sequence
+
+    with _lock:
+        now = _now_ms()
+        if now < _last_ms:
+            #時計が巻き戻った場合は、最後に発行した時刻のまま連番を進める
+            now = _last_ms
+
+        if now == _last_ms:
+            _sequence = (_sequence + 1) & MAX_SEQUENCE
+            if _sequence == 0:
+                #同じミリ秒内の連番を使い切ったので、次のミリ秒まで待つ
+                while now <= _last_ms:
+                    now = _now_ms()
+        else:
+            _sequence = 0
+
+        _last_ms = now
+        return ((now - EPOCH_MS) << TIMESTAMP_SHIFT) | (_node << SEQUENCE_BITS) | _sequence
+
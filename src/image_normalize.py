@@ -0,0 +1,226 @@
+#coding: UTF-8
+"""
+Slackから取得した画像を、Rekognitionに渡す前に小さくするモジュール
+
+  - JPEGは縮小しながら読み込む(draft)ので、大きな写真でもメモリを使いすぎない
+  - PNGなどは縮小しながら読み込めないので、展開した大きさに上限を設ける(RGB/RGBAで約400万画素)
+    上限を超える場合はImageTooLargeErrorにする(呼び出し側は、Rekognitionの上限以下なら元画像のまま判定する)
+  - 展開した画像は横長の帯ごとに白地に重ねて縮小し、全体のコピーは作らない
+  - 長辺をIMAGE_TARGET_LONG_EDGEまで縮小する(ラベル判定に高解像度は不要)
+  - Exifなどのメタデータは消す(向きだけは縮小後の画素に反映してから消す)
+  - IMAGE_MAX_BYTES以下になるまで画質・サイズを落としてJPEGにする
+
+Pillowがない環境ではis_available()がFalseになり、呼び出し側は縮小せずに処理する。
+"""
+import io
+import math
+import os
+from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+loghandler = StreamHandler()
+loghandler.setFormatter(Formatter("%(asctime)s %(name)s %(levelname)8s %(message)s"))
+logger.addHandler(loghandler)
+
+TARGET_LONG_EDGE = int(os.environ.get('IMAGE_TARGET_LONG_EDGE',1024)) # 縮小後の長辺(px)
+MAX_OUTPUT_BYTES = int(os.environ.get('IMAGE_MAX_BYTES',1000000)) # 縮小後の上限サイズ(byte)
+MAX_SOURCE_BYTES = int(os.environ.get('IMAGE_MAX_SOURCE_BYTES',20000000)) # 受け付ける元画像の上限サイズ(byte)
+MAX_DECODE_BYTES = 16000000 # 縮小前に展開してよい大きさ(byte)の上限(128MBのLambdaに収めるため。JPEGはdraft後の大きさ)
+STRIP_ROWS = 32 # 帯ごとに縮小する時の、縮小後の1つの帯の行数
+LANCZOS_SUPPORT = 3 # LANCZOSフィルターが参照する範囲(縮小後の画素単位)
+JPEG_QUALITIES = (85,75,65,55,45)
+MIN_LONG_EDGE = 256
+CONTENT_TYPE = 'image/jpeg'
+EXTENSION = '.jpg'
+
+_available = None
+
+
+class ImageNormalizeError(Exception):
+    """
+    画像を縮小できなかった
+    """
+    pass
+
+
+class ImageTooLargeError(ImageNormalizeError):
+    """
+    画像が大きすぎて、メモリに収まるように展開できなかった
+    """
+    pass
+
+
+def is_available():
+    """
+    画像の縮小ができる(Pillowがある)か調べる
+
+    引数  :  なし
+    戻り値:  ret    boolean    縮小できる(True),できない(False)
+    """
+    global _available
+    if _available is None:
+        try:
+            import PIL.Image # noqa: F401
+            _available = True
+        except ImportError:
+            logger.warning('Pillowがないため、画像の縮小は行いません')
+            _available = False
+    return _available
+
+
+def _encode_jpeg(image,max_bytes):
+    """
+    上限サイズ以下になるまで画質を落としてJPEGにする。画質を最低まで落としても超える場合はNone
+    """
+    for quality in JPEG_QUALITIES:
+        buf = io.BytesIO()
+        image.save(buf,format='JPEG',quality=quality,optimize=True)
+        if buf.tell() <= max_bytes:
+            logger.info(f'JPEGに変換しました:quality={quality}:{buf.tell()}bytes')
+            return buf.getvalue()
+    return None
+
+
+def _decoded_bytes(image):
+    """
+    展開した時の大きさ(byte)を返す(Pillowは1チャンネル以外の画像を1画素4byteで持つ)
+    """
+    width,height = image.size
+    return width * height * (1 if image.mode in ('1','L','P') else 4)
+
+
+def _has_alpha(image):
+    """
+    透過部分がある画像か調べる
+    """
+    return image.mode in ('RGBA','LA','PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def _flatten(image,has_alpha):
+    """
+    RGBにする。透過部分は白で塗る(絵は白地に描かれていることが多いため)
+    """
+    from PIL import Image
+
+    if has_alpha:
+        image = image.convert('RGBA')
+        background = Image.new('RGB',image.size,(255,255,255))
+        background.paste(image,mask=image.getchannel('A'))
+        return background
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+
+def _shrink(image,target_long_edge):
+    """
+    長辺がtarget_long_edgeになるまで、横長の帯ごとに白地のRGBにして縮小する
+    帯の上下には縮小フィルターが参照する行も含めて切り出すので、まとめて縮小した場合と同じ画素になる
+    展開した元画像のほかには、帯と縮小後の画像の分しかメモリを使わない
+
+    引数  :  image              Image   元画像
+             target_long_edge   int     縮小後の長辺(px)
+    戻り値:  image              Image   縮小後の画像(RGB)
+    """
+    from PIL import Image
+
+    has_alpha = _has_alpha(image)
+    width,height = image.size
+    scale = max(width,height) / target_long_edge
+    if scale <= 1:
+        return _flatten(image,has_alpha)
+
+    out_width = max(1,round(width / scale))
+    out_height = max(1,round(height / scale))
+    scale_y = height / out_height
+    margin = math.ceil(LANCZOS_SUPPORT * scale_y) + 1
+
+    shrunk = Image.new('RGB',(out_width,out_height))
+    for out_top in range(0,out_height,STRIP_ROWS):
+        out_bottom = min(out_top + STRIP_ROWS,out_height)
+        top = max(0,math.floor(out_top * scale_y) - margin)
+        bottom = min(height,math.ceil(out_bottom * scale_y) + margin)
+
+        strip = _flatten(image.crop((0,top,width,bottom)),has_alpha)
+        strip = strip.resize(
+            (out_width,out_bottom - out_top),
+            Image.LANCZOS,
+            box=(0,out_top * scale_y - top,width,out_bottom * scale_y - top),
+        )
+        shrunk.paste(strip,(0,out_top))
+
+    logger.info(f'縮小しました:size={shrunk.size}')
+    return shrunk
+
+
+def _transpose(image,orientation):
+    """
+    Exifの向き(Orientation)を画素に反映する
+    """
+    from PIL import Image
+
+    method = {
+        2:Image.FLIP_LEFT_RIGHT,
+        3:Image.ROTATE_180,
+        4:Image.FLIP_TOP_BOTTOM,
+        5:Image.TRANSPOSE,
+        6:Image.ROTATE_270,
+        7:Image.TRANSVERSE,
+        8:Image.ROTATE_90,
+    }.get(orientation)
+    if method is None:
+        return image
+    return image.transpose(method)
+
+
+def normalize_image(data,target_long_edge=TARGET_LONG_EDGE,max_bytes=MAX_OUTPUT_BYTES):
+    """
+    画像を縮小してJPEGにする
+
+    引数  :  data               bytes   元画像
+             target_long_edge   int     縮小後の長辺(px)
+             max_bytes          int     縮小後の上限サイズ(byte)
+    戻り値:  image_bytes        bytes   縮小後の画像(JPEG、メタデータなし)
+    """
+    from PIL import Image
+
+    logger.info('Function normalize_image')
+    logger.info(f'元画像:{len(data)}bytes')
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        logger.info(f'元画像:format={image.format}:size={image.size}:mode={image.mode}')
+
+        #JPEGは縮小しながら読み込む(PNGなどは何もしない)
+        image.draft('RGB',(target_long_edge,target_long_edge))
+
+        decoded_bytes = _decoded_bytes(image)
+        if decoded_bytes > MAX_DECODE_BYTES:
+            width,height = image.size
+            raise ImageTooLargeError(f'画像が大きすぎます:{width}x{height}:{image.mode}:{decoded_bytes}bytes')
+
+        #Exifの向きは縮小後に反映する(このあとメタデータは保存しない)
+        orientation = image.getexif().get(0x0112)
+
+        image = _shrink(image,target_long_edge)
+        image = _transpose(image,orientation)
+
+        #ここからは縮小後の画像だけを扱う(上限サイズを超える場合は、さらに縮小する)
+        long_edge = target_long_edge
+        while True:
+            image.thumbnail((long_edge,long_edge),Image.LANCZOS)
+            logger.info(f'縮小しました:size={image.size}')
+
+            image_bytes = _encode_jpeg(image,max_bytes)
+            if image_bytes is not None:
+                return image_bytes
+
+            if long_edge <= MIN_LONG_EDGE:
+                raise ImageNormalizeError(f'上限サイズ以下に縮小できませんでした:{max_bytes}bytes')
+            long_edge = max(long_edge // 2,MIN_LONG_EDGE)
+
+    except ImageNormalizeError:
+        raise
+    except Exception as e:
+        raise ImageNormalizeError(f'画像を読み込めませんでした:{type(e)}:{e}')
@@ -1,16 +1,15 @@
 #coding: UTF-8
 import os
+import base64
 import json
 import sys
 import urllib.parse
-import boto3
-from boto3.dynamodb.conditions import Key
 from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
-import decimal
-from datetime import datetime
+from datetime import datetime,timezone
 import math
-import slack
 import traceback
+from src import clients,label_cache,label_store,slack_outbox,tracing
+from src.repository import Repository
 
 
 logger = getLogger(__name__)
@@ -22,111 +21,188 @@ logger.addHandler(loghandler)
 logger.info('処理を開始します')
 
 AWS_S3_BUCKET_NAME = os.environ['PUT_BACKET']
-client = slack.WebClient(token=os.environ['SLACK_API_TOKEN'])
-bot_client = slack.WebClient(token=os.environ['SLACK_BOT_API_TOKEN'])
-post_channel = os.environ['POST_CHANNEL']
-s3 = boto3.client('s3')
-rekognition = boto3.client('rekognition')
 TWO_DAYS = 180000 # 若干余裕を持っている
+MAX_LABELS = 10 # Rekognitionで取得するラベル数
+MAX_STATE_RETRY = 5 # ゲームの状態の更新が競合した場合の再試行回数
+JUDGE_PREFIX = 'judge/' # このプレフィックスの画像がS3に投稿されると判定する
+ARCHIVE_PREFIX = 'archive/' # インライン判定モードで判定済みの画像の保存先(判定しない)
 
 logger.info('環境変数を設定しました')
 
 def handler(event, context):
     logger.info("Received event: " + json.dumps(event))
 
+    tracing.start('judge')
+    try:
+        repo = Repository()
+
+        # Get the object from the event and show its content type
+        record = event['Records'][0]
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+
+        logger.debug(f'S3バケット名:{bucket}')
+        logger.debug(f'S3に投稿されたファイル名:{key}')
+
+        #インライン判定モードでアーカイブした画像は、mainで判定済みなので何もしない
+        if key.startswith(ARCHIVE_PREFIX):
+            logger.info('判定済みの画像のため処理を終了します')
+            return
+
+        #S3に画像が置かれてから、このイベントが届くまでの時間
+        event_time = record.get('eventTime')
+        if event_time:
+            delivered = datetime.strptime(event_time,'%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+            tracing.record('s3_event_delivery',(datetime.now(timezone.utc) - delivered).total_seconds() * 1000)
+
+        image_id = int(os.path.basename(key)[:-4]) #ファイル名から拡張子(.png/.jpg)を除く
+        with tracing.span('get_image'):
+            image = dict(repo.get_image(image_id) or {})
+
+        #相関ID(Slackのfile_id)と画像のハッシュはimageテーブルから引き継ぐ
+        #ない場合(ストリーミングで転送した画像など)は、S3のメタデータとチェックサムから読む
+        correlation_id = image.get('fileId')
+        if not correlation_id or not image.get('imageHash'):
+            metadata_id,image_hash = get_object_info(bucket,key)
+            correlation_id = correlation_id or metadata_id
+            image.setdefault('imageHash',image_hash)
+        tracing.set_correlation_id(correlation_id)
+
+        rekognition_image = {
+            'S3Object': {
+                'Bucket': AWS_S3_BUCKET_NAME,
+                'Name': key,
+            }
+        }
+        judge_image(repo,image,rekognition_image)
+
+    finally:
+        tracing.emit()
+
+
+def get_object_info(bucket,key):
+    """
+    mainがS3のオブジェクトに付けた相関ID(メタデータ)と、S3が計算した画像のSHA-256(チェックサム)を読む
+
+    引数:   bucket   str   バケット名
+            key      str   オブジェクトのキー
+    戻り値: correlation_id   str   相関ID。読めない場合はNone
+            image_hash       str   画像のSHA-256(16進)。読めない場合はNone
+    """
+    try:
+        res = clients.s3().head_object(Bucket=bucket,Key=key,ChecksumMode='ENABLED')
+    except Exception as e:
+        logger.warning(f'S3のメタデータを読めませんでした:{e}')
+        return None,None
+
+    correlation_id = res.get('Metadata',{}).get(tracing.CORRELATION_METADATA_KEY)
+
+    #マルチパートでアップロードした場合(<チェックサム>-<パート数>)は、画像全体のハッシュではないので使わない
+    image_hash = None
+    checksum = res.get('ChecksumSHA256')
+    if checksum and '-' not in checksum:
+        image_hash = base64.b64decode(checksum).hex()
+
+    return correlation_id,image_hash
+
+
+def judge_image(repo,image,rekognition_image):
+    """
+    画像を判定し、結果をDBに登録してSlackに投稿する
+    (S3イベントから呼ばれる他に、インライン判定モードではmainから直接呼ばれる)
+
+    引数:   repo               Repository DBアクセス
+            image              dict       imageテーブルのデータ(poster/channelId/gameId/imageHash)
+            rekognition_image  dict       RekognitionのImage引数(S3ObjectまたはBytes)
+    戻り値: なし(失敗時は終了コード1で終了する)
+    """
+
+    logger.info('Function judge_image')
+    logger.info(f'image:{image}')
+
+    ##結果は画像が投稿されたチャンネルに、mainが投稿した受付メッセージを書き換えて投稿する
+    ##(受付メッセージがない古い画像は新しく投稿する)
+    channel_id = image.get('channelId')
+    outbox = slack_outbox.Outbox(channel_id,image.get('messageChannel'),image.get('messageTs'))
+
+    ##画像を受け付けたゲームを取得(チャンネルごとのゲームなので、画像を受け付けた時点のゲームを使う)
+    current_game_id = image.get('gameId')
+    logger.debug('channel_id:'+str(channel_id))
+    logger.debug('current_game_id:'+str(current_game_id))
+
     #実行中のゲームがない場合は早期リターン
-    if not is_game_in_progress():
+    game = repo.get_game(current_game_id) if current_game_id else None
+    if not game or game.get('isEnded'):
         message_nogame = '実行中のゲームがありません！'
         logger.warning(message_nogame)
         logger.info('処理を中断します')
         exit(1)
 
-    # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-
-    logger.debug(f'S3バケット名:{bucket}')
-    logger.debug(f'S3に投稿されたファイル名:{key}')
-
     try:
 
         ##Rekognitionに投げてAI判定結果の単語を取得
-        retrekog = rekognition.detect_labels(
-                Image={
-                    'S3Object': {
-                    'Bucket': AWS_S3_BUCKET_NAME,
-                    'Name': key,
-                }
-            },
-            MaxLabels=10
-        )
+        ##(同じ絵が再投稿された場合はキャッシュの結果を使う)
+        with tracing.span('detect_labels'):
+            retrekog = label_cache.detect_labels(rekognition_image,image.get('imageHash'),MAX_LABELS)
         
         logger.debug('retrekog:'+str(retrekog))
-        
-        
-        ##最新のgame_idを取得
-        current_game_id = get_game_id()
-        logger.debug('current_game_id:'+str(current_game_id))
-        
-        ##最後の文字を取得
-        prev_next_char = get_next_char(current_game_id)
-        logger.debug('prev_next_char:'+prev_next_char)
-        
-        ##AI判定した単語に、しりとり成立する単語があるか探す
-        next_word = get_next_word(retrekog,prev_next_char,current_game_id)
-        logger.debug('next_word:'+str(next_word))
-        
-        ##Dynamodbに投げるJson作成
-        prev_id = get_valid_word_id(current_game_id)
-        word_id = get_word_id(current_game_id)+1
-
-        dt = datetime.now()
-        current_time = math.floor(dt.timestamp())
-        
-        image_id = int(key[:-4]) #ファイル名から拡張子.pngを除く
-        is_valid = bool(next_word)
-        
-        if is_valid:
-            ##しりとり成立の場合
-            ####next_charを設定
-            next_char = next_word[-1].upper()
-            ####wordをしりとり成立した値に更新
-            word = next_word
-        
-        else:
-            ##しりとり不成立の場合
-            ####next_charは空文字
-            next_char = ''
-            ####wordを最も一致度が高い単語に更新
-            word = most_confident_word(retrekog)
-            
-        put_json = {
-                    'id':word_id,
-                    'gameId':int(current_game_id),
-                    'isValid':is_valid,
-                    'word':word,
-                    'nextChar':next_char,
-                    'postTime':int(current_time),
-                    'poster':get_poster(image_id),
-                    'prevId':int(prev_id),
-                    'retJson':retrekog,
-                    'unixTime':int(current_time)+TWO_DAYS,
-        }
 
-        logger.debug('put_json:'+str(put_json))
-            
-        ##Dynamodbのwordテーブルにデータ挿入
-        ret_db = insert_word_table(put_json)
-        logger.debug('データ挿入の戻り値:'+str(ret_db))
-        
-        if ret_db:
-            logger.info('DynamoDBにデータを挿入しました')
+        ##候補の単語を頭文字ごとに分けておく(判定し直す場合も使い回す)
+        candidates = bucket_candidates(retrekog)
+
+        poster = image.get('poster','default_user')
+
+        ##rekognitionの元の結果は、label_storeで圧縮(またはS3に保存)してwordテーブルに一緒に登録する
+        ##(S3に保存する場合のキーは画像ごとなので、判定し直しても保存は1回だけ行う)
+        raw_labels = label_store.encode_raw_labels(retrekog,current_game_id,image.get('imageId'))
+
+        ##wordテーブルへの挿入とゲームの状態の更新を、1つのトランザクションで条件付きで書き込む
+        ##同時に判定した他の画像が先に更新した場合は、読み直して判定し直す
+        ##(読み直したゲームが終了していた場合は受け付けない)
+        for attempt in range(MAX_STATE_RETRY):
+            if attempt:
+                tracing.count('game_state_retry')
+                game = repo.get_game(current_game_id)
+
+                #判定中にfinishがゲームを終了した場合は、再試行せずに受け付けない
+                if game.get('isEnded'):
+                    message_ended = 'ゲームは終了しています！'
+                    logger.warning(message_ended)
+                    outbox.post(message_ended)
+                    outbox.flush()
+                    return
+
+            state = repo.get_game_state(game)
+            logger.debug('state:'+str(state))
+
+            ##最後の文字を取得
+            prev_next_char = state['nextChar'].upper()
+            logger.debug('prev_next_char:'+prev_next_char)
+
+            ##AI判定した単語に、しりとり成立する単語があるか探す
+            ##(お知らせは判定し直した時に重複しないよう、状態の更新に成功してから投稿する)
+            notices = []
+            used_words = build_used_word_index(state['usedWords'])
+            next_word = get_next_word(candidates,prev_next_char,used_words,notices)
+            logger.debug('next_word:'+str(next_word))
+
+            put_json = make_word_json(retrekog,next_word,current_game_id,state,poster)
+            logger.debug('put_json:'+str(put_json))
+
+            with tracing.span('commit_word'):
+                updated = repo.commit_word(current_game_id,next_game_state(state,put_json),{**put_json,**raw_labels})
+            if updated:
+                logger.info('DynamoDBにデータを挿入しました')
+                break
         else:
-            logger.error('DynamoDBへのデータ挿入に失敗しました')
+            logger.error('ゲームの状態の更新に失敗しました')
             sys.exit(1)
+
+        for notice in notices:
+            outbox.post(notice)
         
         ##結果をslackに投稿
-        ret_slack = send_message_to_slack(put_json,prev_next_char)
+        ret_slack = send_message_to_slack(put_json,prev_next_char,outbox)
         
         if ret_slack:
             logger.info('Slackへの投稿に成功しました')
@@ -139,260 +215,197 @@ def handler(event, context):
     except Exception as e:
         message_error = f'エラーが発生しました:{traceback.format_exc()}'
         logger.error('message_error')
-        bot_client.chat_postMessage(channel=post_channel, text=message_error)
+        outbox.post(message_error)
+        outbox.flush()
         logger.error('処理を中止します')
         exit(1)
 
 
-def get_game_id():
+def make_word_json(retrekog,next_word,game_id,state,poster):
     """
-    最新のgame_idを取得
-    
-    引数    :  なし
-    戻り値  :  game_id    int  最新のgame_id
+    wordテーブルに挿入するデータを作成する
+
+    引数:   retrekog   dict   rekognitionの戻り値
+            next_word  str    しりとり成立した単語。なければNone
+            game_id    int    ゲームID
+            state      dict   判定に使ったゲームの集約状態
+            poster     str    投稿者
+    戻り値: put_json   dict   wordテーブルに挿入するデータ
     """
-    
-    logger.info('Function get_game_id')
-    
-    dynamodb = boto3.resource('dynamodb')
-    game_table = dynamodb.Table('game')
-    game_res = game_table.scan()
-
-    game_id = 0
-    for item in game_res.get('Items'):
-        if game_id < item.get('id'):
-                game_id = item.get('id')
-    return game_id
-    
-    
-def get_word_id(game_id):
+
+    dt = datetime.now()
+    current_time = math.floor(dt.timestamp())
+
+    is_valid = bool(next_word)
+
+    if is_valid:
+        ##しりとり成立の場合
+        ####next_charを設定
+        next_char = next_word[-1].upper()
+        ####wordをしりとり成立した値に更新
+        word = next_word
+
+    else:
+        ##しりとり不成立の場合
+        ####next_charは空文字
+        next_char = ''
+        ####wordを最も一致度が高い単語に更新
+        word = most_confident_word(retrekog)
+
+    put_json = {
+                'id':state['lastWordId']+1,
+                'gameId':int(game_id),
+                'isValid':is_valid,
+                'word':word,
+                'nextChar':next_char,
+                'postTime':int(current_time),
+                'poster':poster,
+                'prevId':state['lastValidId'],
+                'labels':label_store.summarize_labels(retrekog),
+                'unixTime':int(current_time)+TWO_DAYS,
+    }
+
+    return put_json
+
+
+def next_game_state(state,put_json):
     """
-    最新のword_idを取得(isValid=falseも含む)
-    
-    引数  :  game_id    int  最新のgame_id
-    戻り値:  word_id    int  現時点での最後のword_id
+    判定結果を反映したゲームの集約状態を返す(引数のstateは変更しない)
+    集約状態は/shiritori statusとfinishがそのまま読む(wordテーブルを読み直さない)
+
+    引数:   state      dict   判定前のゲームの集約状態
+            put_json   dict   wordテーブルに挿入するデータ
+    戻り値: new_state  dict   判定後のゲームの集約状態
     """
-    
-    logger.info('Function get_word_id')
-    logger.info('game_id:'+str(game_id))
-    
-    word_res = get_words(game_id)
-    
-    logger.debug('word_res:'+str(word_res))
-    
-    word_id = 0
-    
-    for item in word_res:
-            if word_id < item.get('id'):
-                word_id = item.get('id')
-                
-    return word_id
 
+    new_state = dict(state)
+    new_state['lastWordId'] = put_json['id']
 
-def get_valid_word_id(game_id):
+    if put_json['isValid']:
+        poster = put_json['poster']
+        new_state['nextChar'] = put_json['nextChar']
+        new_state['lastValidId'] = put_json['id']
+        new_state['usedWords'] = state['usedWords'] + [put_json['word']]
+        new_state['posterCounts'] = dict(state['posterCounts'])
+        new_state['posterCounts'][poster] = new_state['posterCounts'].get(poster,0) + 1
+        new_state['posterLastIds'] = dict(state.get('posterLastIds',{}))
+        new_state['posterLastIds'][poster] = put_json['id']
+
+    return new_state
+
+
+def normalize_word(word):
     """
-    最新のword_idを取得
-    
-    引数  :  game_id    int  最新のgame_id
-    戻り値:  word_id    int  現時点での最後のword_id
+    既出判定用に単語を正規化する(大文字小文字・空白・単数形/複数形の違いをなくす)
+    例: "Cats" -> "cat", "Ice Cream" -> "icecream", "Berries" -> "berry", "Boxes" -> "box"
+
+    引数:   word      str   単語
+    戻り値: key       str   正規化した単語
     """
-    
-    logger.info('Function get_valid_word_id')
-    logger.info('game_id:'+str(game_id))
-    
-    word_res = get_words(game_id)
-    
-    logger.debug('word_res:'+str(word_res))
-    
-    word_id = 0
-    
-    for item in word_res:
-        if item.get('isValid'):
-            if word_id < item.get('id'):
-                word_id = item.get('id')
-                
-    return word_id
-    
-    
-def get_words(game_id):
+
+    tokens = word.casefold().split()
+    if not tokens:
+        return ''
+
+    #複数形は最後の単語だけ単数形にする
+    last = tokens[-1]
+    if len(last) > 4 and last.endswith('ies'):
+        last = last[:-3] + 'y'
+    elif len(last) > 3 and last.endswith(('sses','xes','zes','ches','shes')):
+        last = last[:-2]
+    elif len(last) > 3 and last.endswith('s') and not last.endswith(('ss','us','is')):
+        last = last[:-1]
+    tokens[-1] = last
+
+    return ''.join(tokens)
+
+
+def build_used_word_index(past_words):
     """
-    wordテーブルのデータを取得   ##FIX 検索はqueryで行いたい
-    引数  :  game_id    int        game_id
-    戻り値:  words     list<dict>  wordテーブルのデータ
+    既出単語を正規化したsetを返す(判定ごとに1回作る)
+
+    引数:   past_words  list<str>  これまでにしりとりが成立した単語
+    戻り値: used_words  set<str>   正規化した既出単語
     """
-    logger.info('Function get_words')
-    logger.info('game_id:'+str(game_id))
-    
-    dynamodb = boto3.resource('dynamodb')
-    word_table = dynamodb.Table('word')
-    word_res = word_table.scan()
 
-    logger.debug('word_res:'+str(word_res))
-    
-    words = []
-    for i in word_res.get('Items'):
-        if i.get('gameId') == game_id:
-            words.append(i)
+    logger.info('Function build_used_word_index')
+    logger.info('これまでの単語:'+','.join(past_words))
 
-    return words
+    return {normalize_word(w) for w in past_words}
 
-    
-def get_next_char(game_id):
+
+def bucket_candidates(retrekog):
     """
-    現時点での最後の文字を取得
-    引数  :  game_id    int  最新のgame_id
-    戻り値:  next_char  str  しりとり成立する文字
+    rekognitionの戻り値から、候補の単語を頭文字ごとに分ける
+    ラベルのNameに加えて、Parents(上位概念)・Aliases(別名)も候補にする(戻り値を1回走査するだけで作る)
+    同じ単語(正規化して同じもの)は一致度が高い方だけ残し、頭文字ごとに一致度の高い順に並べる
+
+    引数:   retrekog    dict   rekognitionの戻り値
+    戻り値: candidates  dict   頭文字(大文字)→単語のリスト(一致度の高い順)
     """
-    
-    logger.info('Function get_next_char')
-    logger.info('game_id:'+str(game_id))
-    
-    words = get_words(game_id)
-    
-    logger.debug('words:'+str(words))
-    
-    max_word_id = 0
-    next_char = ''
-    
-    for wr in words:
-        if wr.get('gameId') == game_id and max_word_id < wr.get('id') and wr.get('isValid'):
-            max_word_id = wr.get('id')
-            next_char = wr.get('nextChar').upper()
-            
-    return next_char
+
+    logger.info('Function bucket_candidates')
+
+    best = {} #正規化した単語→(一致度,単語)
+    for label in retrekog.get('Labels',[]):
+        confidence = label.get('Confidence',0.0)
+        names = [label.get('Name')]
+        names.extend(p.get('Name') for p in label.get('Parents',[]))
+        names.extend(a.get('Name') for a in label.get('Aliases',[]))
+
+        for name in names:
+            name = (name or '').strip()
+            if not name:
+                continue
+            key = normalize_word(name)
+            if key not in best or best[key][0] < confidence:
+                best[key] = (confidence,name)
+
+    candidates = {}
+    for confidence,name in sorted(best.values(),key=lambda x:-x[0]):
+        candidates.setdefault(name[0].upper(),[]).append(name)
+
+    logger.debug(f'candidates:{candidates}')
+    return candidates
 
 
-def get_next_word(retrekog,next_char,game_id):
+def get_next_word(candidates,next_char,used_words,notices):
     """
-    しりとり成立する単語を返す
+    しりとり成立する単語のうち、一致度が最も高いものを返す
     
-    引数:  retrekog dict  最新のgame_id
+    引数:  candidates dict  頭文字→単語のリスト(bucket_candidatesの戻り値)
            next_char str   しりとり成立する頭文字
+           used_words set<str>  正規化した既出単語(build_used_word_indexの戻り値)
+           notices list<str>  Slackに投稿するお知らせ(この関数で追加する)
     戻り値:next_word str しりとり成立した単語。なければNone
     """
     
     logger.info('Function get_next_word')
-    logger.info('retrekog:'+str(retrekog))
     logger.info('nextChar:'+str(next_char))
-    logger.info('game_id:'+str(game_id))
-    
-    labels = retrekog.get('Labels')
-    
-    words = get_words(game_id)
-    past_words = []
-    for w in words:
-        logger.debug(f'これまでの単語:{str(w)}')
-        if w.get('isValid'):
-            past_words.append(w.get('word'))
-        
-    logger.info('これまでの単語:'+','.join(past_words))
 
     next_word = None
-    duplicate = False
-    
-    for label in labels:
-        candidate = label.get('Name')
-        if candidate[0] == next_char:
-            for pw in past_words:
-                if candidate == pw:
-                    logger.info(f'すでにこの単語は出ています:{candidate}')
-                    msg = f'{candidate}はもう出ているよ！'
-                    bot_client.chat_postMessage(channel=post_channel, text=msg)
-                    duplicate = True
-                    break
-
-            if not duplicate:#過去に出ていない単語の場合
-                next_word = candidate
-                break
-    
-    logger.info('次の単語:'+str(next_word))
 
-    return next_word
-    
-    
-def insert_word_table(put_json):
-    """
-    Dynamodbのwordテーブルにデータを挿入する
-    
-    引数:   put_json  dict    挿入するデータ
-    戻り値: ret      boolean データ挿入の成否
-    """
-    
-    logger.info('Function insert_word_table')
-    logger.info('json:'+str(put_json))
-    
-    dynamodb = boto3.resource('dynamodb')
-    word_table = dynamodb.Table('word')
-    
-    item = dict_float_to_decimal(put_json)
-    
-    try:
-        res = word_table.put_item(Item=item)
-        logger.info(res)
+    for candidate in candidates.get(next_char,[]):
+        if normalize_word(candidate) in used_words:
+            logger.info(f'すでにこの単語は出ています:{candidate}')
+            notices.append(f'{candidate}はもう出ているよ！')
+            continue
 
-    except Exception as e:
-        logger.error(e)
-        return False
-    
-    return True
-
-
-def dict_float_to_decimal(json_obj):
-    """
-    dictのfloat型要素をdecimal型に変更する
-    
-    引数:   json_obj dict 変換前dict
-    戻り値: json_obj dict 変換後dict
-    """
+        next_word = candidate
+        break
     
-    logger.info('Function dict_float_to_decimal')
-    logger.info('json:'+str(json_obj))
-    
-    for key,value in json_obj.items():
-        
-        if isinstance(value,dict):
-            json_obj[key] = dict_float_to_decimal(value)
-        elif isinstance(value,list):
-            json_obj[key] = list_float_to_decimal(value)
-        elif isinstance(value,float):
-            json_obj[key] = decimal.Decimal(value)
-        else:
-            pass
-        
-    return json_obj
-
+    logger.info('次の単語:'+str(next_word))
 
-def list_float_to_decimal(list_obj):
-    """
-    listのfloat型要素をdecimal型に変更する
-    
-    引数:   list_obj list 変換前list
-    戻り値: list_obj list 変換後list
-    """
-    
-    logger.info('Function list_float_to_decimal')
-    logger.info('list:'+str(list_obj))
-    
-    for index,value in enumerate(list_obj):
-        
-        if isinstance(value,dict):
-            list_obj[index] = dict_float_to_decimal(value)
-        elif isinstance(value,list):
-            list_obj[index] = list_float_to_decimal(value)
-        elif isinstance(value,float):
-            list_obj[index] = decimal.Decimal(value)
-        else:
-            pass
+    return next_word
     
-    return list_obj
     
-
-def send_message_to_slack(result_json,prev_next_char):
+def send_message_to_slack(result_json,prev_next_char,outbox):
     """
-    判定結果をSlackに投稿する
+    判定結果をSlackに投稿する(outboxにためたお知らせとまとめて投稿する)
     
     引数:   result_json    dict     判定結果json
             prev_next_char  str      1個前の単語の最後の文字
+            outbox         Outbox   Slackへの投稿
     戻り値: ret           boolean  Slack投稿成否
     """
     
@@ -420,7 +433,8 @@ def send_message_to_slack(result_json,prev_next_char):
     
     try:
         logger.debug('try文')
-        bot_client.chat_postMessage(channel=post_channel, text=msg)
+        outbox.post(msg)
+        outbox.flush()
     except Exception as e:
         logger.error(e)
         return False
@@ -446,59 +460,3 @@ def most_confident_word(retrekog):
             most_confident_word = word.get('Name')
     
     return most_confident_word
-    
-    
-def get_poster(image_id):
-    """
-    画像のIDから、投稿者を返す
-    
-    引数:   image_id    int    画像ID
-    戻り値: poster     str    投稿者名 テーブルに存在しない場合は、'defalut_user'を返す
-    """
-
-    logger.info('Function get_poster')
-    logger.info('image_id:'+str(image_id))
-
-    dynamodb = boto3.resource('dynamodb')
-    image_table = dynamodb.Table('image')
- 
-    try:
-        res = image_table.get_item(Key={'imageId': image_id})
-        logger.info(res)
-        poster = res.get('Item').get('poster','default_user')
-
-    except Exception as e:
-        logger.warning(f'imageテーブルからユーザーを取得できませんでした:{e}')
-        return 'default_user'
-
-    return poster
-
-
-def is_game_in_progress():
-    """
-    実行中のゲームがあるか調べる
-    
-    引数    :  なし
-    戻り値  :  isGame boolean 実行中のゲームがある(True)か、ない(False)か。
-    """
-
-    logger.info('Function is_game_in_progress')
-
-    dynamodb = boto3.resource('dynamodb')
-    game_table = dynamodb.Table('game')
-
-    try:
-        res = game_table.scan()
-        logger.info(res)
-
-    except Exception as e:
-        logger.warning(f'gameテーブルへの接続に失敗しました:{e}')
-        raise e
-
-    for item in res.get('Items'):
-        if not item.get('isEnded'):
-            logger.debug('実行中のゲームがあります')
-            return True
-
-    logger.debug('実行中のゲームはありません')
-    return False
\ No newline at end of file
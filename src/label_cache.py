@@ -0,0 +1,137 @@
+#coding: UTF-8
+"""
+RekognitionのDetectLabelsの結果を、画像の内容(SHA-256)をキーにしてキャッシュするモジュール
+
+同じ絵が再投稿された場合は、Rekognitionを呼ばずにキャッシュの結果で判定する。
+  1段目: コンテナ内のLRUキャッシュ(ウォームスタートの実行で共有)
+  2段目: DynamoDBのlabelCacheテーブル(TTLで自動削除)
+"""
+import json
+import math
+import time
+from collections import OrderedDict
+from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
+
+from src import clients
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+loghandler = StreamHandler()
+loghandler.setFormatter(Formatter("%(asctime)s %(name)s %(levelname)8s %(message)s"))
+logger.addHandler(loghandler)
+
+LABEL_CACHE_TABLE = 'labelCache' # ハッシュキー:imageHash
+LABEL_CACHE_TTL = 7 * 24 * 60 * 60 # 7日
+LRU_MAX_ENTRIES = 128
+
+#値はJSON文字列で持ち、取り出すたびに新しいdictにする(呼び出し側で書き換えられても影響しないように)
+_lru = OrderedDict()
+
+
+def _cache_key(image_hash,max_labels):
+    return f'{image_hash}:{max_labels}'
+
+
+def _lru_get(cache_key):
+    labels_json = _lru.get(cache_key)
+    if labels_json is None:
+        return None
+    _lru.move_to_end(cache_key)
+    return json.loads(labels_json)
+
+
+def _lru_put(cache_key,labels_json):
+    _lru[cache_key] = labels_json
+    _lru.move_to_end(cache_key)
+    while len(_lru) > LRU_MAX_ENTRIES:
+        _lru.popitem(last=False)
+
+
+def get_cached_labels(image_hash,max_labels):
+    """
+    キャッシュからDetectLabelsの結果を取得する(LRU→DynamoDBの順に探す)
+
+    引数  :  image_hash   str    画像のSHA-256(16進)
+             max_labels   int    DetectLabelsのMaxLabels
+    戻り値:  retrekog     dict   DetectLabelsの結果。キャッシュにない場合はNone
+    """
+    logger.info('Function get_cached_labels')
+    logger.info(f'image_hash:{image_hash}')
+
+    cache_key = _cache_key(image_hash,max_labels)
+
+    retrekog = _lru_get(cache_key)
+    if retrekog is not None:
+        logger.info('LRUキャッシュにヒットしました')
+        return retrekog
+
+    try:
+        res = clients.table(LABEL_CACHE_TABLE).get_item(Key={'imageHash':cache_key})
+    except Exception as e:
+        logger.warning(f'labelCacheテーブルを読み込めませんでした:{e}')
+        return None
+
+    item = res.get('Item')
+    if not item:
+        logger.info('キャッシュにありません')
+        return None
+
+    logger.info('DynamoDBのキャッシュにヒットしました')
+    _lru_put(cache_key,item['labels'])
+    return json.loads(item['labels'])
+
+
+def put_cached_labels(image_hash,max_labels,retrekog):
+    """
+    DetectLabelsの結果をキャッシュに保存する(LRUとDynamoDBの両方)
+
+    引数  :  image_hash   str    画像のSHA-256(16進)
+             max_labels   int    DetectLabelsのMaxLabels
+             retrekog     dict   DetectLabelsの結果
+    戻り値:  なし(DynamoDBへの保存に失敗しても例外にしない)
+    """
+    logger.info('Function put_cached_labels')
+
+    cache_key = _cache_key(image_hash,max_labels)
+    labels_json = json.dumps(retrekog)
+    _lru_put(cache_key,labels_json)
+
+    item = {
+        'imageHash':cache_key,
+        #float型をそのまま保存できるようにJSON文字列で持つ
+        'labels':labels_json,
+        'unixTime':math.floor(time.time()) + LABEL_CACHE_TTL,
+    }
+
+    try:
+        clients.table(LABEL_CACHE_TABLE).put_item(Item=item)
+    except Exception as e:
+        logger.warning(f'labelCacheテーブルに保存できませんでした:{e}')
+
+
+def detect_labels(rekognition_image,image_hash,max_labels):
+    """
+    画像のラベルを取得する。キャッシュにあればRekognitionを呼ばない
+
+    引数  :  rekognition_image  dict   RekognitionのImage引数(S3ObjectまたはBytes)
+             image_hash   str    画像のSHA-256(16進)。Noneの場合はキャッシュを使わない
+             max_labels   int    DetectLabelsのMaxLabels
+    戻り値:  retrekog     dict   DetectLabelsの結果(ResponseMetadataは除く)
+    """
+    logger.info('Function detect_labels')
+
+    if image_hash:
+        retrekog = get_cached_labels(image_hash,max_labels)
+        if retrekog is not None:
+            return retrekog
+
+    retrekog = clients.rekognition().detect_labels(
+        Image=rekognition_image,
+        MaxLabels=max_labels
+    )
+    retrekog.pop('ResponseMetadata',None)
+
+    if image_hash:
+        put_cached_labels(image_hash,max_labels,retrekog)
+
+    return retrekog
@@ -0,0 +1,101 @@
+#coding: UTF-8
+"""
+wordテーブルに保存するRekognitionの結果を、小さく保存・復元するモジュール
+
+  - labels    : ラベル名と一致度だけの要約(一致度は100倍した整数で持つので、Decimalへの変換が不要)
+  - 元の結果  : RAW_LABELS_STORAGEで保存方法を選ぶ
+                  zlib : zlibで圧縮してバイナリ属性(retJsonZ)に保存する(デフォルト)
+                  s3   : S3(labels/<gameId>/<imageId>.json)にgzipで保存し、キー(retJsonKey)だけ持つ
+                  none : 保存しない
+元の結果はdecode_raw_labels()を呼んだ時だけ復元する(通常の判定・終了処理では使わない)。
+"""
+import gzip
+import json
+import os
+import zlib
+from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
+
+from src import clients
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+loghandler = StreamHandler()
+loghandler.setFormatter(Formatter("%(asctime)s %(name)s %(levelname)8s %(message)s"))
+logger.addHandler(loghandler)
+
+RAW_LABELS_STORAGE = os.environ.get('RAW_LABELS_STORAGE','zlib') # zlib/s3/none
+RAW_LABELS_PREFIX = 'labels/' # S3に保存する場合のプレフィックス(judgeのS3イベントの対象外)
+CONFIDENCE_SCALE = 100 # 一致度(%)を100倍した整数で持つ(小数点以下2桁)
+
+
+def summarize_labels(retrekog):
+    """
+    rekognitionの戻り値から、ラベル名と一致度だけの要約を作る
+
+    引数  :  retrekog   dict         rekognitionの戻り値
+    戻り値:  labels     list<dict>   [{'name':ラベル名,'confidence':一致度×100(int)}]
+    """
+    return [
+        {
+            'name':label.get('Name'),
+            'confidence':int(round(label.get('Confidence',0.0) * CONFIDENCE_SCALE)),
+        }
+        for label in retrekog.get('Labels',[])
+    ]
+
+
+def encode_raw_labels(retrekog,game_id,image_id,storage=None):
+    """
+    rekognitionの戻り値を、wordテーブルに保存する形にする
+
+    引数  :  retrekog   dict   rekognitionの戻り値
+             game_id    int    ゲームID
+             image_id   int    画像ID(word_idは書き込むまで決まらないので、画像ごとのキーにする)
+             storage    str    保存方法(zlib/s3/none)。省略時はRAW_LABELS_STORAGE
+    戻り値:  attrs      dict   wordテーブルのデータに追加する属性(retJsonZまたはretJsonKey)
+                               S3への保存に失敗した場合は空(元の結果は保存しない)
+    """
+    storage = storage or RAW_LABELS_STORAGE
+    raw = json.dumps(retrekog,separators=(',',':')).encode()
+
+    if storage == 'zlib':
+        compressed = zlib.compress(raw,9)
+        logger.info(f'元の結果を圧縮しました:{len(raw)}bytes -> {len(compressed)}bytes')
+        return {'retJsonZ':compressed}
+
+    if storage == 's3':
+        key = f'{RAW_LABELS_PREFIX}{game_id}/{image_id}.json'
+        try:
+            clients.s3().put_object(
+                Bucket=os.environ['PUT_BACKET'],
+                Key=key,
+                Body=gzip.compress(raw),
+                ContentType='application/json',
+                ContentEncoding='gzip',
+            )
+        except Exception as e:
+            logger.warning(f'元の結果をS3に保存できませんでした:{e}')
+            return {}
+        return {'retJsonKey':key}
+
+    return {}
+
+
+def decode_raw_labels(item):
+    """
+    wordテーブルのデータから、rekognitionの戻り値を復元する
+
+    引数  :  item       dict   wordテーブルのデータ
+    戻り値:  retrekog   dict   rekognitionの戻り値。保存されていない場合はNone
+    """
+    if item.get('retJsonZ') is not None:
+        data = item['retJsonZ']
+        data = getattr(data,'value',data) #boto3のBinary型の場合は中身を取り出す
+        return json.loads(zlib.decompress(bytes(data)))
+
+    if item.get('retJsonKey'):
+        res = clients.s3().get_object(Bucket=os.environ['PUT_BACKET'],Key=item['retJsonKey'])
+        return json.loads(gzip.decompress(res['Body'].read()))
+
+    #古いデータはそのまま保存されている(数値はDecimal)
+    return item.get('retJson')
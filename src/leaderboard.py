@@ -0,0 +1,154 @@
+#coding: UTF-8
+"""
+ゲームの経過(しりとりの単語の並び)・投稿者ごとの得点・優勝者を、ゲームの集約状態から求めるモジュール
+
+集約状態(gameテーブルのusedWords/posterCounts/posterLastIdsなど)はjudgeが判定のたびに更新しているので、
+wordテーブルを読み直さずに、/shiritori status(start)とゲームの終了(finish)で同じ結果を返せる。
+投稿者は表示名で表示する(<@ユーザーID>のメンションにすると、statusのたびに全員に通知が届くため)。
+"""
+import time
+from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
+
+from src import clients,slack_outbox
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+loghandler = StreamHandler()
+loghandler.setFormatter(Formatter("%(asctime)s %(name)s %(levelname)8s %(message)s"))
+logger.addHandler(loghandler)
+
+MAX_STATUS_WORDS = 20 # statusで表示する単語数(長い場合は最後のほうだけ表示する)
+
+
+def get_progress(state):
+    """
+    しりとりの結果リストを返す
+
+    引数  :  state           dict   ゲームの集約状態(Repository.get_game_stateの戻り値)
+    戻り値:  progress_list   list   しりとりが成立した単語(成立した順)
+    """
+    return list(state['usedWords'])
+
+
+def get_scores(state):
+    """
+    投稿者ごとのしりとり成功回数を、順位の順に返す
+    成功回数が同じ場合は、最後に成功したのが後の投稿者を上にする
+
+    引数  :  state    dict                ゲームの集約状態
+    戻り値:  scores   list<(str,int)>     (投稿者,成功回数)のリスト
+    """
+    last_ids = state.get('posterLastIds',{})
+    return sorted(
+        state['posterCounts'].items(),
+        key=lambda x:(x[1],last_ids.get(x[0],0)),
+        reverse=True,
+    )
+
+
+def get_winner(state):
+    """
+    しりとり成功回数がもっとも多いユーザーを返す
+
+    引数  :  state    dict   ゲームの集約状態
+    戻り値:  winner   str    勝利者。しりとりが成功した履歴が1件もない場合はNone
+    """
+    scores = get_scores(state)
+    if not scores:
+        logger.warning('しりとりが成功した履歴が1件もありませんでした')
+        return None
+
+    winner = scores[0][0]
+    logger.info(f'winner:{winner}')
+    return winner
+
+
+def get_display_name(user_id):
+    """
+    SlackAPI(users.profile.get)でユーザーの表示名を取得する(users.profile:readの権限が必要)
+
+    引数  :  user_id   str   SlackのユーザーID
+    戻り値:  name      str   表示名(display_nameが未登録の場合はreal_name)。取得できない場合はNone
+    """
+    user_profile = slack_outbox.call_slack(
+        'users.profile.get',
+        clients.slack_client().users_profile_get,
+        user=user_id,
+    )
+    logger.debug('user_proflie:'+str(user_profile))
+
+    if not user_profile.get('ok',None):
+        logger.error(f'ユーザー名の取得に失敗しました:{user_id}')
+        return None
+
+    #display_nameが未登録の場合はreal_nameを使う
+    return user_profile['profile']['display_name'] or user_profile['profile']['real_name']
+
+
+def get_display_names(user_ids):
+    """
+    ユーザーごとの表示名を返す(取得できないユーザーは含めない)
+
+    引数  :  user_ids   list<str>        SlackのユーザーID
+    戻り値:  names      dict<str,str>    ユーザーID→表示名
+    """
+    names = {}
+    for user_id in user_ids:
+        try:
+            name = get_display_name(user_id)
+        except Exception as e:
+            logger.warning(f'ユーザー名を取得できませんでした:{user_id}:{e}')
+            continue
+        if name:
+            names[user_id] = name
+    return names
+
+
+def format_remaining(end_unix_time,now=None):
+    """
+    締め切りまでの残り時間を表示用の文字列にする
+    """
+    remaining = int(end_unix_time - (now or time.time()))
+    if remaining <= 0:
+        return 'まもなく終了'
+    hours,rest = divmod(remaining,3600)
+    minutes = rest // 60
+    if hours:
+        return f'{hours}時間{minutes}分'
+    return f'{minutes}分'
+
+
+def format_status(game,state,now=None,names=None):
+    """
+    /shiritori statusで投稿するメッセージを作る
+
+    引数  :  game      dict        gameテーブルのデータ
+             state     dict        ゲームの集約状態
+             now       float       現在時刻(unixtime)。省略時はtime.time()
+             names     dict        ユーザーID→表示名(ない場合はユーザーIDをそのまま表示する。メンションにはしない)
+    戻り値:  lines     list<str>   メッセージ(1行ずつ)
+    """
+    names = names or {}
+    progress = get_progress(state)
+    if not progress:
+        chain = f"(まだありません。最初の文字は{game.get('firstChar','')})"
+    elif len(progress) > MAX_STATUS_WORDS:
+        chain = '...->' + '->'.join(progress[-MAX_STATUS_WORDS:])
+    else:
+        chain = '->'.join(progress)
+
+    lines = [
+        f'今のしりとりは、{chain}',
+        f"次の文字は{state['nextChar']}だよ！",
+    ]
+
+    if game.get('endUnixTime') is not None:
+        lines.append(f"締め切りまで、あと{format_remaining(int(game['endUnixTime']),now)}")
+
+    scores = get_scores(state)
+    if scores:
+        lines.append('得点:' + ' / '.join(f'{names.get(poster,poster)} {count}' for poster,count in scores))
+    else:
+        lines.append('得点:まだ誰もしりとりに成功していないよ')
+
+    return lines
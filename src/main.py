@@ -1,20 +1,15 @@
 #coding: UTF-8
 import os
-import slack
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
 from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
-import json
 import math
-import boto3
-import requests
-import codecs
 import time
 import traceback
-import hmac
 import hashlib
-import urllib
-from datetime import datetime
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from src import clients,ids,image_normalize,judge,slack_outbox,tracing
+from src.repository import Repository
 
 logger = getLogger(__name__)
 logger.setLevel(DEBUG)
@@ -25,170 +20,270 @@ logger.addHandler(loghandler)
 logger.info('処理を開始します')
 
 slack_api_token = os.environ['SLACK_API_TOKEN']
-client = slack.WebClient(token=os.environ['SLACK_API_TOKEN'])
-bot_client = slack.WebClient(token=os.environ['SLACK_BOT_API_TOKEN'])
-slack_signing_secret = os.environ['SLACK_SIGNING_SECRET']
-post_channel = os.environ['POST_CHANNEL']
-post_channel_id = os.environ['POST_CHANNEL_ID']
 put_bucket = os.environ['PUT_BACKET']
-time_stamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
-tmp_dir = '/tmp/' + time_stamp
 TWO_DAYS = 180000 # 若干余裕を持っている
+MAX_FILE_SIZE = 5000000 #5MB(AWS rekognitionの上限)
+STREAM_CHUNK_SIZE = 64 * 1024 #Slackからの読み込み単位
+inline_judge = os.environ.get('INLINE_JUDGE','false').lower() == 'true' #mainの中で判定する(S3はアーカイブのみ)
+archive_executor = ThreadPoolExecutor(max_workers=1) #インライン判定モードで、S3へのアーカイブを並行して行う
 
 logger.info('環境変数を設定しました')
 
 def handler(event, lambda_context):    
+    """
+    画像を受け付けて判定に回す
+    eventsがSlackのリクエストを検証・受付した後、{"body":<Events APIのリクエストbody>}で非同期に呼び出す
+    """
+    outbox = slack_outbox.Outbox(None) #投稿先は画像が投稿されたチャンネル(イベントから取得後に設定する)
+    tracing.start('main')
     try:
+        repo = Repository()
 
         logger.debug(f'event:{event}')
-        body = event['body']
-        logger.debug(f'event[body]:{body}')
-
-        #リクエストの検証
-        timestamp = event['headers']['X-Slack-Request-Timestamp']
-        if abs(math.floor(time.time()) - int(timestamp)) > 60 * 5:
-            logger.warning('reply attackの可能性があります')
-            logger.info('処理を終了します')
-            return
 
-        logger.debug(f'timestamp:{timestamp}')
+        #イベントの画像IDを取得
+        logger.debug('event[body][event]:'+str(event['body']['event']))
+        file_id = event['body']['event']['file_id']
+        event_channel_id = event['body']['event'].get('channel_id',None)
+        tracing.set_correlation_id(file_id)
 
-        body_str = str(body).replace(' ','').replace("'",'"')
-        sig_basestring = f'v0:{timestamp}:{body_str}'
+        #以降の処理は、互いに依存しない呼び出しを並行して実行する
+        clients.event_loop().run_until_complete(ingest(repo,outbox,file_id,event_channel_id))
 
-        logger.debug(f'sig_basestring:{sig_basestring}')
-        logger.debug(f'slack_signing_secret:{slack_signing_secret}')
-        my_signature = 'v0=' + hmac.new(slack_signing_secret.encode(),sig_basestring.encode(),hashlib.sha256).hexdigest()
+    except Exception:
+        message_error = f'エラーが発生しました:{traceback.format_exc()}'
+        logger.error('message_error')
+        outbox.post(message_error)
+        outbox.flush()
+        logger.error('処理を中止します')
+        exit(1)
 
-        slack_signature = event['headers']['X-Slack-Signature']
+    finally:
+        tracing.emit()
 
-        logger.debug(f'my_signature   :{my_signature}')
-        logger.debug(f'slack_signature:{slack_signature}')
 
-        if hmac.compare_digest(my_signature, slack_signature):
-            logger.info('リクエスト検証 OK')
-        else:
-            logger.error('リクエスト検証 NG')
-            logger.error('処理を中止します')
-            return
+async def ingest(repo,outbox,file_id,event_channel_id):
+    """
+    画像を受け付けて、判定(S3への投稿またはインライン判定)まで進める
+    互いに依存しない呼び出しは並行して実行し、チェックがNGになった時点で残りを待たずに終了する
+
+    param:     repo             Repository DBアクセス
+               outbox           Outbox     Slackへの投稿
+               file_id          str        (Slackの)ファイルID
+               event_channel_id str        file_sharedイベントのchannel_id(ない場合はNone)
+    return:    なし(失敗時は終了コード1で終了する)
+    """
+
+    logger.info('Function ingest')
 
-        #Slack APIのチャレンジ用
-        if isinstance(event['body'],str): #チャレンジの場合はbodyの要素はstr/それ以外はbodyの要素はdict
-            if json.loads(event['body']).get('type',None) == 'url_verification':
-
-                body_json = {
-                        'challenge':json.loads(event['body']).get('challenge'),
-                    }
-
-                logger.debug('body_json:'+str(body_json))
-                logger.debug('body_json:'+str(type(body_json)))
-
-                response = {
-                    "isBase64Encoded": False,
-                    "statusCode": 200,
-                    "headers": {},
-                    "body": json.dumps(body_json)
-                }
-
-                return response
-        
-        
-        #実行中のゲームがない場合は早期リターン
-        if not is_game_in_progress():
+    loop = asyncio.get_event_loop()
+
+    #画像が投稿されたチャンネルを取得(file_sharedイベントのchannel_idを使う)
+    files_info = None
+    if event_channel_id:
+        channel_id = event_channel_id
+    else:
+        #イベントにchannel_idがない場合のみ、files.infoの共有先チャンネルのうちゲーム中のチャンネルを使う
+        with tracing.span('find_channel'):
+            files_info = await get_files_info(file_id)
+            channel_id = find_game_channel(repo,get_file_channels(files_info))
+        if not channel_id:
             message_nogame = '実行中のゲームがありません'
             logger.info(message_nogame)
-            #bot_client.chat_postMessage(channel=post_channel, text=message_nogame)
             return
 
-        #受付メッセージを送信
-        logger.info('受付済みのmessageを投稿します')
-        message_accept = 'しりとり判定中です...しばらくお待ちください'
-        bot_client.chat_postMessage(channel=post_channel, text=message_accept)
-        message_accept_2 = '(他のチャンネルへの画像投稿を拾うことがありますが、自動で処理中断されます)'
-        bot_client.chat_postMessage(channel=post_channel, text=message_accept_2)
-        logger.info('受付済みのmessageを投稿しました')
+    logger.info(f'channel_id:{channel_id}')
+    outbox.channel = channel_id
 
-        #イベントの画像IDを取得
-        logger.debug('event[body][event]:'+str(event['body']['event']))
-        file_id = event['body']['event']['file_id']
+    #実行中のゲームの確認・files.infoを並行して行う
+    #処理済みの画像の確認(未処理の場合は処理済みとして登録)は、ゲーム中と分かってから行う
+    #(ゲームがないチャンネルの画像では、DynamoDBに何も書き込まない)
+    game = loop.run_in_executor(None,repo.is_game_in_progress,channel_id)
 
-        #処理済みの画像だった場合は早期リターン
-        if is_file_duplicated(file_id):
-            message_duplicated = 'すでに画像'+str(file_id)+'は処理済みです'
-            logger.info(message_duplicated)
+    async def claim_in_game():
+        if not await game:
+            return True #ゲームがない場合は'game'のチェックがNGになる
+        return await loop.run_in_executor(None,repo.claim_file,file_id,math.floor(time.time())+TWO_DAYS)
+
+    checks = {
+        'game':game,
+        'claim':claim_in_game(),
+    }
+    others = {}
+    if not files_info:
+        others['files_info'] = get_files_info(file_id)
+
+    with tracing.span('checks'):
+        failed,results = await run_until_check_fails(checks,others)
+
+    #実行中のゲームがない場合は早期リターン
+    if failed == 'game':
+        message_nogame = '実行中のゲームがありません'
+        logger.info(message_nogame)
+        #clients.slack_bot_client().chat_postMessage(channel=channel_id, text=message_nogame)
+        return
+
+    #処理済みの画像だった場合は早期リターン
+    if failed == 'claim':
+        message_duplicated = 'すでに画像'+str(file_id)+'は処理済みです'
+        logger.info(message_duplicated)
+        return
+
+    files_info = files_info or results['files_info']
+
+    #ファイルチェック
+    if not check_file(files_info,outbox):
+        outbox.flush()
+        logger.error('処理を中止します')
+        return
+
+    #ユーザー名と、パスを取得
+    poster = files_info['file']['user']
+    image_file_path = files_info['file']['url_private_download']
+    image_file_name = os.path.basename(image_file_path)
+
+    logger.debug('poster:' + poster)
+    logger.debug('image_file_path:' + image_file_path)
+    logger.debug('image_file_name:' + image_file_name)
+
+    #画像にIDを振る(実行ごとに新しいIDを発行する)
+    image_id = ids.new_id()
+    logger.debug('image_id' + str(image_id))
+
+    #受付メッセージ(仮メッセージ)の投稿と、画像のダウンロードを並行して行う
+    #判定結果はjudgeがこのメッセージを書き換えて投稿する
+    logger.info('受付済みのmessageを投稿します')
+    message_accept = 'しりとり判定中です...しばらくお待ちください'
+    placeholder = outbox.placeholder_async(message_accept)
+
+    #縮小しない場合は、画像をダウンロードせずにS3へストリーミングで転送する(imageテーブルへの登録後)
+    prefetch = inline_judge or image_normalize.is_available()
+    if prefetch:
+        #ダウンロードに失敗した場合も、エラーは受付メッセージを書き換えて投稿するので投稿の完了を待つ
+        results = await asyncio.gather(
+            placeholder,
+            loop.run_in_executor(None,download_image,image_file_path),
+            return_exceptions=True,
+        )
+        if isinstance(results[0],Exception):
+            raise results[0]
+        #縮小できない画像は、トレースバックではなく短いメッセージで知らせる
+        if isinstance(results[1],image_normalize.ImageNormalizeError):
+            logger.error(f'画像を縮小できませんでした:{results[1]}')
+            outbox.post(f'画像が大きすぎるため処理できません:{files_info["file"]["name"]}')
+            outbox.flush()
             return
+        if isinstance(results[1],Exception):
+            raise results[1]
+        image_bytes,extension,content_type = results[1]
+        #画像のハッシュ(judgeがRekognitionの結果のキャッシュを探すのに使う)は、imageテーブルに一緒に登録する
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+    else:
+        await placeholder
+        #ストリーミングで転送する場合は、S3が計算したSHA-256をjudgeが読む
+        image_hash = None
+    logger.info('受付済みのmessageを投稿しました')
+
+    #画像IDと送信者をDBに格納(S3への投稿でjudgeが起動する前に登録しておく)
+    with tracing.span('insert_image'):
+        inserted = insert_image_table(repo,image_id,channel_id,poster,file_id,outbox,image_hash)
+    if inserted:
+        logger.info('imageテーブルに登録しました')
+    else:
+        logger.error('imageテーブルへの登録に失敗しました')
+        exit(1)    
+
+    if inline_judge:
+        #S3イベント・judgeを経由せず、この場で判定する
+        with tracing.span('inline_judge'):
+            judged = inline_judge_image(repo,image_id,image_bytes,extension,content_type)
+        if not judged:
+            logger.error('画像の判定に失敗しました')
+            exit(1)
+
+        logger.info('処理を終了します.')
+        return
 
-        #files.infoを呼び出す
-        files_info = client.files_info(file=file_id)
-        logger.debug('files_info:' + str(files_info))
+    #S3に投稿するとjudgeが起動して判定する(imageテーブルは投稿後に更新しない)
+    if prefetch:
+        #縮小した画像をS3に投稿する
+        file_name_upload = judge.JUDGE_PREFIX + str(image_id) + extension
+        uploaded = upload_image_to_s3(image_bytes,put_bucket,file_name_upload,content_type)
+    else:
+        #画像をslackからS3へストリーミングで転送する(/tmpには保存しない)
+        file_name_upload = judge.JUDGE_PREFIX + str(image_id) + '.png'
+        uploaded = transfer_image_from_slack_to_s3(image_file_path,put_bucket,file_name_upload)
 
-        #ファイルチェック
-        if not check_file(files_info):
-            logger.error('処理を中止します')
-            return
+    if uploaded:
+        logger.info('S3に画像を投稿しました')
+    else:
+        logger.error('S3への画像の投稿に失敗しました')
+        exit(1)
 
-        #ユーザー名と、パスを取得
-        poster = files_info['file']['user']
-        image_file_path = files_info['file']['url_private_download']
-        image_file_name = os.path.basename(image_file_path)
+    #処理終了のログを出力
+    logger.info('処理を終了します.')
 
-        logger.debug('poster:' + poster)
-        logger.debug('image_file_path:' + image_file_path)
-        logger.debug('image_file_name:' + image_file_name)
 
-        #チャンネルが処理対象か否かを判定
-        if not channel_check(file_id):
-            message_other_channel='対象外チャンネルへの投稿のため処理を終了します'
-            logger.info(message_other_channel)
-            bot_client.chat_postMessage(channel=post_channel, text=message_other_channel)
-            return
+async def run_until_check_fails(checks,others):
+    """
+    checksとothersを並行して実行し、checksのどれかが偽を返した時点で残りを取り消す
 
-        #画像をslackから/tmpにダウンロードする
-        if download_image_from_slack(image_file_path,tmp_dir):
-            logger.info('画像の取得に成功しました')
-        else:
-            logger.error('画像の取得に失敗しました')
-            exit(1)
+    param:     checks     dict       名前→awaitable(真偽値を返すチェック)
+               others     dict       名前→awaitable(チェック以外の呼び出し)
+    return:    failed     str        偽を返したチェックの名前(すべてOKの場合はNone)
+               results    dict       名前→結果(終わったものだけ)
+    """
 
-        #画像にIDを振る マイクロ秒単位で同じでないとかぶらない。
-        image_id = int(time_stamp)
-        logger.debug('image_id' + str(image_id))
+    tasks = {asyncio.ensure_future(aw):name for name,aw in {**checks,**others}.items()}
+    pending = set(tasks)
+    results = {}
 
-        #S3に画像を投稿
-        file_path_local = tmp_dir + r'/' + image_file_name
-        file_name_upload = str(image_id) + '.png'
+    try:
+        while pending:
+            done,pending = await asyncio.wait(pending,return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = tasks[task]
+                results[name] = task.result()
+                if name in checks and not results[name]:
+                    logger.info(f'チェックがNGのため残りの処理を取り消します:{name}')
+                    return name,results
+        return None,results
+
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending,return_exceptions=True)
+
+
+async def get_files_info(file_id):
+    """
+    SlackAPI(files.info)でファイルの情報を取得する
 
-        if upload_image_to_s3(file_path_local,put_bucket,file_name_upload):
-            logger.info('S3に画像を投稿しました')
-        else:
-            logger.error('S3への画像の投稿に失敗しました')
-            exit(1)
-        
-        #画像IDと送信者をDBに格納
-        if insert_image_table(image_id,poster,file_id) :
-            logger.info('imageテーブルに登録しました')
-        else:
-            logger.error('imageテーブルへの登録に失敗しました')
-            exit(1)    
-
-        #処理終了のログを出力
-        logger.info('処理を終了します.')
+    param:     file_id    str       (Slackの)ファイルID
+    return:    files_info dict      SlackAPI(files_info)の戻り値
+    """
 
-    except Exception:
-        message_error = f'エラーが発生しました:{traceback.format_exc()}'
-        logger.error('message_error')
-        bot_client.chat_postMessage(channel=post_channel, text=message_error)
-        logger.error('処理を中止します')
-        exit(1)
+    files_info = await slack_outbox.call_slack_async(
+        'files.info',
+        clients.slack_async_client().files_info,
+        file=file_id,
+    )
+    logger.debug('files_info:' + str(files_info))
+    return files_info
 
 
-def insert_image_table(image_id,poster,file_id):
+def insert_image_table(repo,image_id,channel_id,poster,file_id,outbox,image_hash=None):
     """
     DynamoDBのimageテーブルにデータを挿入する
 
-    param:     image_id int       画像ID
+    param:     repo     Repository DBアクセス
+               image_id int       画像ID
+               channel_id str     画像が投稿されたチャンネルID
                poster   str       投稿者
                file_id int        (Slackの)ファイルID
+               outbox   Outbox    受付メッセージを投稿したOutbox(judgeが書き換えるメッセージ)
+               image_hash str     判定する画像のSHA-256(16進)。分からない場合はNone
     return:    ret      boolean   データ挿入成否
 
     """
@@ -198,9 +293,6 @@ def insert_image_table(image_id,poster,file_id):
     logger.info('poster:'+poster)
     logger.info('image_id:'+str(file_id))
 
-    dynamodb = boto3.resource('dynamodb')
-    image_table = dynamodb.Table('image')
-
     dt = datetime.now()
     current_time = math.floor(dt.timestamp())
 
@@ -208,12 +300,17 @@ def insert_image_table(image_id,poster,file_id):
         'imageId':image_id,
         'poster':poster,
         'fileId':file_id,
+        'channelId':channel_id,
+        'gameId':repo.get_game_id(channel_id),
+        'messageChannel':outbox.channel_id,
+        'messageTs':outbox.ts,
         'unixTime':int(current_time)+TWO_DAYS,
     }
+    if image_hash:
+        item['imageHash'] = image_hash
 
     try:
-        res = image_table.put_item(Item=item)
-        logger.info(res)
+        repo.insert_image(item)
     except Exception as e:
         logger.error(e)
         return False
@@ -221,164 +318,275 @@ def insert_image_table(image_id,poster,file_id):
     return True
 
 
-def upload_image_to_s3(file_name,bucket,object_name):
+class FileTooLargeError(Exception):
+    """
+    画像が上限サイズを超えた
     """
-    ファイルをS3にアップする
+    pass
 
-    param:    file_name  str       ファイル名
-              bucket     str       バケット名
-              object_name str      オブジェクト名
-    retern:   ret        boolean   データ挿入成否
 
+class CappedStream:
     """
-    logger.info('Function upload_image_to_s3')
-    logger.info('file_name:'+file_name)
-    logger.info('bucket:'+bucket)
-    logger.info('object_name:'+object_name)
+    HTTPレスポンスのbodyを読み込むファイルライクオブジェクト
+    読み込んだバイト数が上限を超えた時点でFileTooLargeErrorを送出し、転送を中断させる
+    読み込みながら内容のSHA-256も計算する
+    """
+
+    def __init__(self,raw,max_bytes):
+        self._raw = raw
+        self._max_bytes = max_bytes
+        self.bytes_read = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self,size=-1):
+        if size is None or size < 0:
+            size = self._max_bytes + 1 - self.bytes_read
+
+        #要求されたサイズ分をまとめて返すが、上限チェックは小さい単位で読むたびに行う
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = self._raw.read(min(remaining,STREAM_CHUNK_SIZE))
+            if not chunk:
+                break
+            self.bytes_read += len(chunk)
+            if self.bytes_read > self._max_bytes:
+                raise FileTooLargeError(f'画像が上限サイズを超えました:{self.bytes_read}bytes')
+            self.sha256.update(chunk)
+            chunks.append(chunk)
+            remaining -= len(chunk)
+
+        return b''.join(chunks)
+
+
+def open_slack_image(from_url,max_bytes):
+    """
+    Slackの画像のダウンロードを開始する(bodyはまだ読み込まない)
+
+    param: from_url     str          画像のダウンロード元
+           max_bytes    int          読み込みを許可する上限サイズ
+    return: response    Response     HTTPレスポンス(呼び出し側でcloseする)
+            stream      CappedStream bodyを読み込むストリーム
+    """
+
+    response = clients.http_session().get(
+            from_url,
+            allow_redirects = True,
+            headers = {'Authorization':f'Bearer {slack_api_token}'},
+            stream = True,
+            timeout = clients.HTTP_TIMEOUT
+    )
 
-    s3_client = boto3.client('s3')
     try:
-        s3_client.upload_file(file_name, bucket, object_name)
-    except Exception as e:
-        logger.error(f'画像をS3にアップロードできませんでした:{e}')
-        return False
-    return True
+        response.raise_for_status()
+
+        #Content-Lengthで上限を超えることが分かる場合は、読み込む前に中断する
+        content_length = int(response.headers.get('Content-Length',0))
+        if content_length > max_bytes:
+            raise FileTooLargeError(f'画像が上限サイズを超えています:{content_length}bytes')
 
+    except Exception:
+        response.close()
+        raise
+
+    response.raw.decode_content = True
+    return response,CappedStream(response.raw,max_bytes)
 
-def download_image_from_slack(from_url,to_path):
+
+def transfer_image_from_slack_to_s3(from_url,bucket,object_name):
     """
-    画像をSlackからダウンロードする
+    画像をSlackからダウンロードしながら、そのままS3にアップする
+    画像全体をメモリや/tmpに保持しない。上限サイズを超えた時点で転送を中断する
+    S3には画像のSHA-256のチェックサムも保存させる(judgeがRekognitionの結果のキャッシュを探すのに使う)
+
     param: from_url     str        画像のダウンロード元
-           to_path      str        画像のダウンロード先
-    return: image_content binary   画像
+           bucket       str        バケット名
+           object_name  str        オブジェクト名
+    return: image_hash  str        画像のSHA-256(16進)。転送失敗時はNone
     """
 
-    logger.info('Function download_image_from_slack')
+    logger.info('Function transfer_image_from_slack_to_s3')
     logger.info('from_url:'+from_url)
-    logger.info('to_path:'+to_path)
+    logger.info('bucket:'+bucket)
+    logger.info('object_name:'+object_name)
 
-    if not os.path.exists(to_path):
-        os.mkdir(to_path)
-    
-    image_content = None
+    response = None
     try:
-        image_content = requests.get(
-                from_url,
-                allow_redirects = True,
-                headers = {'Authorization':f'Bearer {slack_api_token}'},
-                stream = True
-        ).content
+        from boto3.s3.transfer import TransferConfig
+
+        #ダウンロードとアップロードは1つのストリームで同時に行うので、まとめて計測する
+        with tracing.span('slack_to_s3'):
+            response,image_stream = open_slack_image(from_url,MAX_FILE_SIZE)
+            clients.s3().upload_fileobj(
+                image_stream,
+                bucket,
+                object_name,
+                ExtraArgs={'Metadata':tracing.s3_metadata(),'ChecksumAlgorithm':'SHA256'},
+                Config=TransferConfig(use_threads=False),
+            )
+        logger.info(f'転送したバイト数:{image_stream.bytes_read}')
 
-        target_path = to_path + r'/' + os.path.basename(from_url)
+    except Exception as e:
+        logger.error(f'画像をS3にアップロードできませんでした:{e}')
+        return None
 
-        with codecs.open(target_path,mode='wb') as target:
-            target.write(image_content)
+    finally:
+        if response is not None:
+            response.close()
 
-    except Exception as e:
-        logger.error(f'画像の書き込みに失敗しました:{e}')
-        return False
+    return image_stream.sha256.hexdigest()
 
-    return True
 
-def channel_check(file_id):
+def download_image(from_url):
     """
-    ファイルが、対象チャンネルに投稿されているかかどうか判断する
-    param: file_id          str        ファイルID
-    return:isValid          boolean    対象チャンネル(True),対象外(False)
+    画像をSlackからメモリにダウンロードする(縮小できる場合は縮小する)
+
+    param: from_url      str        画像のダウンロード元
+    return: image_bytes  bytes      画像
+            extension    str        S3に保存する時の拡張子
+            content_type str        S3に保存する時のContent-Type
     """
 
-    logger.info('channel_check')
-    logger.info('file_id:'+file_id)
+    logger.info('Function download_image')
+    logger.info('from_url:'+from_url)
 
-    valid_channel = post_channel_id
-    logger.info('valid_channel:'+valid_channel)
+    normalize = image_normalize.is_available()
+    max_bytes = image_normalize.MAX_SOURCE_BYTES if normalize else MAX_FILE_SIZE
 
-    ts_from = round(time.time()) - 300 #5分間
-    logger.info('ts_from:'+str(ts_from))
+    with tracing.span('slack_download'):
+        response,image_stream = open_slack_image(from_url,max_bytes)
+        try:
+            image_bytes = image_stream.read()
+        finally:
+            response.close()
+    logger.info(f'ダウンロードしたバイト数:{image_stream.bytes_read}')
 
-    for i in range(6):
-    
-        logger.info(f'files_listループ{i+1}回目')
-        #対象チャンネルに投稿されているファイル一覧を取得(5分前まで遡る)
-        files_list = client.files_list(channel=valid_channel,ts_from=ts_from)
-        logger.debug('files_list:'+str(files_list))
+    if not normalize:
+        return image_bytes,'.png','image/png'
 
+    with tracing.span('normalize_image'):
         try:
-            for f in files_list.get('files'):
-                if f['id'] == file_id:
-                    logger.info('対象チャンネルの投稿です')
-                    return True
-        except Exception as e:
-            logger.warning(f'files_listにchannnelのidがありません:[files_info]{files_list}:[エラーメッセージ]:{e}')
-            return False
-        
-        time.sleep(10) #投稿したファイルがfiles.listで読み出せるようになるまでにラグがあるので待つ。
-
-    return False
-    
-    
-def is_game_in_progress():
-    """
-    実行中のゲームがあるか調べる
-    
-    引数    :  なし
-    戻り値  :  isGame boolean 実行中のゲームがある(True)か、ない(False)か。
+            normalized = image_normalize.normalize_image(image_bytes)
+        except image_normalize.ImageTooLargeError as e:
+            #展開すると大きすぎる画像も、Rekognitionの上限以下であれば元画像のまま判定する
+            if len(image_bytes) > MAX_FILE_SIZE:
+                raise
+            logger.warning(f'縮小せずに元画像のまま判定します:{e}')
+            return image_bytes,'.png','image/png'
+    return normalized,image_normalize.EXTENSION,image_normalize.CONTENT_TYPE
+
+
+def upload_image_to_s3(image_bytes,bucket,object_name,content_type):
     """
+    メモリ上の画像をS3にアップする
 
-    logger.info('Function is_game_in_progress')
+    param: image_bytes  bytes      画像
+           bucket       str        バケット名
+           object_name  str        オブジェクト名
+           content_type str        Content-Type
+    return: ret         boolean    アップロード成否
+    """
 
-    dynamodb = boto3.resource('dynamodb')
-    game_table = dynamodb.Table('game')
+    logger.info('Function upload_image_to_s3')
+    logger.info('bucket:'+bucket)
+    logger.info('object_name:'+object_name)
 
     try:
-        res = game_table.scan()
-        logger.info(res)
+        with tracing.span('s3_upload'):
+            clients.s3().put_object(
+                Bucket=bucket,
+                Key=object_name,
+                Body=image_bytes,
+                ContentType=content_type,
+                Metadata=tracing.s3_metadata(),
+            )
+        logger.info(f'アップロードしたバイト数:{len(image_bytes)}')
 
     except Exception as e:
-        logger.warning(f'gameテーブルへの接続に失敗しました:{e}')
-        raise e
-
-    for item in res.get('Items'):
-        if not item.get('isEnded'):
-            logger.debug('実行中のゲームがあります')
-            return True
+        logger.error(f'画像をS3にアップロードできませんでした:{e}')
+        return False
 
-    logger.debug('実行中のゲームはありません')
-    return False
+    return True
 
 
-def is_file_duplicated(file_id):
+def inline_judge_image(repo,image_id,image_bytes,extension,content_type):
     """
-    Slackのfile_idが投稿済みでないか調べる(多重実行防止)
-    
-    引数　  :  file_id          str        ファイルID
-    戻り値  :  ret              boolean    投稿済み(true),未投稿(false)
+    Slackから取得した画像を、S3を経由せずにその場で判定する(インライン判定モード)
+    S3への保存(アーカイブ)は判定と並行して行い、判定結果の投稿を待たせない
+
+    param: repo         Repository DBアクセス
+           image_id     int        画像ID
+           image_bytes  bytes      画像
+           extension    str        S3に保存する時の拡張子
+           content_type str        S3に保存する時のContent-Type
+    return: ret         boolean    処理成否
     """
 
-    logger.info('Function is_file_duplicated')
-    logger.info('file_id:'+str(file_id))
+    logger.info('Function inline_judge_image')
+    logger.info('image_id:'+str(image_id))
 
-    dynamodb = boto3.resource('dynamodb')
-    image_table = dynamodb.Table('image')
+    #画像のハッシュはimageテーブルに登録済み
+    image = repo.get_image(image_id)
+
+    #アーカイブ先はjudgeのS3イベントの対象外(judge.ARCHIVE_PREFIX)
+    archive = archive_executor.submit(
+        upload_image_to_s3,
+        image_bytes,
+        put_bucket,
+        judge.ARCHIVE_PREFIX + str(image_id) + extension,
+        content_type,
+    )
 
     try:
-        res = image_table.scan()
-        logger.info(res)
+        judge.judge_image(repo,image,{'Bytes':image_bytes})
+    finally:
+        #Lambdaは戻ると停止するので、アーカイブの完了は待つ(判定結果の投稿後)
+        if not archive.result():
+            logger.warning('画像のアーカイブに失敗しました')
 
-    except Exception as e:
-        logger.error(f'imageテーブルへの接続に失敗しました:{e}')
-        raise e
+    return True
 
-    for item in res.get('Items'):
-        if item.get('fileId') == file_id:
-            logger.warning('この画像は処理済みです')
-            return True
+def find_game_channel(repo,channel_ids):
+    """
+    ファイルが共有されているチャンネルのうち、実行中のゲームがあるチャンネルを返す
+    param: repo             Repository DBアクセス
+           channel_ids      list<str>  ファイルが共有されているチャンネルID
+    return:channel_id       str        ゲーム中のチャンネルID(ない場合はNone)
+    """
 
+    logger.info('find_game_channel')
+    logger.info(f'channel_ids:{channel_ids}')
 
-    logger.info('画像は未処理です')
-    return False
-    
+    for channel_id in sorted(channel_ids):
+        if repo.is_game_in_progress(channel_id):
+            logger.info(f'ゲーム中のチャンネルの投稿です:{channel_id}')
+            return channel_id
+
+    logger.info('ゲーム中のチャンネルの投稿ではありません')
+    return None
+
+
+def get_file_channels(files_info):
+    """
+    files.infoの戻り値から、ファイルが共有されているチャンネルIDを取得する
+    param: files_info       dict       SlackAPI(files_info)の戻り値
+    return:channel_ids      list<str>  チャンネルID
+    """
+
+    logger.info('get_file_channels')
+
+    file = files_info.get('file',{})
+    channel_ids = set(file.get('channels',[]))
+    channel_ids.update(file.get('groups',[]))
+
+    shares = file.get('shares',{})
+    for share_type in ('public','private'):
+        channel_ids.update(shares.get(share_type,{}).keys())
 
+    logger.info(f'channel_ids:{channel_ids}')
+    return list(channel_ids)
+    
+    
 def check_file_suffix(file_name):
     """
     ファイル名の拡張子チェック
@@ -420,7 +628,11 @@ def check_file_size(files_info):
     file_size = files_info['file']['size']
     logger.info(f'file_size:{file_size}')
 
-    max_size = 5000000 #5MB(AWS rekognitionの上限)
+    #縮小できる場合は、Rekognitionの上限より大きい画像も受け付ける
+    if image_normalize.is_available():
+        max_size = image_normalize.MAX_SOURCE_BYTES
+    else:
+        max_size = MAX_FILE_SIZE
 
     if file_size <= max_size:
         logger.info('End Function check_file_size')
@@ -430,11 +642,12 @@ def check_file_size(files_info):
         return False
 
 
-def check_file(files_info):
+def check_file(files_info,outbox):
     """
-    ファイルのチェック処理
+    ファイルのチェック処理(NGの理由はoutboxにためる)
     
     引数　  :  files_info       dict       SlackAPI(files_info)の戻り値
+               outbox           Outbox     Slackへの投稿
     戻り値  :  ret              boolean    チェックOK(true),NG(false)
     """
 
@@ -448,14 +661,14 @@ def check_file(files_info):
     if not check_file_size(files_info):
         message_exceeded = f'ファイルサイズが大きすぎます:{file_name}'
         logger.error(message_exceeded)
-        bot_client.chat_postMessage(channel=post_channel, text=message_exceeded)
+        outbox.post(message_exceeded)
         return False
     
     #ファイル拡張子チェック
     if not check_file_suffix(file_name):
         message_suffix_invalid = f'拡張子が.png/.jpg/.jpeg以外の画像は処理できません:{file_name}'
         logger.error(message_suffix_invalid)
-        bot_client.chat_postMessage(channel=post_channel, text=message_suffix_invalid)
+        outbox.post(message_suffix_invalid)
         return False
     
     #files_info['file']['url_private_download']のキー存在チェック
@@ -465,7 +678,7 @@ def check_file(files_info):
         #files_info['file']['url_private_download']のキーが存在しない場合→ダウンロードできない
         message_nokey = f'画像を処理できませんでした:{file_name}'
         logger.error(message_nokey)
-        bot_client.chat_postMessage(channel=post_channel, text=message_nokey)
+        outbox.post(message_nokey)
         return False
     
     logger.info('ファイルチェックOK')
@@ -0,0 +1,570 @@
+#coding: UTF-8
+"""
+DynamoDB(game/word/image/idempotencyテーブル)へのアクセスをまとめたモジュール
+
+main/start/judge/finishの各ハンドラーから共通で使う。
+Repositoryは1回の実行(invocation)ごとに生成し、読み込んだテーブルの内容をメモ化するので、
+同じ実行の中で何度呼び出してもDynamoDBへのアクセスは1回で済む。
+ゲームはSlackのチャンネルごとに独立しており、チャンネルの最新のゲームはGSIを1件queryするだけで取得できる
+(実行中のゲームの数が増えても遅くならない)。
+"""
+from src import clients
+from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+loghandler = StreamHandler()
+loghandler.setFormatter(Formatter("%(asctime)s %(name)s %(levelname)8s %(message)s"))
+logger.addHandler(loghandler)
+
+GAME_TABLE = 'game'
+GAME_CHANNEL_INDEX = 'channelId-id-index' # gameテーブルのGSI(パーティションキー:channelId/ソートキー:id。キーとisEndedだけを持つ)
+WORD_TABLE = 'gameWord' # パーティションキー:gameId/ソートキー:id
+IMAGE_TABLE = 'image'
+IDEMPOTENCY_TABLE = 'idempotency' # 多重実行防止用(ハッシュキー:id。file:<file_id>/event:<event_id>)
+
+
+class Repository:
+    """
+    game/word/imageテーブルの読み書きを行う。読み込み結果は実行中メモ化する。
+    """
+
+    def __init__(self):
+        self._games = None
+        self._channel_games = {}
+        self._words = {}
+        self._images = {}
+
+    def _table(self,name):
+        return clients.table(name)
+
+    def get_games(self):
+        """
+        gameテーブルのデータを取得(実行中1回だけscanする)
+        全チャンネルのゲームを読み込むので、終了処理(finish)以外では使わない
+
+        引数    :  なし
+        戻り値  :  games    list<dict>  gameテーブルのデータ
+        """
+        if self._games is not None:
+            return self._games
+
+        logger.info('Function get_games')
+
+        game_table = self._table(GAME_TABLE)
+        games = []
+        scan_args = {}
+
+        try:
+            while True:
+                res = game_table.scan(**scan_args)
+                logger.debug(f'game_res:{res}')
+                games.extend(res.get('Items'))
+
+                last_key = res.get('LastEvaluatedKey')
+                if not last_key:
+                    break
+                scan_args['ExclusiveStartKey'] = last_key
+
+        except Exception as e:
+            logger.warning(f'gameテーブルへの接続に失敗しました:{type(e)}:{e.args}')
+            raise e
+
+        self._games = games
+        return games
+
+    def get_latest_game(self,channel_id):
+        """
+        チャンネルの最新のゲームを取得(チャンネルごとに実行中1回だけqueryする)
+        インデックスにはid/channelId/isEndedしかないので、それ以外の項目はget_gameで読む
+
+        引数    :  channel_id   str    SlackのチャンネルID
+        戻り値  :  game         dict   gameテーブルのデータ(id/channelId/isEnded)。ゲームがない場合はNone
+        """
+        if channel_id in self._channel_games:
+            return self._channel_games[channel_id]
+
+        logger.info('Function get_latest_game')
+        logger.info(f'channel_id:{channel_id}')
+
+        from boto3.dynamodb.conditions import Key
+
+        try:
+            res = self._table(GAME_TABLE).query(
+                IndexName=GAME_CHANNEL_INDEX,
+                KeyConditionExpression=Key('channelId').eq(channel_id),
+                ScanIndexForward=False, #idは時刻順なので、降順の1件目が最新のゲーム
+                Limit=1,
+            )
+            logger.debug(f'game_res:{res}')
+
+        except Exception as e:
+            logger.warning(f'gameテーブルへの接続に失敗しました:{type(e)}:{e.args}')
+            raise e
+
+        items = res.get('Items')
+        game = items[0] if items else None
+        self._channel_games[channel_id] = game
+        return game
+
+    def is_game_in_progress(self,channel_id):
+        """
+        チャンネルに実行中のゲームがあるか調べる
+
+        引数    :  channel_id   str    SlackのチャンネルID
+        戻り値  :  isGame boolean 実行中のゲームがある(True)か、ない(False)か。
+        """
+        logger.info('Function is_game_in_progress')
+
+        game = self.get_latest_game(channel_id)
+        if game and not game.get('isEnded'):
+            logger.info('実行中のゲームがあります')
+            return True
+
+        logger.info('実行中のゲームはありません')
+        return False
+
+    def get_game_id(self,channel_id):
+        """
+        チャンネルの最新のgame_idを取得
+
+        引数    :  channel_id   str    SlackのチャンネルID
+        戻り値  :  game_id    int  最新のgame_id(ゲームがない場合は0)
+        """
+        logger.info('Function get_game_id')
+
+        game = self.get_latest_game(channel_id)
+        if not game:
+            return 0
+        return game.get('id')
+
+    def get_game(self,game_id):
+        """
+        gameテーブルからゲームを1件取得(強い整合性で読み込む。メモ化しない)
+
+        引数    :  game_id    int   ゲームID
+        戻り値  :  game       dict  gameテーブルのデータ。存在しない場合はNone
+        """
+        logger.info('Function get_game')
+        logger.info(f'game_id:{game_id}')
+
+        res = self._table(GAME_TABLE).get_item(Key={'id': int(game_id)},ConsistentRead=True)
+        logger.debug(res)
+
+        return res.get('Item')
+
+    def get_game_state(self,game):
+        """
+        ゲームの集約状態(次の文字・最後のword_id・既出単語・投稿者ごとの成功数)を返す
+        集約状態を持たない古いゲームの場合は、wordテーブルから組み立てる
+
+        引数    :  game     dict   gameテーブルのデータ
+        戻り値  :  state    dict   集約状態
+                            nextChar     str        しりとり成立する文字
+                            lastWordId   int        最後のword_id(isValid=falseも含む)
+                            lastValidId  int        しりとりが成立した最後のword_id
+                            usedWords    list<str>  しりとりが成立した単語
+                            posterCounts dict       投稿者ごとのしりとり成功回数
+                            posterLastIds dict      投稿者ごとのしりとりが成立した最後のword_id(同数の場合の順位に使う)
+                            version      int        楽観ロック用のバージョン(集約状態がない場合は0)
+        """
+        logger.info('Function get_game_state')
+
+        if 'version' in game:
+            return {
+                'nextChar':game.get('nextChar',''),
+                'lastWordId':int(game.get('lastWordId',0)),
+                'lastValidId':int(game.get('lastValidId',0)),
+                'usedWords':list(game.get('usedWords',[])),
+                'posterCounts':{k:int(v) for k,v in game.get('posterCounts',{}).items()},
+                'posterLastIds':{k:int(v) for k,v in game.get('posterLastIds',{}).items()},
+                'version':int(game['version']),
+            }
+
+        game_id = game['id']
+        used_words = []
+        poster_counts = {}
+        poster_last_ids = {}
+        for w in self.get_words(game_id):
+            if w.get('isValid') and w.get('word'):
+                used_words.append(w['word'])
+            if w.get('isValid') and w.get('poster'):
+                poster_counts[w['poster']] = poster_counts.get(w['poster'],0) + 1
+                poster_last_ids[w['poster']] = max(poster_last_ids.get(w['poster'],0),int(w['id']))
+
+        return {
+            'nextChar':self.get_next_char(game_id),
+            'lastWordId':int(self.get_word_id(game_id)),
+            'lastValidId':int(self.get_valid_word_id(game_id)),
+            'usedWords':used_words,
+            'posterCounts':poster_counts,
+            'posterLastIds':poster_last_ids,
+            'version':0,
+        }
+
+    def commit_word(self,game_id,state,word):
+        """
+        判定した単語をwordテーブルに挿入し、ゲームの集約状態に反映する(1つのトランザクションで書き込む)
+        読み込んだ時点からバージョンが変わっておらず、ゲームが終了していない場合のみ書き込む(条件付き更新)
+        既出単語・投稿者ごとの成功数は追加分だけを書き込み、集約状態全体は書き直さない
+        (集約状態が、wordテーブルにない単語を指すことはない)
+
+        引数    :  game_id   int      ゲームID
+                   state     dict     判定後の集約状態(versionは読み込んだ時点の値。集約状態を持たない古いゲームの場合のみ全体を書き込む)
+                   word      dict     wordテーブルに挿入するデータ
+        戻り値  :  ret       boolean  書き込み成功(True),他の実行が先に更新したかゲームが終了していた(False)
+        """
+        logger.info('Function commit_word')
+        logger.info(f'game_id:{game_id}')
+        logger.info(f'word:{word}')
+
+        version = state['version']
+        names = {'#ver':'version'}
+        values = {':lw':word['id'],':nv':version + 1,':false':False}
+
+        if not version:
+            #wordテーブルから組み立てた状態を、最初の1回だけまとめて書き込む
+            values.update({
+                ':nc':state['nextChar'],
+                ':lv':state['lastValidId'],
+                ':uw':state['usedWords'],
+                ':pc':state['posterCounts'],
+                ':pl':state['posterLastIds'],
+            })
+            update = 'set nextChar=:nc, lastWordId=:lw, lastValidId=:lv, usedWords=:uw, posterCounts=:pc, posterLastIds=:pl, #ver=:nv'
+            condition = 'attribute_not_exists(#ver) AND isEnded = :false'
+
+        elif word['isValid']:
+            names['#u'] = word['poster']
+            values.update({
+                ':nc':word['nextChar'],
+                ':w':[word['word']],
+                ':one':1,
+                ':v':version,
+            })
+            update = ('set nextChar=:nc, lastWordId=:lw, lastValidId=:lw, usedWords=list_append(usedWords,:w), '
+                      'posterLastIds.#u=:lw, #ver=:nv add posterCounts.#u :one')
+            condition = '#ver = :v AND isEnded = :false'
+
+        else:
+            values[':v'] = version
+            update = 'set lastWordId=:lw, #ver=:nv'
+            condition = '#ver = :v AND isEnded = :false'
+
+        from botocore.exceptions import ClientError
+
+        try:
+            #リソースのクライアントは、Tableと同じようにPythonの値をそのまま渡せる
+            res = clients.dynamodb().meta.client.transact_write_items(
+                TransactItems=[
+                    {
+                        'Put':{
+                            'TableName':WORD_TABLE,
+                            'Item':word,
+                            'ConditionExpression':'attribute_not_exists(id)',
+                        },
+                    },
+                    {
+                        'Update':{
+                            'TableName':GAME_TABLE,
+                            'Key':{'id':int(game_id)},
+                            'UpdateExpression':update,
+                            'ConditionExpression':condition,
+                            'ExpressionAttributeNames':names,
+                            'ExpressionAttributeValues':values,
+                        },
+                    },
+                ],
+            )
+            logger.debug(res)
+
+        except ClientError as e:
+            reasons = [r.get('Code') for r in e.response.get('CancellationReasons',[])]
+            if e.response['Error']['Code'] == 'TransactionCanceledException' and 'ConditionalCheckFailed' in reasons:
+                logger.warning('他の実行が先にゲームの状態を更新したか、ゲームが終了しました')
+                return False
+            raise e
+
+        game_id = int(game_id)
+        if game_id in self._words:
+            self._words[game_id].append(word)
+        return True
+
+    def get_words(self,game_id):
+        """
+        wordテーブルのデータを取得(gameIdをパーティションキーとしてqueryする。ゲームごとに実行中1回だけ)
+
+        引数  :  game_id    int         ゲームID
+        戻り値:  words     list<dict>  wordテーブルのデータ(id昇順)
+        """
+        game_id = int(game_id)
+        if game_id in self._words:
+            return self._words[game_id]
+
+        logger.info('Function get_words')
+        logger.info(f'game_id:{game_id}')
+
+        from boto3.dynamodb.conditions import Key
+
+        word_table = self._table(WORD_TABLE)
+
+        words = []
+        query_args = {'KeyConditionExpression':Key('gameId').eq(game_id)}
+        while True:
+            word_res = word_table.query(**query_args)
+            logger.debug(f'word_res:{word_res}')
+            words.extend(word_res.get('Items'))
+
+            #1MBを超える場合は続きをページングで取得する
+            last_key = word_res.get('LastEvaluatedKey')
+            if not last_key:
+                break
+            query_args['ExclusiveStartKey'] = last_key
+
+        self._words[game_id] = words
+        return words
+
+    def get_word_id(self,game_id):
+        """
+        最新のword_idを取得(isValid=falseも含む)
+
+        引数  :  game_id    int  ゲームID
+        戻り値:  word_id    int  現時点での最後のword_id
+        """
+        logger.info('Function get_word_id')
+
+        word_id = 0
+        for item in self.get_words(game_id):
+            if word_id < item.get('id'):
+                word_id = item.get('id')
+
+        return word_id
+
+    def get_valid_word_id(self,game_id):
+        """
+        しりとりが成立した最新のword_idを取得
+
+        引数  :  game_id    int  ゲームID
+        戻り値:  word_id    int  現時点での最後のword_id
+        """
+        logger.info('Function get_valid_word_id')
+
+        word_id = 0
+        for item in self.get_words(game_id):
+            if item.get('isValid') and word_id < item.get('id'):
+                word_id = item.get('id')
+
+        return word_id
+
+    def get_next_char(self,game_id):
+        """
+        現時点での最後の文字を取得
+
+        引数  :  game_id    int  ゲームID
+        戻り値:  next_char  str  しりとり成立する文字
+        """
+        logger.info('Function get_next_char')
+
+        max_word_id = 0
+        next_char = ''
+
+        for wr in self.get_words(game_id):
+            if max_word_id < wr.get('id') and wr.get('isValid'):
+                max_word_id = wr.get('id')
+                next_char = wr.get('nextChar').upper()
+
+        return next_char
+
+    def insert_word(self,item):
+        """
+        wordテーブルにデータを挿入する(メモ化済みのデータにも反映する)
+
+        引数:   item     dict     挿入するデータ
+        戻り値: なし(失敗時は例外)
+        """
+        logger.info('Function insert_word')
+        logger.info(f'item:{item}')
+
+        res = self._table(WORD_TABLE).put_item(Item=item)
+        logger.debug(res)
+
+        game_id = int(item['gameId'])
+        if game_id in self._words:
+            self._words[game_id].append(item)
+
+    def insert_game(self,item):
+        """
+        gameテーブルにデータを挿入する(メモ化済みのデータにも反映する)
+        同じidのゲームがすでにある場合は上書きせずに例外とする
+
+        引数:   item     dict     挿入するデータ
+        戻り値: なし(失敗時は例外)
+        """
+        logger.info('Function insert_game')
+        logger.info(f'item:{item}')
+
+        res = self._table(GAME_TABLE).put_item(Item=item,ConditionExpression='attribute_not_exists(id)')
+        logger.debug(res)
+
+        if self._games is not None:
+            self._games.append(item)
+        if item.get('channelId'):
+            self._channel_games[item['channelId']] = item
+
+    def end_game(self,game_id):
+        """
+        gameテーブルの実行中フラグを更新する(ゲームを終了にする)
+
+        引数:   game_id    int      ゲームID
+        戻り値: なし(失敗時は例外)
+        """
+        logger.info('Function end_game')
+        logger.info(f'game_id:{game_id}')
+
+        response = self._table(GAME_TABLE).update_item(
+            Key={
+                'id': game_id
+            },
+            UpdateExpression="set isEnded=:e",
+            ExpressionAttributeValues={
+                ':e': True
+            },
+            ReturnValues="ALL_NEW"
+        )
+        logger.debug('gameテーブル更新結果:'+str(response))
+
+        if self._games is not None:
+            for item in self._games:
+                if item.get('id') == game_id:
+                    item['isEnded'] = True
+        for item in self._channel_games.values():
+            if item and item.get('id') == game_id:
+                item['isEnded'] = True
+
+    def get_image(self,image_id):
+        """
+        imageテーブルのデータを取得(画像ごとに実行中1回だけ)
+
+        引数:   image_id    int     画像ID
+        戻り値: item        dict    imageテーブルのデータ。存在しない場合はNone
+        """
+        if image_id in self._images:
+            return self._images[image_id]
+
+        logger.info('Function get_image')
+        logger.info(f'image_id:{image_id}')
+
+        res = self._table(IMAGE_TABLE).get_item(Key={'imageId': image_id},ConsistentRead=True)
+        logger.debug(res)
+
+        item = res.get('Item')
+        self._images[image_id] = item
+        return item
+
+    def get_poster(self,image_id):
+        """
+        画像のIDから、投稿者を返す
+
+        引数:   image_id    int    画像ID
+        戻り値: poster     str    投稿者名 テーブルに存在しない場合は、'default_user'を返す
+        """
+        logger.info('Function get_poster')
+
+        try:
+            poster = self.get_image(image_id).get('poster','default_user')
+        except Exception as e:
+            logger.warning(f'imageテーブルからユーザーを取得できませんでした:{e}')
+            return 'default_user'
+
+        return poster
+
+    def insert_image(self,item):
+        """
+        imageテーブルにデータを挿入する
+        同じimageIdの画像がすでにある場合は上書きせずに例外とする
+
+        引数:   item     dict     挿入するデータ
+        戻り値: なし(失敗時は例外)
+        """
+        logger.info('Function insert_image')
+        logger.info(f'item:{item}')
+
+        res = self._table(IMAGE_TABLE).put_item(Item=item,ConditionExpression='attribute_not_exists(imageId)')
+        logger.debug(res)
+
+        self._images[item['imageId']] = item
+
+    def claim_file(self,file_id,expire_time):
+        """
+        Slackのfile_idを処理済みとして登録する(多重実行防止)
+        条件付き書き込みなので、同時に同じfile_idが届いても登録できるのは1回だけ
+
+        引数　  :  file_id          str        ファイルID
+                   expire_time      int        登録を消す時刻(unixtime)
+        戻り値  :  ret              boolean    登録できた(true),処理済み(false)
+        """
+        logger.info('Function claim_file')
+        logger.info(f'file_id:{file_id}')
+
+        if not self._claim(f'file:{file_id}',expire_time):
+            logger.warning('この画像は処理済みです')
+            return False
+
+        logger.info('画像は未処理です')
+        return True
+
+    def claim_event(self,event_id,expire_time):
+        """
+        SlackのEvents APIのevent_idを受付済みとして登録する(再送されたイベントの多重実行防止)
+
+        引数　  :  event_id         str        イベントID
+                   expire_time      int        登録を消す時刻(unixtime)
+        戻り値  :  ret              boolean    登録できた(true),受付済み(false)
+        """
+        logger.info('Function claim_event')
+        logger.info(f'event_id:{event_id}')
+
+        if not self._claim(f'event:{event_id}',expire_time):
+            logger.warning('このイベントは受付済みです')
+            return False
+
+        return True
+
+    def release_event(self,event_id):
+        """
+        claim_eventの登録を消す(受付に失敗して、Slackに再送してもらう場合)
+
+        引数　  :  event_id         str        イベントID
+        """
+        logger.info('Function release_event')
+        self._table(IDEMPOTENCY_TABLE).delete_item(Key={'id':f'event:{event_id}'})
+
+    def _claim(self,key,expire_time):
+        """
+        idempotencyテーブルにキーを条件付きで登録する
+
+        引数　  :  key              str        キー(種類:ID)
+                   expire_time      int        登録を消す時刻(unixtime)
+        戻り値  :  ret              boolean    登録できた(true),登録済み(false)
+        """
+        item = {
+            'id':key,
+            'unixTime':int(expire_time),
+        }
+
+        from botocore.exceptions import ClientError
+
+        try:
+            res = self._table(IDEMPOTENCY_TABLE).put_item(
+                Item=item,
+                ConditionExpression='attribute_not_exists(id)',
+            )
+            logger.debug(res)
+
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            logger.error(f'idempotencyテーブルへの接続に失敗しました:{e}')
+            raise e
+
+        return True
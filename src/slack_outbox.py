@@ -0,0 +1,274 @@
+#coding: UTF-8
+"""
+Slackへの投稿をまとめて行うモジュール
+
+  - 1回の実行の中で出たメッセージは、Outboxにためて1つのBlock Kitの投稿にまとめる
+  - 「判定中」の仮メッセージを投稿しておき、結果はchat.updateで書き換える(新しく投稿しない)
+  - メソッドごとのレート制限(Tier)に合わせてトークンバケットで間隔を空ける
+  - 429(rate_limited)が返った場合は、Retry-Afterの秒数だけ待って再送する
+
+トークンバケットはコンテナごとなので、同時に動いている別コンテナとは共有しない。
+chat.postMessageはチャンネルごとの制限なので、チャンネルごとにトークンバケットを分ける。
+"""
+import asyncio
+import threading
+import time
+from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
+
+from src import clients,tracing
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+loghandler = StreamHandler()
+loghandler.setFormatter(Formatter("%(asctime)s %(name)s %(levelname)8s %(message)s"))
+logger.addHandler(loghandler)
+
+#メソッドごとのレート制限 (1秒あたりの回数, バースト)
+#https://api.slack.com/docs/rate-limits
+METHOD_RATES = {
+    'chat.postMessage':(1.0,3), # 1チャンネルあたり1回/秒(短いバーストは許容)
+    'chat.update':(50 / 60,5), # Tier3
+    'files.info':(100 / 60,10), # Tier4
+    'users.profile.get':(100 / 60,10), # Tier4
+}
+DEFAULT_RATE = (20 / 60,3) # Tier2
+PER_CHANNEL_METHODS = ('chat.postMessage',) # チャンネルごとに制限されるメソッド
+MAX_RETRY = 3
+DEFAULT_RETRY_AFTER = 1
+MAX_BLOCK_TEXT = 3000 # sectionブロックのテキスト上限
+
+
+class TokenBucket:
+    """
+    トークンバケット(rate回/秒、最大burst回まで連続で実行できる)
+    """
+
+    def __init__(self,rate,burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        トークンを1つ取得する。足りない場合は貯まるまで待つ
+
+        戻り値: waited    float   待った秒数
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self):
+        """
+        acquire()の非同期版(待つ間はイベントループの他の処理を進める)
+        """
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def reserve(self):
+        """
+        トークンを1つ予約し、使えるようになるまでの秒数を返す(待つのは呼び出し側)
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            wait = 0.0
+            if self._tokens < 1:
+                wait = (1 - self._tokens) / self.rate
+            self._tokens -= 1
+
+        if wait > 0:
+            logger.info(f'レート制限のため{wait:.2f}秒待ちます')
+        return wait
+
+    def penalize(self,seconds):
+        """
+        Retry-Afterを受け取った場合に、次のトークンがその秒数後まで貯まらないようにする
+        """
+        with self._lock:
+            self._tokens = min(self._tokens,1 - seconds * self.rate)
+            self._updated = time.monotonic()
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _bucket(method,channel=None):
+    key = (method,channel if method in PER_CHANNEL_METHODS else None)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            rate,burst = METHOD_RATES.get(method,DEFAULT_RATE)
+            bucket = TokenBucket(rate,burst)
+            _buckets[key] = bucket
+    return bucket
+
+
+def call_slack(method,func,**kwargs):
+    """
+    レート制限を守ってSlack APIを呼び出す。429の場合はRetry-After秒待って再送する
+
+    引数  :  method     str        APIメソッド名(chat.postMessageなど)
+             func       callable   WebClientのメソッド
+             kwargs     dict       APIの引数
+    戻り値:  response   SlackResponse
+    """
+    from slack.errors import SlackApiError
+
+    bucket = _bucket(method,kwargs.get('channel'))
+    with tracing.span(f'slack.{method}'): #レート制限の待ち時間も含める
+        for attempt in range(MAX_RETRY + 1):
+            bucket.acquire()
+            tracing.count(f'slack.{method}')
+            try:
+                return func(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt == MAX_RETRY:
+                    raise e
+                retry_after = int(e.response.headers.get('Retry-After',DEFAULT_RETRY_AFTER))
+                logger.warning(f'{method}がレート制限されました。{retry_after}秒後に再送します')
+                bucket.penalize(retry_after)
+
+
+async def call_slack_async(method,func,**kwargs):
+    """
+    call_slack()の非同期版(funcは非同期のWebClientのメソッド)
+
+    引数  :  method     str        APIメソッド名(chat.postMessageなど)
+             func       callable   非同期のWebClientのメソッド
+             kwargs     dict       APIの引数
+    戻り値:  response   SlackResponse
+    """
+    from slack.errors import SlackApiError
+
+    bucket = _bucket(method,kwargs.get('channel'))
+    with tracing.span(f'slack.{method}'): #レート制限の待ち時間も含める
+        for attempt in range(MAX_RETRY + 1):
+            await bucket.acquire_async()
+            tracing.count(f'slack.{method}')
+            try:
+                return await func(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt == MAX_RETRY:
+                    raise e
+                retry_after = int(e.response.headers.get('Retry-After',DEFAULT_RETRY_AFTER))
+                logger.warning(f'{method}がレート制限されました。{retry_after}秒後に再送します')
+                bucket.penalize(retry_after)
+
+
+def _to_blocks(messages):
+    blocks = []
+    for msg in messages:
+        if len(msg) > MAX_BLOCK_TEXT:
+            msg = msg[:MAX_BLOCK_TEXT - 3] + '...'
+        blocks.append({'type':'section','text':{'type':'mrkdwn','text':msg}})
+    return blocks
+
+
+class Outbox:
+    """
+    1つのチャンネルへの投稿をためて、まとめて送る
+
+    placeholder()で仮メッセージを投稿しておくと、flush()はそのメッセージをchat.updateで書き換える。
+    channel_id/tsを渡すと、別の実行(main→judgeなど)が投稿した仮メッセージを書き換えられる。
+    """
+
+    def __init__(self,channel,channel_id=None,ts=None):
+        self.channel = channel
+        self.channel_id = channel_id
+        self.ts = ts
+        self._messages = []
+
+    def post(self,text):
+        """
+        メッセージをためる(flush()で送る)
+        """
+        logger.debug(f'outbox:{text}')
+        self._messages.append(text)
+
+    def placeholder(self,text):
+        """
+        仮メッセージをすぐに投稿する。以降のflush()はこのメッセージを書き換える
+
+        戻り値: ts   str   投稿したメッセージのts
+        """
+        logger.info('Function placeholder')
+
+        res = call_slack(
+            'chat.postMessage',
+            clients.slack_bot_client().chat_postMessage,
+            channel=self.channel,
+            text=text,
+        )
+        self.channel_id = res['channel']
+        self.ts = res['ts']
+        return self.ts
+
+    async def placeholder_async(self,text):
+        """
+        placeholder()の非同期版
+
+        戻り値: ts   str   投稿したメッセージのts
+        """
+        logger.info('Function placeholder_async')
+
+        res = await call_slack_async(
+            'chat.postMessage',
+            clients.slack_async_bot_client().chat_postMessage,
+            channel=self.channel,
+            text=text,
+        )
+        self.channel_id = res['channel']
+        self.ts = res['ts']
+        return self.ts
+
+    def flush(self):
+        """
+        ためたメッセージを1つの投稿にまとめて送る
+        仮メッセージがある場合は、新しく投稿せずにchat.updateで書き換える
+
+        戻り値: ret   boolean   送るメッセージがあった(True),なかった(False)
+        """
+        if not self._messages:
+            return False
+
+        logger.info('Function flush')
+
+        if not self.channel and not self.ts:
+            logger.warning(f'投稿先のチャンネルが分からないため投稿しません:{self._messages}')
+            self._messages = []
+            return False
+
+        messages = self._messages
+        self._messages = []
+        text = '\n'.join(messages)
+        blocks = _to_blocks(messages)
+
+        if self.ts:
+            call_slack(
+                'chat.update',
+                clients.slack_bot_client().chat_update,
+                channel=self.channel_id,
+                ts=self.ts,
+                text=text,
+                blocks=blocks,
+            )
+        else:
+            res = call_slack(
+                'chat.postMessage',
+                clients.slack_bot_client().chat_postMessage,
+                channel=self.channel,
+                text=text,
+                blocks=blocks,
+            )
+            self.channel_id = res['channel']
+
+        return True
@@ -0,0 +1,164 @@
+#coding: UTF-8
+"""
+SlackからのHTTPリクエスト(スラッシュコマンド・Events API)の署名を検証するミドルウェア
+
+API Gatewayからは、以下のどちらかの形でリクエストが届く。
+  - Lambda統合(start): マッピングテンプレート(serverless.ymlのslack_request_template)で、
+    リクエストのbodyをそのままBase64にしたrawBodyと、ヘッダーを渡す
+  - Lambdaプロキシ統合(events): bodyを受け取ったままの文字列(isBase64EncodedがtrueならBase64)と、ヘッダーを渡す
+署名は受け取ったbodyのバイト列そのものに対して検証する(パースしたbodyから組み立て直さない)。
+
+  1. タイムスタンプのずれ(5分以上)をチェックする
+  2. HMAC-SHA256の署名をチェックする
+  3. 検証OKの場合だけbodyをパースして(JSON/フォーム)、event['body']に入れてハンドラーを呼ぶ
+
+検証NGのリクエストは、イベントのログ出力・JSONのパース・AWSクライアントの生成より前に捨てる。
+"""
+import base64
+import functools
+import hashlib
+import hmac
+import json
+import os
+import time
+import urllib.parse
+from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+loghandler = StreamHandler()
+loghandler.setFormatter(Formatter("%(asctime)s %(name)s %(levelname)8s %(message)s"))
+logger.addHandler(loghandler)
+
+SIGNATURE_VERSION = 'v0'
+MAX_TIMESTAMP_SKEW = 60 * 5 # リクエストのタイムスタンプと現在時刻のずれの上限(秒)
+TIMESTAMP_HEADER = 'x-slack-request-timestamp'
+SIGNATURE_HEADER = 'x-slack-signature'
+
+_signing_secret = os.environ['SLACK_SIGNING_SECRET'].encode()
+
+
+def get_header(event,name):
+    """
+    ヘッダーの値を返す(ヘッダー名の大文字・小文字は区別しない)
+
+    引数  :  event   dict   Lambdaのイベント
+             name    str    ヘッダー名(小文字)
+    戻り値:  value   str    ヘッダーの値。ない場合はNone
+    """
+    headers = event.get('headers') or {}
+    value = headers.get(name)
+    if value is not None:
+        return value
+    for key,value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def get_raw_body(event):
+    """
+    署名の対象になる、リクエストのbodyのバイト列を返す
+
+    引数  :  event      dict    Lambdaのイベント
+    戻り値:  raw_body   bytes   bodyのバイト列。取得できない場合はNone
+    """
+    raw_body = event.get('rawBody')
+    if raw_body is not None:
+        try:
+            return base64.b64decode(raw_body,validate=True)
+        except ValueError:
+            return None
+
+    #Lambdaプロキシ統合の場合は、bodyが文字列のまま渡される
+    body = event.get('body')
+    if isinstance(body,str):
+        return base64.b64decode(body) if event.get('isBase64Encoded') else body.encode()
+    return None
+
+
+def sign(timestamp,raw_body,secret=None):
+    """
+    Slackと同じ方法で署名を作る
+
+    引数  :  timestamp   str     X-Slack-Request-Timestampの値
+             raw_body    bytes   bodyのバイト列
+             secret      bytes   Signing Secret(省略時は環境変数SLACK_SIGNING_SECRET)
+    戻り値:  signature   str     v0=<HMAC-SHA256(16進)>
+    """
+    basestring = f'{SIGNATURE_VERSION}:{timestamp}:'.encode() + raw_body
+    digest = hmac.new(secret or _signing_secret,basestring,hashlib.sha256).hexdigest()
+    return f'{SIGNATURE_VERSION}={digest}'
+
+
+def verify(event,now=None):
+    """
+    リクエストのタイムスタンプと署名を検証する
+
+    引数  :  event      dict    Lambdaのイベント
+             now        float   現在時刻(unix時間)。省略時はtime.time()
+    戻り値:  raw_body   bytes   検証OKの場合はbodyのバイト列。NGの場合はNone
+    """
+    timestamp = get_header(event,TIMESTAMP_HEADER)
+    signature = get_header(event,SIGNATURE_HEADER)
+    if not timestamp or not signature:
+        return None
+
+    try:
+        skew = abs((now or time.time()) - int(timestamp))
+    except ValueError:
+        return None
+    if skew > MAX_TIMESTAMP_SKEW:
+        return None
+
+    raw_body = get_raw_body(event)
+    if raw_body is None:
+        return None
+
+    if not hmac.compare_digest(sign(timestamp,raw_body),signature):
+        return None
+    return raw_body
+
+
+def parse_body(event,raw_body):
+    """
+    検証済みのbodyをパースする(JSONまたはフォーム)
+
+    引数  :  event      dict    Lambdaのイベント
+             raw_body   bytes   bodyのバイト列
+    戻り値:  body       dict    パースしたbody(フォームの値は1つ目の値だけ使う)
+    """
+    content_type = (get_header(event,'content-type') or '').lower()
+    text = raw_body.decode('utf-8')
+
+    if 'json' in content_type or (not content_type and text.lstrip().startswith('{')):
+        return json.loads(text)
+    return dict(urllib.parse.parse_qsl(text,keep_blank_values=True))
+
+
+def verified(handler=None,rejected=None):
+    """
+    ハンドラーの前に署名を検証するデコレーター(@verified または @verified(rejected=<応答>) の形で使う)
+    検証OKの場合は、event['body']をパースしたbodyにしてハンドラーを呼ぶ。NGの場合はハンドラーを呼ばずにrejectedを返す
+    """
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event,lambda_context):
+            raw_body = verify(event)
+            if raw_body is None:
+                #イベントの中身はログに出さない(署名NGのリクエストに対しては何もしない)
+                logger.warning('リクエスト検証 NG')
+                return rejected
+
+            event = dict(event)
+            event.pop('rawBody',None)
+            event.pop('isBase64Encoded',None)
+            event['body'] = parse_body(event,raw_body)
+            return handler(event,lambda_context)
+
+        return wrapper
+
+    if handler is None:
+        return decorator
+    return decorator(handler)
@@ -1,19 +1,14 @@
 #coding: UTF-8
 import os
-import slack
 from datetime import datetime,timedelta
-from dateutil.relativedelta import relativedelta
 from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
 import json
 import math
-import boto3
 import random
 import string
 import traceback
-import hmac
-import time
-import hashlib
-import urllib.parse
+from src import clients,ids,leaderboard,slack_outbox,slack_request
+from src.repository import Repository
 
 logger = getLogger(__name__)
 logger.setLevel(DEBUG)
@@ -23,50 +18,39 @@ logger.addHandler(loghandler)
 
 logger.info('処理を開始します')
 
-client = slack.WebClient(token=os.environ['SLACK_API_TOKEN'])
-bot_client = slack.WebClient(token=os.environ['SLACK_BOT_API_TOKEN'])
-post_channel = os.environ['POST_CHANNEL']
-slack_signing_secret = os.environ['SLACK_SIGNING_SECRET']
+finish_function_arn = os.environ.get('FINISH_FUNCTION_ARN') #ゲーム終了時刻に実行するfinishのARN
+scheduler_role_arn = os.environ.get('SCHEDULER_ROLE_ARN') #EventBridge Schedulerがfinishを実行する時のロール
 alphabet_list = ['A','B','C','D','E','F','G','H','I','J','K','L','M','N','O','P','Q','R','S','T','U','V','W','X','Y','Z'] #HACK string.ascii_uppercaseで簡単に書けるはず
 TWO_DAYS = 180000 # 若干余裕を持っている
+FIRST_WORD_ID = 1 # 最初の文字を登録するword_id
+SCHEDULE_NAME_PREFIX = 'shiritori-finish-' # ゲーム終了用のスケジュール名(後ろにgame_idを付ける)
+STATUS_COMMAND = 'status' # /shiritori status で実行中のゲームの状況を表示する
 
 logger.info('環境変数を設定しました')
 
+@slack_request.verified
 def handler(event, lambda_context):    
+    outbox = slack_outbox.Outbox(None) #投稿先はリクエストのチャンネル(検証後に設定する)
     try:
+        repo = Repository()
         logger.debug(f'event:{event}')
 
-        #リクエストの検証
-        timestamp = event['headers']['X-Slack-Request-Timestamp']
-        if abs(math.floor(time.time()) - int(timestamp)) > 60 * 5:
-            logger.warning('reply attackの可能性があります')
-            logger.info('処理を終了します')
-            return
-
-        logger.debug(f'timestamp:{timestamp}')
-        
-        body = event['body']
-        sig_basestring = f'v0:{timestamp}:{parse_body(body)}'
-
-        logger.debug(f'sig_basestring:{sig_basestring}')
-        logger.debug(f'slack_signing_secret:{slack_signing_secret}')
-        my_signature = 'v0=' + hmac.new(slack_signing_secret.encode(),sig_basestring.encode(),hashlib.sha256).hexdigest()
+        #リクエストの検証はslack_request.verifiedで済んでいる(bodyはパース済み)
 
-        slack_signature = event['headers']['X-Slack-Signature']
-
-        logger.debug(f'my_signature   :{my_signature}')
-        logger.debug(f'slack_signature:{slack_signature}')
-
-        if hmac.compare_digest(my_signature, slack_signature):
-            logger.info('リクエスト検証 OK')
-        else:
-            logger.error('リクエスト検証 NG')
-            logger.error('処理を中止します')
-            return
+        ##ゲームはコマンドを実行したチャンネルごとに行う
+        channel_id = event['body']['channel_id']
+        outbox.channel = channel_id
+        logger.info(f'channel_id:{channel_id}')
 
         ##引数(時)で制限時間を設定する
         limit_hour_str = event['body'].get('text',None)
 
+        ##statusの場合は、ゲームを開始せずに実行中のゲームの状況を投稿する
+        if str(limit_hour_str or '').strip().lower() == STATUS_COMMAND:
+            show_status(repo,channel_id,outbox)
+            logger.info('処理を終了します')
+            return
+
         if not limit_hour_str:
             #NOTE bodyに項目がない場合も、空文字の場合も、いずれもデフォルトの1時間を設定する
             limit_hour_str = 1
@@ -74,15 +58,17 @@ def handler(event, lambda_context):
         ret = validate_limit_hour(limit_hour_str)
         if not ret['is_ok']:
             logger.warning(ret['ng_msg'])
-            bot_client.chat_postMessage(channel=post_channel, text=ret['ng_msg'])
+            outbox.post(ret['ng_msg'])
+            outbox.flush()
             logger.info('処理を終了します')
             return
         
         #実行中のゲームがある場合は、実行中であるメッセージを出す
-        if is_game_in_progress():
+        if repo.is_game_in_progress(channel_id):
             message_already = 'すでにゲームは実行中だよ！'
             logger.warning(message_already)
-            bot_client.chat_postMessage(channel=post_channel, text=message_already)
+            outbox.post(message_already)
+            outbox.flush()
             logger.info('処理を終了します')
             return
 
@@ -90,7 +76,7 @@ def handler(event, lambda_context):
         first_char = random.choice(alphabet_list)
 
         #gameテーブル登録
-        current_game_id = insert_game_table(first_char,limit_hour_str)
+        current_game_id = insert_game_table(repo,channel_id,first_char,limit_hour_str)
         if current_game_id:
             logger.info(f'今回のgame_id:{current_game_id}')
         else:
@@ -99,21 +85,22 @@ def handler(event, lambda_context):
             exit(1)            
 
         #wordテーブルに最初の文字を登録
-        if insert_first_char_to_word_table(first_char,current_game_id):
+        if insert_first_char_to_word_table(repo,first_char,current_game_id):
             logger.info('wordテーブルへの登録に成功しました')
         else:
             logger.error('wordテーブルへの登録に失敗しました')
             logger.error('処理を中止します')
             exit(1)
             
-        #slackに返信を投稿
+        #slackに返信を投稿(2つのメッセージを1つの投稿にまとめる)
         message_ok = f'AI絵しりとりを始めるよ！最初の文字は...{first_char}。'
         logger.info(message_ok)
-        bot_client.chat_postMessage(channel=post_channel, text=message_ok)
+        outbox.post(message_ok)
 
         message_ok_2 = f'締め切りは今から{limit_hour_str}時間後、ゲームスタート！'
         logger.info(message_ok_2)
-        bot_client.chat_postMessage(channel=post_channel, text=message_ok_2)
+        outbox.post(message_ok_2)
+        outbox.flush()
         
         #処理終了のログを出力
         logger.info('処理を終了します')
@@ -121,52 +108,60 @@ def handler(event, lambda_context):
     except Exception as e:
         message_error = f'エラーが発生しました:{type(e)}:{e.args}:{traceback.format_exc()}'
         logger.error(message_error)
-        bot_client.chat_postMessage(channel=post_channel, text=message_error)
+        outbox.post(message_error)
+        outbox.flush()
         logger.error('処理を中止します')
         exit(1)
 
 
-def get_max_game_id():
+def show_status(repo,channel_id,outbox):
     """
-    現在登録されているgame_idのうち最大のものを返す
-    
-    引数    :  なし
-    戻り値  :  maxId    int  現在登録されているgame_idのうち最大値
+    チャンネルの実行中のゲームの状況(経過・次の文字・残り時間・得点)を投稿する
+    judgeが更新しているゲームの集約状態をそのまま使う(wordテーブルは読まない)
+
+    引数　:    repo        Repository  DBアクセス
+    　　   　  channel_id  str         SlackのチャンネルID
+    　　   　  outbox      Outbox      Slackへの投稿
+    戻り値:    なし
     """
-    
-    logger.info('START Function get_max_game_id')
-    
-    dynamodb = boto3.resource('dynamodb')
-    game_table = dynamodb.Table('game')
-    game_res = game_table.scan()
-    
-    maxId = 0
-    for item in game_res.get('Items'):
-        if maxId < item.get('id'):
-                maxId = item.get('id')
 
-    logger.info(f'maxid:{maxId}')
-    logger.info('END   Function get_max_game_id')  
-    return maxId
+    logger.info('START Function show_status')
+
+    game = repo.get_latest_game(channel_id)
+    if not game or game.get('isEnded'):
+        message_nogame = '実行中のゲームがありません！'
+        logger.info(message_nogame)
+        outbox.post(message_nogame)
+    else:
+        #インデックスにはキーとisEndedしかないので、集約状態はゲームを読み直して使う
+        game = repo.get_game(game['id'])
+        state = repo.get_game_state(game)
+        names = leaderboard.get_display_names(state['posterCounts'])
+        for line in leaderboard.format_status(game,state,names=names):
+            outbox.post(line)
+    outbox.flush()
+
+    logger.info('END   Function show_status')
 
 
-def insert_game_table(first_char,limit_hour_str):
+def insert_game_table(repo,channel_id,first_char,limit_hour_str):
     """
     DynamoDBのgameテーブルにデータを挿入する
 
-    引数　:    first_char     str    最初の文字
+    引数　:    repo           Repository DBアクセス
+    　　   　  channel_id     str    ゲームを行うSlackのチャンネルID
+    　　   　  first_char     str    最初の文字
     　　   　  limit_hour_str str    制限時間(単位:時)
     戻り値:    game_id        int    採番されたgame_id。処理失敗時は0。
 
     """
 
     logger.info('START Function insert_game_table')
+    logger.info(f'channel_id:{channel_id}')
     logger.info(f'first_char:{first_char}')
     logger.info(f'limit_hour_str:{limit_hour_str}')
 
-    logger.info('START CALL Function get_max_game_id')
-    game_id = get_max_game_id() + 1
-    logger.info('END   CALL Function get_max_game_id')
+    game_id = ids.new_id() #時刻順に並ぶので、チャンネルの最大のgame_idが最新のゲームになる
 
     now = datetime.now()
     end = now + timedelta(hours=int(limit_hour_str))
@@ -178,25 +173,41 @@ def insert_game_table(first_char,limit_hour_str):
     end_time = end.strftime('%H:%M:%S')
 
     current_time = math.floor(now.timestamp())
+    end_unix_time = math.ceil(end.timestamp())
+
+    #終了時刻にfinishを1回だけ実行するスケジュールを作成する(gameテーブルへの登録前に作成する)
+    #登録に失敗した場合も、finishはゲームが見つからずに何もしないので、スケジュールは残してよい
+    try:
+        schedule_finish(game_id,end_unix_time)
+    except Exception as e:
+        logger.error(f'ゲーム終了のスケジュールを作成できませんでした:{type(e)}:{e.args}')
+        logger.info('game_id:0')
+        return 0
 
     item = {
         'id':game_id,
+        'channelId':channel_id,
         'beginDate':begin_date,
         'beginTime':begin_time,
         'endDate':end_date,
         'endTime':end_time,
+        'endUnixTime':end_unix_time,
         'firstChar':first_char,
         'isEnded':bool(False),
         'unixTime':int(current_time)+TWO_DAYS,
+        #ゲームの集約状態(judgeが条件付き更新する)
+        'nextChar':first_char,
+        'lastWordId':FIRST_WORD_ID,
+        'lastValidId':FIRST_WORD_ID,
+        'usedWords':[],
+        'posterCounts':{},
+        'posterLastIds':{},
+        'version':1,
     }
 
     logger.debug(f'item:{item}')
-    dynamodb = boto3.resource('dynamodb')
-    image_table = dynamodb.Table('game')
-    
     try:
-        res = image_table.put_item(Item=item)
-        logger.debug(res)
+        repo.insert_game(item)
     except Exception as e:
         logger.error(f'データ挿入に失敗しました:{type(e)}:{e.args}')
         logger.info('game_id:0')
@@ -207,11 +218,45 @@ def insert_game_table(first_char,limit_hour_str):
     return game_id
 
 
-def insert_first_char_to_word_table(first_char,current_game_id):
+def schedule_finish(game_id,end_unix_time):
+    """
+    ゲームの終了時刻に、finishを1回だけ実行するスケジュールを作成する(EventBridge Schedulerのat式)
+    実行後のスケジュールは自動で削除される
+
+    引数　:    game_id        int    ゲームID
+    　　   　  end_unix_time  int    ゲームの終了時刻(unixtime)
+    戻り値:    なし(失敗時は例外)
+    """
+
+    logger.info('START Function schedule_finish')
+    logger.info(f'game_id:{game_id}')
+    logger.info(f'end_unix_time:{end_unix_time}')
+
+    at = datetime.utcfromtimestamp(end_unix_time).strftime('%Y-%m-%dT%H:%M:%S')
+
+    res = clients.scheduler().create_schedule(
+        Name=SCHEDULE_NAME_PREFIX + str(game_id),
+        ScheduleExpression=f'at({at})',
+        ScheduleExpressionTimezone='UTC',
+        FlexibleTimeWindow={'Mode':'OFF'},
+        Target={
+            'Arn':finish_function_arn,
+            'RoleArn':scheduler_role_arn,
+            'Input':json.dumps({'gameId':game_id}),
+        },
+        ActionAfterCompletion='DELETE',
+    )
+    logger.debug(res)
+
+    logger.info('END   Function schedule_finish')
+
+
+def insert_first_char_to_word_table(repo,first_char,current_game_id):
     """
     最初の文字をwordテーブルに登録
     
-    引数    :  first_char   str        最初の文字
+    引数    :  repo         Repository DBアクセス
+               first_char   str        最初の文字
                current_game_id  int        現在のgame_id
     戻り値  :   ret        boolean    処理結果
     """
@@ -223,9 +268,7 @@ def insert_first_char_to_word_table(first_char,current_game_id):
     dt = datetime.now()
     current_time = math.floor(dt.timestamp())
 
-    logger.info('START CALL Function get_max_word_id')
-    word_id = get_max_word_id(current_game_id-1) + 1 #NOTE current_game_id-1が直近のゲームIDになる。＃TODO わかりづらいので修正したい。
-    logger.info('END   CALL Function get_max_word_id')
+    word_id = FIRST_WORD_ID #NOTE word_idはゲームごとの連番(wordテーブルのソートキー)
 
     logger.debug(f'current_time:{current_time}')
     logger.debug(f'word_id:{word_id}')
@@ -240,14 +283,10 @@ def insert_first_char_to_word_table(first_char,current_game_id):
             'unixTime':int(current_time)+TWO_DAYS,
         }
     
-    dynamodb = boto3.resource('dynamodb')
-    word_table = dynamodb.Table('word')
-
     logger.debug(f'put_json:{put_json}')
 
     try:
-        res = word_table.put_item(Item=put_json)
-        logger.debug(res)
+        repo.insert_word(put_json)
 
     except Exception as e:
         logger.error(f'wordテーブルへの登録に失敗しました:{type(e)}:{e.args}')
@@ -257,87 +296,6 @@ def insert_first_char_to_word_table(first_char,current_game_id):
     return True
 
 
-def is_game_in_progress():
-    """
-    実行中のゲームがあるか調べる
-    
-    引数    :  なし
-    戻り値  :  isGame boolean 実行中のゲームがある(True)か、ない(False)か。
-    """
-
-    logger.info('START Function is_game_in_progress')
-
-    dynamodb = boto3.resource('dynamodb')
-    game_table = dynamodb.Table('game')
-
-    try:
-        res = game_table.scan()
-        logger.info(res)
-
-    except Exception as e:
-        logger.warning(f'gameテーブルへの接続に失敗しました:{type(e)}:{e.args}')
-        raise e
-
-    for item in res.get('Items'):
-        if not item.get('isEnded'):
-            logger.info('実行中のゲームがあります')
-            return True
-
-    logger.info('実行中のゲームはありません')
-    logger.info('END   Function is_game_in_progress')
-
-    return False
-
-
-def get_words(game_id):
-    """
-    wordテーブルのデータを取得   
-    引数  :  game_id    int         ゲームID
-    戻り値:  words     list<dict>  wordテーブルのデータ
-    """
-    logger.info('START Function get_words')
-    logger.info(f'game_id:{game_id}')
-    
-    dynamodb = boto3.resource('dynamodb')
-    word_table = dynamodb.Table('word')
-    word_res = word_table.scan()
-    
-    logger.debug(f'word_res:{word_res}')
-
-    words = []
-    for i in word_res.get('Items'):
-        if i.get('gameId') == game_id:
-            words.append(i)    
-
-    logger.info(f'words:{words}')
-    logger.info('END   Function get_words')
-    return words
-
-
-def get_max_word_id(game_id):
-    """
-    wordテーブルの最後のIDを取得   
-    引数　 :  game_id        int         現在のgame_id
-    戻り値 :  max_word_id    int         現在登録されている最後のword_id
-    """
-    logger.info('START Function get_max_word_id')
-    logger.info(f'game_id:{game_id}')
-
-    logger.info('START CALL Function get_words')
-    words = get_words(game_id)
-    logger.info('END   CALL Function get_words')
-
-    max_word_id = 0
-    for w in words:
-        if w.get('id',None) > max_word_id:
-            max_word_id = w['id']
-        
-    logger.info(f'max_word_id:{max_word_id}')
-    logger.info('END   Function get_max_word_id')
-
-    return max_word_id
-
-
 def validate_limit_hour(limit_hour_str):
     """    
     制限時間の妥当性チェック   
@@ -372,25 +330,3 @@ def validate_limit_hour(limit_hour_str):
 
     return result
 
-
-def parse_body(body):
-    """    
-    リクエスト検証用にdict型のbodyをパースする  
-    引数　 :  body        dict    リクエストbody
-    戻り値 :  body_str    str     パース後のリクエストbody文字列
-    """
-    logger.info('START Function parse_body')
-    logger.info(f'body:{body}')
-
-    body_str = ''
-
-    for k in body:
-        body_str += '&' + urllib.parse.quote_plus(k) + '=' + urllib.parse.quote_plus(body[k])
-
-    body_str = body_str[1:] #1字目の&は不要
-
-    logger.info(f'body_str:{body_str}')
-    logger.info('End Function parse_body')
-
-    return body_str
-
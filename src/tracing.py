@@ -0,0 +1,182 @@
+#coding: UTF-8
+"""
+main/judgeの処理区間(スパン)の時間と、外部APIの呼び出し回数・DynamoDBの消費キャパシティを計測するモジュール
+
+1回の実行(Lambdaの呼び出し)ごとにstart()で計測を始め、最後にemit()で
+CloudWatchのEmbedded Metric Format(EMF)の1行のJSONとして標準出力に書き出す。
+Lambdaでは標準出力がCloudWatch Logsに送られ、そのままメトリクスになる(ローカルでは表示されるだけ)。
+
+相関ID(correlationId)はSlackのfile_idを使う。mainはS3のオブジェクトのメタデータに相関IDを付けて、
+judgeはそれを引き継ぐので、1枚の画像の受付から判定までをログで追える。
+
+計測していない時(start()の前)は、span()/count()などは何もしない。
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter,defaultdict
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE','PictureShiritori')
+CORRELATION_METADATA_KEY = 'correlation-id' # S3のオブジェクトのメタデータ(x-amz-meta-correlation-id)
+
+_lock = threading.Lock()
+_trace = None
+
+
+class Trace:
+    """
+    1回の実行の計測結果
+    """
+
+    def __init__(self,function,correlation_id=None):
+        self.function = function
+        self.correlation_id = correlation_id
+        self.started = time.perf_counter()
+        self.spans = defaultdict(float) # スパン名 -> 合計時間(ミリ秒)
+        self.calls = Counter() # API名 -> 呼び出し回数
+        self.capacity = defaultdict(float) # テーブル名 -> 消費したキャパシティユニット
+
+
+def start(function,correlation_id=None):
+    """
+    計測を始める(前の実行の計測結果は捨てる)
+
+    引数  :  function         str   関数名(main/judge)。メトリクスのディメンションになる
+             correlation_id   str   相関ID。後からset_correlation_id()で設定してもよい
+    """
+    global _trace
+    with _lock:
+        _trace = Trace(function,correlation_id)
+
+
+def set_correlation_id(correlation_id):
+    """
+    相関IDを設定する
+    """
+    trace = _trace
+    if trace is not None and correlation_id:
+        trace.correlation_id = str(correlation_id)
+
+
+def correlation_id():
+    """
+    今の実行の相関IDを返す(計測していない場合はNone)
+    """
+    trace = _trace
+    return trace.correlation_id if trace is not None else None
+
+
+def s3_metadata():
+    """
+    S3に画像を保存する時に付けるメタデータ(相関ID)を返す
+    """
+    cid = correlation_id()
+    return {CORRELATION_METADATA_KEY:cid} if cid else {}
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    with文の中の処理時間を、スパンの時間として加算する(同じ名前のスパンは合計する)
+    別スレッド・並行して実行するコルーチンの中でも使える
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name,(time.perf_counter() - t0) * 1000)
+
+
+def record(name,milliseconds):
+    """
+    計測済みの時間(ミリ秒)を、スパンの時間として加算する
+    """
+    trace = _trace
+    if trace is None:
+        return
+    with _lock:
+        trace.spans[name] += milliseconds
+
+
+def count(name,n=1):
+    """
+    外部APIの呼び出し回数を数える
+    """
+    trace = _trace
+    if trace is None:
+        return
+    with _lock:
+        trace.calls[name] += n
+
+
+def add_consumed_capacity(consumed):
+    """
+    DynamoDBの戻り値のConsumedCapacity(バッチ系の場合はリスト)を加算する
+    """
+    trace = _trace
+    if trace is None or not consumed:
+        return
+    if isinstance(consumed,dict):
+        consumed = [consumed]
+    with _lock:
+        for c in consumed:
+            trace.capacity[c.get('TableName','unknown')] += float(c.get('CapacityUnits',0))
+
+
+def build_record(trace):
+    """
+    計測結果をEMFのJSON(dict)にする
+    """
+    metrics = []
+    values = {}
+
+    def put(name,value,unit):
+        metrics.append({'Name':name,'Unit':unit})
+        values[name] = round(value,3)
+
+    put('duration',(time.perf_counter() - trace.started) * 1000,'Milliseconds')
+    for name,ms in sorted(trace.spans.items()):
+        put(f'span.{name}',ms,'Milliseconds')
+    for name,n in sorted(trace.calls.items()):
+        put(f'calls.{name}',n,'Count')
+    if trace.capacity:
+        put('dynamodb.consumedCapacity',sum(trace.capacity.values()),'Count')
+        for table,units in sorted(trace.capacity.items()):
+            put(f'dynamodb.consumedCapacity.{table}',units,'Count')
+
+    return {
+        '_aws':{
+            'Timestamp':int(time.time() * 1000),
+            'CloudWatchMetrics':[{
+                'Namespace':NAMESPACE,
+                'Dimensions':[['Function']],
+                'Metrics':metrics,
+            }],
+        },
+        'Function':trace.function,
+        'correlationId':trace.correlation_id,
+        **values,
+    }
+
+
+def emit(stream=None):
+    """
+    計測を終えて、EMFの1行のJSONを書き出す(計測していない場合は何もしない)
+
+    引数  :  stream   file   書き出し先(省略時は標準出力)
+    戻り値:  record   dict   書き出した内容。計測していない場合はNone
+    """
+    global _trace
+    with _lock:
+        trace,_trace = _trace,None
+    if trace is None:
+        return None
+
+    emf = build_record(trace)
+    stream = stream or sys.stdout
+    stream.write(json.dumps(emf,ensure_ascii=False) + '\n')
+    stream.flush()
+    return emf
@@ -0,0 +1,327 @@
+#coding: UTF-8
+"""
+events/main/start/judge/finishのコールドスタート時間を計測する
+
+ハンドラーごとに新しいPythonプロセスを起動して、以下を計測する。
+  - import_ms      : ハンドラーモジュールのimportにかかった時間
+  - deps_ms        : 最初の実行で遅延importされる依存パッケージ(boto3/slack/requestsなど)のimportにかかった時間
+  - first_call_ms  : 最初の実行(本番と同じ経路)にかかった時間。AWSクライアントの生成・接続を含む
+  - heavy_modules  : import直後に読み込まれていた重いモジュール(boto3/slack/requestsなど)
+
+最初の実行は、ローカルエミュレーター(tools/local_emulator.py)と同じ偽物で行う。
+S3/DynamoDB/Schedulerはmoto、Slack/Rekognition/Lambdaの呼び出しは偽物で、ハンドラーごとに以下を実行する。
+  - start  : スラッシュコマンドでゲームを開始する
+  - events : file_sharedイベントを受け付けて、mainを呼び出す
+  - main   : 画像をダウンロードしてS3(judge/)に置く
+  - judge  : S3イベントの画像を判定してwordテーブルに登録する
+  - finish : スケジュールの入力でゲームを終了して結果を投稿する
+テーブル・バケット・データの準備はsrc.clientsを使わずに行うので、クライアントの生成は最初の実行に含まれる。
+ただしmotoがboto3を読み込むので、依存パッケージのimportはdeps_msとして別に計測する(first_call_msには含まない)。
+重いモジュールはimport時に読み込まれないこと(遅延import)もチェックする。
+
+必要なもの(Lambdaには含めない開発用のパッケージ。ない場合は--import-onlyで計測する):
+  pip install moto PyYAML
+
+使い方:
+  python tools/bench_cold_start.py                           # 計測して結果を表示
+  python tools/bench_cold_start.py --import-only             # importだけ計測する
+  python tools/bench_cold_start.py --save-baseline base.json # 計測結果をベースラインとして保存
+  python tools/bench_cold_start.py --baseline base.json      # ベースラインより遅くなっていたら終了コード1
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOLS_DIR = os.path.join(ROOT_DIR,'tools')
+
+HANDLERS = ['events','main','start','judge','finish']
+HEAVY_MODULES = ['boto3','botocore','slack','requests','aiohttp','PIL']
+METRICS = ['import_ms','deps_ms','first_call_ms']
+
+CHANNEL = 'C0001'
+USER = 'U0001'
+FILE_ID = 'F0001'
+IMAGE_ID = 1
+GAME_ID = 1
+FIRST_CHAR = 'A'
+
+
+def child_env():
+    """
+    計測用のプロセスの環境変数(ローカルエミュレーターと同じダミーの値)
+    """
+    import local_emulator
+
+    env = dict(os.environ)
+    env.update(local_emulator.EMULATOR_ENV)
+    env['INLINE_JUDGE'] = 'false'
+    env['RAW_LABELS_STORAGE'] = 'zlib'
+    env['PYTHONPATH'] = ROOT_DIR + os.pathsep + env.get('PYTHONPATH','')
+    return env
+
+
+def make_game(end_unix_time,used_words=()):
+    """
+    startが登録するのと同じ形のゲームを作る
+    """
+    now = int(time.time())
+    counts = {USER:len(used_words)} if used_words else {}
+    return {
+        'id':GAME_ID,
+        'channelId':CHANNEL,
+        'endUnixTime':end_unix_time,
+        'firstChar':FIRST_CHAR,
+        'isEnded':False,
+        'unixTime':now + 180000,
+        'nextChar':used_words[-1][-1].upper() if used_words else FIRST_CHAR,
+        'lastWordId':1 + len(used_words),
+        'lastValidId':1 + len(used_words),
+        'usedWords':list(used_words),
+        'posterCounts':counts,
+        'posterLastIds':{USER:1 + len(used_words)} if used_words else {},
+        'version':1 + len(used_words),
+    }
+
+
+def prepare_first_call(name,session,fakes):
+    """
+    最初の実行に必要なデータを用意して、ハンドラーに渡すイベントと、本番の経路を通ったかを調べる関数を返す
+    (src.clientsは使わずに、別のboto3のセッションで用意する)
+
+    引数  :  name      str              ハンドラー名
+             session   boto3.Session    データを用意するセッション
+             fakes     dict             local_emulatorの偽物(slack/rekognition/lambda)
+    戻り値:  event     dict             ハンドラーに渡すイベント
+             check     function         実行後にハンドラーの戻り値を渡して呼ぶと、本番の経路を通った場合にTrueを返す
+    """
+    import local_emulator
+
+    bucket = os.environ['PUT_BACKET']
+    dynamodb = session.resource('dynamodb')
+    s3 = session.client('s3')
+    now = int(time.time())
+
+    if name == 'start':
+        event = local_emulator.command_event(CHANNEL,USER,'1')
+        return event,lambda response:bool(dynamodb.Table('game').scan()['Items'])
+
+    if name == 'events':
+        dynamodb.Table('game').put_item(Item=make_game(now + 3600))
+        event = local_emulator.file_shared_event(FILE_ID,USER,CHANNEL)
+        return event,lambda response:local_emulator.check_proxy_response(response) is not None and bool(fakes['lambda'].invocations)
+
+    if name == 'main':
+        dynamodb.Table('game').put_item(Item=make_game(now + 3600))
+        fakes['slack'].upload(FILE_ID,USER,CHANNEL,local_emulator.make_png(FILE_ID))
+        event = {'body':local_emulator.file_shared_body(FILE_ID,USER,CHANNEL)}
+        return event,lambda response:s3.list_objects_v2(Bucket=bucket,Prefix='judge/').get('KeyCount',0) > 0
+
+    if name == 'judge':
+        key = f'judge/{IMAGE_ID}.png'
+        dynamodb.Table('game').put_item(Item=make_game(now + 3600))
+        dynamodb.Table('image').put_item(Item={
+            'imageId':IMAGE_ID,'poster':USER,'fileId':FILE_ID,'channelId':CHANNEL,'gameId':GAME_ID,'unixTime':now + 180000,
+        })
+        s3.put_object(Bucket=bucket,Key=key,Body=local_emulator.make_png(FILE_ID))
+        fakes['rekognition'].expect(['Apple','Fruit'])
+        event = {'Records':[{'s3':{'bucket':{'name':bucket},'object':{'key':key}}}]}
+        return event,lambda response:bool(dynamodb.Table('gameWord').scan()['Items'])
+
+    if name == 'finish':
+        dynamodb.Table('game').put_item(Item=make_game(now - 1,['Apple','Egg','Guitar']))
+        event = {'gameId':GAME_ID}
+        return event,lambda response:bool(dynamodb.Table('game').get_item(Key={'id':GAME_ID})['Item'].get('isEnded'))
+
+    raise ValueError(f'ハンドラーがありません:{name}')
+
+
+def run_child(name,first_call):
+    """
+    (計測用のプロセスの中で)ハンドラーをimportし、最初の実行を計測して結果をJSONで出力する
+    """
+    logging.disable(logging.CRITICAL)
+
+    t0 = time.perf_counter()
+    module = importlib.import_module('src.' + name)
+    result = {
+        'import_ms':(time.perf_counter() - t0) * 1000,
+        'deps_ms':None,
+        'first_call_ms':None,
+        'heavy_modules':[m for m in HEAVY_MODULES if m in sys.modules],
+        'ok':None,
+    }
+
+    if first_call:
+        #最初の実行で遅延importされる依存パッケージ(データの準備で読み込む前に計測する)
+        t1 = time.perf_counter()
+        for heavy in HEAVY_MODULES:
+            try:
+                importlib.import_module(heavy)
+            except ImportError:
+                pass
+        result['deps_ms'] = (time.perf_counter() - t1) * 1000
+
+        import boto3
+        from moto import mock_aws
+        import local_emulator
+        from src import clients,slack_outbox
+
+        #Slackのレート制限の待ち時間は含めない
+        slack_outbox.METHOD_RATES = {}
+        slack_outbox.DEFAULT_RATE = (1e9,1e9)
+
+        stats = local_emulator.CallStats()
+        file_server = local_emulator.FileServer(stats)
+        fakes = {
+            'slack':local_emulator.FakeSlack(stats,file_server),
+            'rekognition':local_emulator.RekognitionStub(stats),
+            'lambda':local_emulator.LambdaStub(stats),
+        }
+        try:
+            with mock_aws():
+                session = boto3.Session()
+                local_emulator.create_aws_resources(
+                    session.client('dynamodb'),session.client('s3'),os.environ['PUT_BACKET'],os.environ['AWS_DEFAULT_REGION'],
+                )
+                local_emulator.install_fakes(clients,fakes['slack'],fakes['rekognition'],fakes['lambda'])
+                event,check = prepare_first_call(name,session,fakes)
+
+                exit_code = 0
+                response = None
+                t2 = time.perf_counter()
+                try:
+                    response = module.handler(event,None)
+                except SystemExit as e:
+                    exit_code = e.code or 0
+                result['first_call_ms'] = (time.perf_counter() - t2) * 1000
+                result['ok'] = not exit_code and check(response)
+        finally:
+            file_server.close()
+
+    #ハンドラーのEMFの出力と区別できるよう、最後の行に出力する
+    print(json.dumps(result))
+
+
+def measure_once(name,first_call,python=sys.executable):
+    """
+    新しいプロセスで1回計測する
+
+    引数  :  name        str       ハンドラー名(events/main/start/judge/finish)
+             first_call  boolean   最初の実行も計測する(Falseの場合はimportのみ)
+    戻り値:  result      dict      import_ms/deps_ms/first_call_ms/heavy_modules/ok
+    """
+    args = [python,os.path.abspath(__file__),'--child',name]
+    if not first_call:
+        args.append('--import-only')
+
+    out = subprocess.run(
+        args,
+        cwd=ROOT_DIR,
+        env=child_env(),
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    return json.loads(out.stdout.decode().strip().splitlines()[-1])
+
+
+def measure(name,first_call,repeat):
+    """
+    repeat回計測して中央値を返す
+    """
+    results = [measure_once(name,first_call) for _ in range(repeat)]
+
+    summary = {'heavy_modules':results[0]['heavy_modules'],'ok':all(r['ok'] is not False for r in results)}
+    for metric in METRICS:
+        values = [r[metric] for r in results if r[metric] is not None]
+        summary[metric] = statistics.median(values) if values else None
+    return summary
+
+
+def check_regression(results,baseline,max_regression):
+    """
+    ベースラインと比べて、max_regression(割合)より遅くなった項目を返す
+    """
+    regressions = []
+    for name,result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in METRICS:
+            if result.get(metric) is None or base.get(metric) is None:
+                continue
+            limit = base[metric] * (1 + max_regression)
+            if result[metric] > limit:
+                regressions.append(f'{name}.{metric}: {result[metric]:.1f}ms > {limit:.1f}ms (baseline {base[metric]:.1f}ms)')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ハンドラーのコールドスタート時間を計測する')
+    parser.add_argument('--handlers',nargs='*',default=HANDLERS,help='計測するハンドラー')
+    parser.add_argument('--repeat',type=int,default=5,help='計測回数(中央値を使う)')
+    parser.add_argument('--import-only',action='store_true',help='importだけ計測する(最初の実行はしない)')
+    parser.add_argument('--save-baseline',help='計測結果を保存するファイル')
+    parser.add_argument('--baseline',help='比較するベースラインのファイル')
+    parser.add_argument('--max-regression',type=float,default=0.2,help='許容する悪化の割合(0.2=20%%)')
+    parser.add_argument('--child',help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    #ローカルエミュレーターの偽物を使う
+    sys.path.insert(0,TOOLS_DIR)
+
+    if args.child:
+        run_child(args.child,not args.import_only)
+        return 0
+
+    first_call = not args.import_only
+    if first_call:
+        try:
+            import moto  # noqa: F401
+            import yaml  # noqa: F401
+        except ImportError as e:
+            print(f'最初の実行の計測にはmotoとPyYAMLが必要です(pip install moto PyYAML)。--import-onlyでimportだけ計測できます:{e}',file=sys.stderr)
+            return 2
+
+    results = {}
+    failed = []
+    for name in args.handlers:
+        result = measure(name,first_call,args.repeat)
+        results[name] = result
+
+        cols = []
+        for metric in METRICS:
+            value = '-' if result[metric] is None else f'{result[metric]:.1f}ms'
+            cols.append(f"{metric[:-3]}:{value:>9s}")
+        print(f"{name:8s} {'  '.join(cols)}  heavy_modules:{result['heavy_modules']}")
+
+        if result['heavy_modules']:
+            failed.append(f'{name}: import時に重いモジュールを読み込んでいます:{result["heavy_modules"]}')
+        if not result['ok']:
+            failed.append(f'{name}: 最初の実行が本番と同じ経路で終わりませんでした')
+
+    if args.save_baseline:
+        with open(args.save_baseline,'w') as f:
+            json.dump(results,f,indent=2)
+        print(f'ベースラインを保存しました:{args.save_baseline}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failed.extend(check_regression(results,baseline,args.max_regression))
+
+    for msg in failed:
+        print('NG ' + msg)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,307 @@
+#coding: UTF-8
+"""
+judge/finishの判定・集計ロジックのマイクロベンチマーク
+
+wordテーブルの件数(10/1千/1万件)ごとに合成したゲームと、実際に近いRekognitionの結果で、
+以下の関数の1回あたりの実行時間を計測する。DynamoDBには接続しない(テーブルはスタブ)。
+  - judge.build_used_word_index / judge.get_next_word / judge.next_game_state : 既出単語の件数に比例
+  - judge.bucket_candidates / judge.most_confident_word                       : ラベル数に比例
+  - label_store.summarize_labels / label_store.encode_raw_labels             : ラベル数に比例
+  - leaderboard.get_progress / leaderboard.get_winner / leaderboard.format_status
+                                                                             : 集約状態から求める(既出単語の件数・投稿者数に比例)
+  - Repository.get_words                                                     : wordテーブルの件数に比例(1MBごとのページング)
+  - Repository.get_next_char / Repository.get_valid_word_id / Repository.get_game_state(集約状態のない古いゲーム)
+                                                                             : wordテーブルの件数に比例(読み込み済みのwordを走査する)
+ラベル数はDetectLabelsのMaxLabelsの上限(1000)までとする。
+件数は、集約状態を持つgameテーブルの項目がDynamoDBの上限(400KB)に収まる範囲までとする(超える件数は指定できない)。
+
+使い方:
+  python tools/bench_logic.py                                # 計測して結果を表示
+  python tools/bench_logic.py --sizes 10 1000                # 件数を指定する
+  python tools/bench_logic.py --save-baseline logic.json     # 計測結果をベースラインとして保存
+  python tools/bench_logic.py --baseline logic.json          # ベースラインより遅くなっていたら終了コード1
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import timeit
+from decimal import Decimal
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DUMMY_ENV = {
+    'SLACK_API_TOKEN':'xoxp-dummy',
+    'SLACK_BOT_API_TOKEN':'xoxb-dummy',
+    'SLACK_SIGNING_SECRET':'dummy-signing-secret',
+    'PUT_BACKET':'dummy-bucket',
+    'AWS_DEFAULT_REGION':'ap-northeast-1',
+}
+
+DEFAULT_SIZES = [10,1000,10000]
+MAX_LABELS = 1000 # DetectLabelsのMaxLabelsの上限
+PAGE_BYTES = 1024 * 1024 # DynamoDBのqueryの1ページ(1MB)
+ITEM_BYTES = 300 # wordテーブルの1件のおおよそのサイズ(ラベルの要約を含む)
+MAX_ITEM_BYTES = 400 * 1024 # DynamoDBの1項目の上限
+MIN_TIME = 0.2 # 1回の計測で最低限ループする時間(秒)
+
+#ベンチマークごとの許容する悪化の割合(ない場合は--max-regression)
+THRESHOLDS = {
+    'repository.get_words':0.5, #ページングのスタブを含むので揺れが大きい
+}
+
+#Rekognitionのラベル名・親ラベル名の材料
+NOUNS = [
+    'Apple','Banana','Cat','Dog','Egg','Fish','Guitar','House','Island','Jacket','Kite','Lamp','Moon',
+    'Nest','Orange','Piano','Queen','Robot','Sun','Tree','Umbrella','Violin','Whale','Xylophone','Yacht','Zebra',
+]
+PARENTS = ['Animal','Food','Fruit','Plant','Building','Vehicle','Instrument','Clothing','Nature','Furniture']
+ADJECTIVES = ['Red','Small','Big','Old','New','Wild','Toy','Sea','Night','Snow']
+
+
+class StubTable:
+    """
+    DynamoDBのTableのスタブ。queryは1MBごとにページングして返す
+    """
+
+    def __init__(self,items):
+        self.items = items
+        self.page_size = max(1,PAGE_BYTES // ITEM_BYTES)
+
+    def query(self,ExclusiveStartKey=None,**kwargs):
+        start = ExclusiveStartKey['index'] if ExclusiveStartKey else 0
+        end = start + self.page_size
+        res = {'Items':self.items[start:end]}
+        if end < len(self.items):
+            res['LastEvaluatedKey'] = {'index':end}
+        return res
+
+
+def make_label_name(rng,i):
+    """
+    ラベル名を作る(同じ頭文字・同じ正規化の単語が混ざるようにする)
+    """
+    noun = NOUNS[i % len(NOUNS)]
+    if i < len(NOUNS):
+        return noun
+    return f'{ADJECTIVES[rng.randrange(len(ADJECTIVES))]} {noun}{"s" if i % 3 == 0 else ""}'
+
+
+def make_retrekog(label_count,seed=0):
+    """
+    DetectLabelsの戻り値(ラベル・親ラベル・別名・インスタンスを含む)を作る
+    """
+    rng = random.Random(seed)
+    labels = []
+    for i in range(label_count):
+        label = {
+            'Name':make_label_name(rng,i),
+            'Confidence':rng.uniform(50.0,99.9),
+            'Instances':[],
+            'Parents':[{'Name':p} for p in rng.sample(PARENTS,2)],
+            'Aliases':[{'Name':f'{make_label_name(rng,i)} Alias'}] if i % 5 == 0 else [],
+            'Categories':[{'Name':PARENTS[i % len(PARENTS)]}],
+        }
+        if i % 4 == 0:
+            label['Instances'].append({
+                'BoundingBox':{'Width':rng.random(),'Height':rng.random(),'Left':rng.random(),'Top':rng.random()},
+                'Confidence':rng.uniform(50.0,99.9),
+            })
+        labels.append(label)
+    labels.sort(key=lambda x:-x['Confidence'])
+    return {'Labels':labels,'LabelModelVersion':'3.0'}
+
+
+def make_words(count,game_id=1,players=5,seed=0):
+    """
+    wordテーブルのデータ(DynamoDBから読んだ形。数値はDecimal)を作る
+    1件目は最初の文字(posterなし)、以降は3件に2件をしりとり成立にする
+    """
+    rng = random.Random(seed)
+    words = [{
+        'id':Decimal(1),'gameId':Decimal(game_id),'isValid':True,'word':'A','nextChar':'A',
+        'postTime':Decimal(1600000000),'unixTime':Decimal(1600180000),
+    }]
+    for i in range(2,count + 1):
+        is_valid = i % 3 != 0
+        word = f'{NOUNS[i % len(NOUNS)]}{i}'
+        words.append({
+            'id':Decimal(i),
+            'gameId':Decimal(game_id),
+            'isValid':is_valid,
+            'word':word,
+            'nextChar':word[-1].upper() if is_valid else '',
+            'postTime':Decimal(1600000000 + i),
+            'poster':f'U{rng.randrange(players):04d}',
+            'prevId':Decimal(i - 1),
+            'labels':[{'name':word,'confidence':Decimal(9512)},{'name':'Object','confidence':Decimal(8730)}],
+            'unixTime':Decimal(1600180000 + i),
+        })
+    return words
+
+
+def make_state(used_words):
+    """
+    judgeのゲームの集約状態を作る
+    """
+    return {
+        'version':len(used_words),
+        'lastWordId':len(used_words),
+        'lastValidId':len(used_words),
+        'nextChar':'A',
+        'usedWords':used_words,
+        'posterCounts':{f'U{i:04d}':len(used_words) // 5 for i in range(5)},
+        'posterLastIds':{f'U{i:04d}':len(used_words) - i for i in range(5)},
+    }
+
+
+def estimate_item_bytes(value):
+    """
+    DynamoDBの項目(属性名と値)のおおよそのサイズ(byte)を返す
+    """
+    if isinstance(value,dict):
+        return 3 + sum(len(str(k).encode()) + 1 + estimate_item_bytes(v) for k,v in value.items())
+    if isinstance(value,(list,tuple)):
+        return 3 + sum(1 + estimate_item_bytes(v) for v in value)
+    if isinstance(value,bool):
+        return 1
+    if isinstance(value,(int,Decimal)):
+        return len(str(value)) // 2 + 1
+    return len(str(value).encode())
+
+
+def make_game_item(size):
+    """
+    集約状態を持つgameテーブルの項目を作る(件数がDynamoDBの上限に収まるかの確認に使う)
+    """
+    used_words = [w['word'] for w in make_words(size) if w['isValid']]
+    game = {'id':1,'channelId':'C0000000000','firstChar':'A','endUnixTime':1600003600,'isEnded':False}
+    game.update(make_state(used_words))
+    return game
+
+
+def build_benchmarks(size):
+    """
+    件数ごとのベンチマーク(名前 -> 引数なしで呼べる関数)を作る
+    """
+    from src import judge,label_store,leaderboard
+    from src.repository import Repository
+
+    retrekog = make_retrekog(min(size,MAX_LABELS))
+    words = make_words(size)
+    used_words = [w['word'] for w in words if w['isValid']]
+    used_index = judge.build_used_word_index(used_words)
+    candidates = judge.bucket_candidates(retrekog)
+    #最初の候補を既出にして、重複チェックの経路も通す
+    next_char = retrekog['Labels'][0]['Name'][0].upper()
+    used_index.add(judge.normalize_word(retrekog['Labels'][0]['Name']))
+    state = make_state(used_words)
+    game = {'id':1,'firstChar':'A','endUnixTime':1600003600}
+    put_json = {'id':size + 1,'isValid':True,'poster':'U0000','nextChar':'E','word':'Apple'}
+    table = StubTable(words)
+
+    class StubRepository(Repository):
+        def _table(self,name):
+            return table
+
+    #集約状態のない古いゲームの経路は、wordテーブルを読み込み済みのリポジトリで計測する
+    loaded = StubRepository()
+    loaded.get_words(1)
+    legacy_game = {'id':1}
+
+    return {
+        'judge.build_used_word_index':lambda:judge.build_used_word_index(used_words),
+        'judge.get_next_word':lambda:judge.get_next_word(candidates,next_char,used_index,[]),
+        'judge.next_game_state':lambda:judge.next_game_state(state,put_json),
+        'judge.bucket_candidates':lambda:judge.bucket_candidates(retrekog),
+        'judge.most_confident_word':lambda:judge.most_confident_word(retrekog),
+        'label_store.summarize_labels':lambda:label_store.summarize_labels(retrekog),
+        'label_store.encode_raw_labels':lambda:label_store.encode_raw_labels(retrekog,1,size,storage='zlib'),
+        'leaderboard.get_progress':lambda:leaderboard.get_progress(state),
+        'leaderboard.get_winner':lambda:leaderboard.get_winner(state),
+        'leaderboard.format_status':lambda:leaderboard.format_status(game,state,now=1600000000),
+        'repository.get_words':lambda:StubRepository().get_words(1),
+        'repository.get_next_char':lambda:loaded.get_next_char(1),
+        'repository.get_valid_word_id':lambda:loaded.get_valid_word_id(1),
+        'repository.get_game_state':lambda:loaded.get_game_state(legacy_game),
+    }
+
+
+def measure(func,repeat):
+    """
+    1回あたりの実行時間(マイクロ秒)を計測する。repeat回のうち最も速い値を使う
+    """
+    timer = timeit.Timer(func)
+    number,elapsed = timer.autorange()
+    number = max(1,int(number * MIN_TIME / max(elapsed,1e-9))) if elapsed < MIN_TIME else number
+    best = min(timer.repeat(repeat=repeat,number=number))
+    return best / number * 1e6
+
+
+def check_regression(results,baseline,max_regression):
+    """
+    ベースラインと比べて、許容する割合より遅くなった項目を返す
+    """
+    regressions = []
+    for name,by_size in results.items():
+        for size,us in by_size.items():
+            base = baseline.get(name,{}).get(size)
+            if base is None:
+                continue
+            limit = base * (1 + THRESHOLDS.get(name,max_regression))
+            if us > limit:
+                regressions.append(f'{name}[{size}]: {us:.1f}us > {limit:.1f}us (baseline {base:.1f}us)')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='judge/finishのロジックのマイクロベンチマーク')
+    parser.add_argument('--sizes',type=int,nargs='*',default=DEFAULT_SIZES,help='wordテーブルの件数')
+    parser.add_argument('--only',nargs='*',help='計測するベンチマーク名(前方一致)')
+    parser.add_argument('--repeat',type=int,default=5,help='計測回数(最も速い値を使う)')
+    parser.add_argument('--save-baseline',help='計測結果を保存するファイル')
+    parser.add_argument('--baseline',help='比較するベースラインのファイル')
+    parser.add_argument('--max-regression',type=float,default=0.25,help='許容する悪化の割合(0.25=25%%)')
+    args = parser.parse_args(argv)
+
+    for k,v in DUMMY_ENV.items():
+        os.environ.setdefault(k,v)
+    sys.path.insert(0,ROOT_DIR)
+    #Lambdaと同じくログの組み立て(f文字列)は計測に含めるが、出力はしない
+    logging.disable(logging.CRITICAL)
+
+    for size in args.sizes:
+        item_bytes = estimate_item_bytes(make_game_item(size))
+        if item_bytes > MAX_ITEM_BYTES:
+            parser.error(f'{size}件ではgameテーブルの項目が約{item_bytes}byteになり、DynamoDBの上限({MAX_ITEM_BYTES}byte)を超えます')
+
+    results = {}
+    for size in args.sizes:
+        for name,func in build_benchmarks(size).items():
+            if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                continue
+            us = measure(func,args.repeat)
+            results.setdefault(name,{})[str(size)] = us
+            print(f'{name:32s} {size:>8d}件 {us:14.1f}us')
+
+    failed = []
+    if args.save_baseline:
+        with open(args.save_baseline,'w') as f:
+            json.dump(results,f,indent=2)
+        print(f'ベースラインを保存しました:{args.save_baseline}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failed.extend(check_regression(results,baseline,args.max_regression))
+
+    for msg in failed:
+        print('NG ' + msg)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
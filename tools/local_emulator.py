@@ -0,0 +1,775 @@
+#coding: UTF-8
+"""
+Slack/S3/DynamoDB/Rekognitionをプロセス内で再現して、ゲームを最初から最後まで実行する(ローカルエミュレーター)
+
+AWSやSlackに接続せずに、本物のハンドラー(start -> events -> main -> judge -> finish)でゲームを進め、
+ステージ(ハンドラー)ごとの実行時間と、外部API(DynamoDB/S3/Slackなど)の呼び出し回数を表示する。
+  - S3/DynamoDB/Scheduler : moto。テーブルはserverless.ymlの定義(インデックスを含む)から作成する
+  - Slack Web API         : 偽のクライアント(同期/非同期)。投稿内容は--verboseで表示する
+  - Slackのファイル       : ローカルのHTTPサーバーから画像を配信する
+  - Rekognition           : 台本どおりのラベルを返すスタブ(--labels-scriptで指定できる)
+  - Lambdaの非同期呼び出し: eventsがmainを呼び出したら、mainを実行する
+  - S3イベント            : mainがjudge/以下に画像を置いたらjudgeを実行する
+  - スケジュール          : startが作成したスケジュールの入力で、finishを実行する
+
+必要なもの(Lambdaには含めない開発用のパッケージ):
+  pip install moto PyYAML
+
+使い方:
+  python tools/local_emulator.py                                    # 1チャンネルで10枚投稿する
+  python tools/local_emulator.py --channels 3 --rounds 20 --inline  # インライン判定モードで3チャンネル同時に遊ぶ
+  python tools/local_emulator.py --miss-every 4                     # 4枚に1枚はしりとり不成立の絵にする
+  python tools/local_emulator.py --labels-script labels.json        # ラベルを台本で指定する
+  python tools/local_emulator.py --slack-retries 3                  # Slackがイベントを3回再送したことにする
+  python tools/local_emulator.py --json result.json                 # 計測結果をJSONで保存する
+
+--labels-scriptのJSONは、投稿順のラベル名のリスト(1枚ごとにラベル名のリスト)。
+台本を使い切った後は、しりとりが成立するラベルを自動で返す。
+  [["Apple","Fruit"],["Egg"],["Cat","Animal"]]
+"""
+import argparse
+import base64
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERLESS_YML = os.path.join(ROOT_DIR,'serverless.yml')
+
+EMULATOR_ENV = {
+    'SLACK_API_TOKEN':'xoxp-emulator',
+    'SLACK_BOT_API_TOKEN':'xoxb-emulator',
+    'SLACK_SIGNING_SECRET':'emulator-signing-secret',
+    'PUT_BACKET':'emulator-bucket',
+    'AWS_DEFAULT_REGION':'ap-northeast-1',
+    'AWS_ACCESS_KEY_ID':'emulator',
+    'AWS_SECRET_ACCESS_KEY':'emulator',
+    'FINISH_FUNCTION_ARN':'arn:aws:lambda:ap-northeast-1:123456789012:function:picShiritori-dev-finish',
+    'SCHEDULER_ROLE_ARN':'arn:aws:iam::123456789012:role/picShiritori-dev-scheduler',
+}
+
+STAGES = ['start','events','main','judge','status','finish']
+
+#しりとりの単語(頭文字ごと)。使い切った頭文字は、nで終わる単語を作って続ける
+WORDS = {
+    'A':['Apple','Anchor','Airplane'],
+    'B':['Banana','Bridge','Bell'],
+    'C':['Cat','Castle','Cloud'],
+    'D':['Dog','Drum','Desk'],
+    'E':['Egg','Eagle','Engine'],
+    'F':['Fish','Flower','Fork'],
+    'G':['Guitar','Grape','Goat'],
+    'H':['Hat','House','Horse'],
+    'I':['Island','Igloo','Iron'],
+    'J':['Jacket','Jar','Juice'],
+    'K':['Kite','Key','Kettle'],
+    'L':['Lemon','Lamp','Leaf'],
+    'M':['Moon','Mouse','Map'],
+    'N':['Nest','Nut','Needle'],
+    'O':['Orange','Owl','Onion'],
+    'P':['Pen','Piano','Pumpkin'],
+    'Q':['Queen','Quilt'],
+    'R':['Rabbit','Robot','Rose'],
+    'S':['Sun','Ship','Star'],
+    'T':['Tree','Train','Tiger'],
+    'U':['Umbrella','Unicorn'],
+    'V':['Violin','Vase'],
+    'W':['Whale','Watch','Window'],
+    'X':['Xylophone'],
+    'Y':['Yacht','Yarn'],
+    'Z':['Zebra','Zipper'],
+}
+
+logger = logging.getLogger(__name__)
+
+
+class CallStats:
+    """
+    ステージごとの実行時間と、外部APIの呼び出し回数を集計する
+    (ハンドラーは1つずつ順番に実行するので、今のステージはインスタンス変数で持つ)
+    """
+
+    def __init__(self):
+        self.stage = None
+        self.durations = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.calls = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+
+    def count(self,api):
+        """
+        今のステージの呼び出し回数を数える(ステージ外の呼び出しは数えない)
+        """
+        stage = self.stage
+        if stage is None:
+            return
+        with self._lock:
+            self.calls[stage][api] += 1
+
+    @contextlib.contextmanager
+    def measure(self,stage):
+        """
+        ステージの実行時間を計測する。ハンドラーのexit(1)は失敗として数える
+        """
+        self.stage = stage
+        t0 = time.perf_counter()
+        try:
+            yield
+        except SystemExit as e:
+            if e.code:
+                self.errors[stage] += 1
+        finally:
+            self.durations[stage].append((time.perf_counter() - t0) * 1000)
+            self.stage = None
+
+    def on_boto_call(self,model,**kwargs):
+        """
+        botocoreのbefore-callイベントで、AWSの呼び出し回数を数える
+        """
+        self.count(f'{model.service_model.service_name}.{model.name}')
+
+    def summary(self):
+        """
+        ステージごとの集計結果を返す
+
+        戻り値:  result   dict   {stage:{'invocations','errors','total_ms','mean_ms','max_ms','calls','calls_per_invocation'}}
+        """
+        result = {}
+        for stage in STAGES:
+            durations = self.durations.get(stage)
+            if not durations:
+                continue
+            n = len(durations)
+            calls = dict(sorted(self.calls[stage].items()))
+            result[stage] = {
+                'invocations':n,
+                'errors':self.errors[stage],
+                'total_ms':round(sum(durations),1),
+                'mean_ms':round(sum(durations) / n,1),
+                'max_ms':round(max(durations),1),
+                'calls':calls,
+                'calls_per_invocation':round(sum(calls.values()) / n,2),
+            }
+        return result
+
+
+class FileServer:
+    """
+    Slackのファイル(url_private_download)を配信するローカルのHTTPサーバー
+    """
+
+    def __init__(self,stats):
+        self.files = {}
+        files = self.files
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stats.count('slack.file_download')
+                data = files.get(self.path)
+                if data is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length',str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self,*args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1',0),Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,daemon=True)
+        self._thread.start()
+
+    def add(self,file_id,data,suffix='png'):
+        """
+        ファイルを登録して、ダウンロード用のURLを返す
+        """
+        path = f'/files/{file_id}.{suffix}'
+        self.files[path] = data
+        return f'http://127.0.0.1:{self._server.server_address[1]}{path}'
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeSlack:
+    """
+    Slack Web APIの偽物(ハンドラーが使うメソッドだけ)。投稿はchannel/tsごとに保存する
+    """
+
+    def __init__(self,stats,file_server,verbose=False):
+        self.stats = stats
+        self.file_server = file_server
+        self.verbose = verbose
+        self.files = {}
+        self.messages = collections.OrderedDict() #(channel,ts) -> text
+        self._ts = 0
+
+    def upload(self,file_id,user,channel,data):
+        """
+        ファイルをアップロードしたことにする(file_sharedイベントの前に呼ぶ)
+        """
+        name = f'{file_id}.png'
+        self.files[file_id] = {
+            'id':file_id,
+            'user':user,
+            'name':name,
+            'size':len(data),
+            'channels':[channel],
+            'url_private_download':self.file_server.add(file_id,data),
+        }
+
+    def files_info(self,file=None,**kwargs):
+        self.stats.count('slack.files.info')
+        return {'ok':True,'file':self.files[file]}
+
+    def chat_postMessage(self,channel=None,text=None,**kwargs):
+        self.stats.count('slack.chat.postMessage')
+        self._ts += 1
+        ts = f'{self._ts}.000000'
+        self._show('post',channel,text)
+        self.messages[(channel,ts)] = text
+        return {'ok':True,'channel':channel,'ts':ts}
+
+    def chat_update(self,channel=None,ts=None,text=None,**kwargs):
+        self.stats.count('slack.chat.update')
+        self._show('update',channel,text)
+        self.messages[(channel,ts)] = text
+        return {'ok':True,'channel':channel,'ts':ts}
+
+    def users_profile_get(self,user=None,**kwargs):
+        self.stats.count('slack.users.profile.get')
+        return {'ok':True,'profile':{'display_name':f'player-{user}','real_name':f'Player {user}'}}
+
+    def _show(self,action,channel,text):
+        if self.verbose:
+            print(f'[slack {action} {channel}] {text}')
+
+
+class FakeSlackAsync:
+    """
+    FakeSlackの非同期版(slack.WebClient(run_async=True)の代わり)
+    """
+
+    def __init__(self,fake):
+        self._fake = fake
+
+    def __getattr__(self,name):
+        method = getattr(self._fake,name)
+
+        async def call(**kwargs):
+            return method(**kwargs)
+        return call
+
+
+class RekognitionStub:
+    """
+    DetectLabelsのスタブ。expect()で登録したラベルを順番に返す
+    """
+
+    def __init__(self,stats):
+        self.stats = stats
+        self.script = collections.deque()
+
+    def expect(self,names,confidence=95.0):
+        """
+        次のDetectLabelsで返すラベル名を登録する(先頭ほど一致度を高くする)
+        """
+        self.script.append([
+            {'Name':name,'Confidence':confidence - i,'Instances':[],'Parents':[],'Aliases':[]}
+            for i,name in enumerate(names)
+        ])
+
+    def detect_labels(self,Image=None,MaxLabels=None,**kwargs):
+        self.stats.count('rekognition.DetectLabels')
+        labels = self.script.popleft() if self.script else []
+        return {'Labels':labels[:MaxLabels],'LabelModelVersion':'emulator'}
+
+
+class LambdaStub:
+    """
+    Lambdaの非同期呼び出し(InvocationType=Event)のスタブ。呼び出しはためておき、Emulatorが順番に実行する
+    """
+
+    def __init__(self,stats):
+        self.stats = stats
+        self.invocations = collections.deque()
+
+    def invoke(self,FunctionName=None,InvocationType=None,Payload=None,**kwargs):
+        self.stats.count('lambda.Invoke')
+        self.invocations.append((FunctionName,json.loads(Payload)))
+        return {'StatusCode':202}
+
+
+def load_table_definitions(path=SERVERLESS_YML):
+    """
+    serverless.ymlから、DynamoDBのテーブル定義(create_tableの引数)を取り出す
+
+    引数  :  path     str          serverless.ymlのパス
+    戻り値:  tables   list<dict>   create_tableの引数
+    """
+    import yaml
+
+    class Loader(yaml.SafeLoader):
+        pass
+    #!GetAttなどのCloudFormationのタグは使わないので読み飛ばす
+    Loader.add_multi_constructor('',lambda loader,suffix,node:None)
+
+    with open(path,encoding='utf-8') as f:
+        conf = yaml.load(f,Loader=Loader)
+
+    tables = []
+    for resource in conf['resources']['Resources'].values():
+        if resource.get('Type') != 'AWS::DynamoDB::Table':
+            continue
+        props = resource['Properties']
+        table = {
+            'TableName':props['TableName'],
+            'AttributeDefinitions':props['AttributeDefinitions'],
+            'KeySchema':props['KeySchema'],
+            'BillingMode':'PAY_PER_REQUEST',
+        }
+        indexes = props.get('GlobalSecondaryIndexes')
+        if indexes:
+            table['GlobalSecondaryIndexes'] = [
+                {k:v for k,v in index.items() if k != 'ProvisionedThroughput'} for index in indexes
+            ]
+        tables.append(table)
+    return tables
+
+
+def load_judge_prefix(path=SERVERLESS_YML):
+    """
+    serverless.ymlから、judgeを実行するS3イベントのプレフィックスを取り出す
+    """
+    import yaml
+
+    with open(path,encoding='utf-8') as f:
+        conf = yaml.safe_load(f)
+    for event in conf['functions']['judge']['events']:
+        for rule in event.get('s3',{}).get('rules',[]):
+            if 'prefix' in rule:
+                return rule['prefix']
+    return ''
+
+
+def load_http_integration(function,path=SERVERLESS_YML):
+    """
+    serverless.ymlから、関数のhttpイベントのAPI Gatewayの統合の種類を取り出す
+
+    引数  :  function      str   関数名
+             path          str   serverless.ymlのパス
+    戻り値:  integration   str   'lambda'(マッピングテンプレートを使う)/'lambda-proxy'
+    """
+    import yaml
+
+    with open(path,encoding='utf-8') as f:
+        conf = yaml.safe_load(f)
+    for event in conf['functions'][function]['events']:
+        http = event.get('http')
+        if http is None:
+            continue
+        #async: trueはLambda統合になる(serverlessのデフォルトはLambdaプロキシ統合)
+        if http.get('async') or http.get('integration') == 'lambda':
+            return 'lambda'
+        return http.get('integration','lambda-proxy')
+    raise ValueError(f'{function}にhttpイベントがありません')
+
+
+def create_aws_resources(dynamodb,s3,bucket,region):
+    """
+    serverless.ymlのテーブルと、画像を置くバケットを作成する(mock_awsの中で呼ぶ)
+
+    引数  :  dynamodb   DynamoDBのクライアント(低レベル)
+             s3         S3のクライアント
+             bucket     str   バケット名
+             region     str   リージョン
+    """
+    for table in load_table_definitions():
+        dynamodb.create_table(**table)
+    s3.create_bucket(Bucket=bucket,CreateBucketConfiguration={'LocationConstraint':region})
+
+
+def install_fakes(clients,slack,rekognition,lambda_stub):
+    """
+    src.clientsのクライアントを、Slack/Rekognition/Lambdaの偽物に差し替える
+    (S3/DynamoDB/Schedulerはmotoを使うので差し替えない)
+    """
+    fake_async = FakeSlackAsync(slack)
+    for token_env in ('SLACK_API_TOKEN','SLACK_BOT_API_TOKEN'):
+        clients._slack_clients[token_env] = slack
+        clients._slack_clients[token_env + ':async'] = fake_async
+    clients._clients['rekognition'] = rekognition
+    clients._clients['lambda'] = lambda_stub
+
+
+def make_png(seed,size=16):
+    """
+    1色で塗りつぶしたPNG画像を作る(seedごとに色を変えて、画像のハッシュが重ならないようにする)
+    """
+    color = hashlib.sha256(str(seed).encode()).digest()[:3]
+    raw = b''.join(b'\x00' + color * size for _ in range(size))
+
+    def chunk(kind,data):
+        body = kind + data
+        return struct.pack('>I',len(data)) + body + struct.pack('>I',zlib.crc32(body) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB',size,size,8,2,0,0,0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR',header) + chunk(b'IDAT',zlib.compress(raw)) + chunk(b'IEND',b'')
+
+
+def http_event(function,path,raw_body,content_type,headers=None):
+    """
+    API Gatewayが関数に渡すのと同じ形の、署名付きのイベントを作る
+    (serverless.ymlの統合の種類に合わせて、Lambda統合はマッピングテンプレート(slack_request_template)の形、
+     Lambdaプロキシ統合はプロキシのイベントの形にする)
+
+    引数  :  function       str     関数名
+             path           str     httpイベントのパス
+             raw_body       bytes   リクエストのbody
+             content_type   str     リクエストのContent-Type
+             headers        dict    追加のヘッダー
+    戻り値:  event          dict    関数に渡すイベント
+    """
+    from src import slack_request
+
+    timestamp = str(int(time.time()))
+    headers = {
+        'Content-Type':content_type,
+        'X-Slack-Request-Timestamp':timestamp,
+        'X-Slack-Signature':slack_request.sign(timestamp,raw_body),
+        **(headers or {}),
+    }
+    if load_http_integration(function) == 'lambda':
+        return {'rawBody':base64.b64encode(raw_body).decode(),'headers':headers}
+
+    return {
+        'resource':f'/{path}',
+        'path':f'/{path}',
+        'httpMethod':'POST',
+        'headers':headers,
+        'multiValueHeaders':{k:[v] for k,v in headers.items()},
+        'queryStringParameters':None,
+        'multiValueQueryStringParameters':None,
+        'pathParameters':None,
+        'stageVariables':None,
+        'requestContext':{'resourcePath':f'/{path}','httpMethod':'POST','path':f'/dev/{path}','stage':'dev'},
+        'body':raw_body.decode(),
+        'isBase64Encoded':False,
+    }
+
+
+def check_proxy_response(response):
+    """
+    Lambdaプロキシ統合の関数の戻り値が、API Gatewayが受け付ける形で、ステータスコードが200かをチェックする
+    (受け付けない形の場合、API Gatewayは502を返す)
+
+    引数  :  response   dict   関数の戻り値
+    戻り値:  body       dict   応答のbody(JSON)。NGの場合はNone
+    """
+    if not isinstance(response,dict) or not isinstance(response.get('statusCode'),int):
+        return None
+    if not isinstance(response.get('body'),str) or response['statusCode'] != 200:
+        return None
+    try:
+        return json.loads(response['body'])
+    except ValueError:
+        return None
+
+
+def command_event(channel,user,text):
+    """
+    スラッシュコマンドのリクエスト(フォーム)のイベントを作る
+    """
+    body = {'channel_id':channel,'user_id':user,'command':'/shiritori','text':text}
+    return http_event('start','gameStart',urllib.parse.urlencode(body).encode(),'application/x-www-form-urlencoded')
+
+
+def file_shared_body(file_id,user,channel):
+    """
+    file_sharedイベントのEvents APIのリクエストbodyを作る
+    """
+    return {
+        'type':'event_callback',
+        'event_id':f'Ev{file_id}',
+        'event_time':int(time.time()),
+        'event':{'type':'file_shared','file_id':file_id,'user_id':user,'channel_id':channel},
+    }
+
+
+def file_shared_event(file_id,user,channel,retry_num=0):
+    """
+    file_sharedイベントのリクエスト(JSON)のイベントを作る(retry_numが1以上の場合はSlackの再送)
+    """
+    body = file_shared_body(file_id,user,channel)
+    headers = {'X-Slack-Retry-Num':str(retry_num),'X-Slack-Retry-Reason':'http_timeout'} if retry_num else None
+    return http_event('events','putImageToS3',json.dumps(body).encode(),'application/json',headers)
+
+
+class Emulator:
+    """
+    ハンドラーを実行し、S3イベントとスケジュールを受け渡す
+    """
+
+    def __init__(self,stats,slack,rekognition,judge_prefix):
+        from src import clients
+        from src import start,events,main,judge,finish
+        import src.repository
+
+        self.stats = stats
+        self.slack = slack
+        self.rekognition = rekognition
+        self.judge_prefix = judge_prefix
+        self.start,self.events,self.main,self.judge,self.finish = start,events,main,judge,finish
+        self.lambda_stub = LambdaStub(stats)
+        self.repository = src.repository
+        self.bucket = os.environ['PUT_BACKET']
+        self.dispatched = set()
+
+        session = clients._boto3_session()
+        session.events.register('before-call',stats.on_boto_call)
+        self.s3 = clients.s3()
+
+        create_aws_resources(clients.dynamodb().meta.client,self.s3,self.bucket,os.environ['AWS_DEFAULT_REGION'])
+        install_fakes(clients,slack,rekognition,self.lambda_stub)
+
+    def run_start(self,channel,user,limit_hour='1'):
+        """
+        startを実行し、作成したゲームのIDを返す
+        """
+        event = command_event(channel,user,limit_hour)
+        with self.stats.measure('start'):
+            self.start.handler(event,None)
+        return self.repository.Repository().get_game_id(channel)
+
+    def run_status(self,channel,user):
+        """
+        /shiritori statusを実行する
+        """
+        event = command_event(channel,user,'status')
+        with self.stats.measure('status'):
+            self.start.handler(event,None)
+
+    def run_events(self,file_id,user,channel,retries=0):
+        """
+        file_sharedイベントをeventsに送り(retries回再送する)、呼び出されたmainと、
+        judge/以下に置かれた画像のS3イベントでjudgeを実行する
+        """
+        for retry_num in range(retries + 1):
+            event = file_shared_event(file_id,user,channel,retry_num)
+            response = None
+            with self.stats.measure('events'):
+                response = self.events.handler(event,None)
+            #API Gatewayが受け付けない応答(502になる)は失敗として数える(exit(1)の場合は数え済み)
+            if response is not None and check_proxy_response(response) is None:
+                logger.error(f'eventsの応答をAPI Gatewayが受け付けません: {response}')
+                self.stats.errors['events'] += 1
+
+        while self.lambda_stub.invocations:
+            _,payload = self.lambda_stub.invocations.popleft()
+            with self.stats.measure('main'):
+                self.main.handler(payload,None)
+        self.dispatch_s3_events()
+
+    def dispatch_s3_events(self):
+        """
+        まだjudgeに渡していない画像のS3イベント(ObjectCreated)を、置かれた順にjudgeへ渡す
+        """
+        res = self.s3.list_objects_v2(Bucket=self.bucket,Prefix=self.judge_prefix)
+        objects = sorted(res.get('Contents',[]),key=lambda o:o['LastModified'])
+        for obj in objects:
+            key = obj['Key']
+            if key in self.dispatched:
+                continue
+            self.dispatched.add(key)
+            event = {'Records':[{
+                'eventName':'ObjectCreated:Put',
+                'eventTime':obj['LastModified'].strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+                's3':{'bucket':{'name':self.bucket},'object':{'key':key,'size':obj['Size']}},
+            }]}
+            with self.stats.measure('judge'):
+                self.judge.handler(event,None)
+
+    def fire_schedule(self,game_id):
+        """
+        startが作成したスケジュールを、終了時刻になったことにしてfinishを実行する
+        """
+        from src import clients
+
+        name = f'{self.start.SCHEDULE_NAME_PREFIX}{game_id}'
+        schedule = clients.scheduler().get_schedule(Name=name)
+        event = json.loads(schedule['Target']['Input'])
+        with self.stats.measure('finish'):
+            self.finish.handler(event,None)
+
+
+def next_labels(next_char,used,round_no,miss_every,script):
+    """
+    次に投稿する絵のラベル名を決める
+
+    引数  :  next_char    str         しりとり成立する頭文字
+             used         set<str>    成立した単語
+             round_no     int         何枚目か(1始まり)
+             miss_every   int         この枚数ごとに不成立の絵にする(0の場合はしない)
+             script       deque       --labels-scriptの台本
+    戻り値:  names        list<str>   ラベル名
+    """
+    if script:
+        return script.popleft()
+
+    if miss_every and round_no % miss_every == 0:
+        #頭文字が違う単語だけにする
+        other = 'Q' if next_char != 'Q' else 'Z'
+        return [WORDS[other][0]]
+
+    for word in WORDS.get(next_char,[]):
+        if word not in used:
+            return [word,'Object']
+
+    #使い切った場合は、nで終わる単語を作る(次の頭文字はN)
+    n = 1
+    while True:
+        word = next_char + 'a' * n + 'n'
+        if word not in used:
+            return [word,'Object']
+        n += 1
+
+
+def play(emulator,channels,rounds,players,miss_every,script,retries=0):
+    """
+    チャンネルごとにゲームを開始し、順番に絵を投稿して、/shiritori statusの後に終了時刻のfinishを実行する
+
+    戻り値:  games   dict   チャンネル -> ゲームID
+    """
+    repo_class = emulator.repository.Repository
+    games = {}
+    used = collections.defaultdict(set)
+
+    for channel in channels:
+        game_id = emulator.run_start(channel,'U0001')
+        if not game_id:
+            raise RuntimeError(f'ゲームを開始できませんでした:{channel}')
+        games[channel] = game_id
+
+    for round_no in range(1,rounds + 1):
+        for channel in channels:
+            game = repo_class().get_game(games[channel])
+            next_char = game['nextChar'].upper()
+            names = next_labels(next_char,used[channel],round_no,miss_every,script)
+            used[channel].add(names[0])
+
+            emulator.rekognition.expect(names)
+            file_id = f'F{channel}{round_no:05d}'
+            user = f'U{(round_no % players) + 1:04d}'
+            emulator.slack.upload(file_id,user,channel,make_png(file_id))
+            emulator.run_events(file_id,user,channel,retries)
+
+    for channel in channels:
+        emulator.run_status(channel,'U0001')
+        emulator.fire_schedule(games[channel])
+
+    return games
+
+
+def print_report(summary,games,repo_class):
+    """
+    ステージごとの実行時間と呼び出し回数を表示する
+    """
+    print('stage     calls  errors   total_ms   mean_ms    max_ms  api/call')
+    for stage,s in summary.items():
+        print(f"{stage:8s} {s['invocations']:6d} {s['errors']:7d} {s['total_ms']:10.1f} "
+              f"{s['mean_ms']:9.1f} {s['max_ms']:9.1f} {s['calls_per_invocation']:9.2f}")
+
+    for stage,s in summary.items():
+        print(f'\n[{stage}] 1回あたりの呼び出し回数')
+        for api,count in s['calls'].items():
+            print(f"  {api:40s} {count / s['invocations']:7.2f}  (計{count})")
+
+    print('\n[ゲーム]')
+    for channel,game_id in games.items():
+        words = repo_class().get_words(game_id)
+        valid = [w['word'] for w in words if w.get('isValid')]
+        print(f'  {channel} game_id={game_id} 投稿{len(words) - 1}件 成立{len(valid) - 1}件: {" -> ".join(valid[1:])}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ローカルエミュレーターでゲームを実行する')
+    parser.add_argument('--channels',type=int,default=1,help='同時に遊ぶチャンネル数')
+    parser.add_argument('--rounds',type=int,default=10,help='チャンネルごとに投稿する絵の枚数')
+    parser.add_argument('--players',type=int,default=3,help='チャンネルごとのプレイヤー数')
+    parser.add_argument('--miss-every',type=int,default=0,help='この枚数ごとにしりとり不成立の絵にする')
+    parser.add_argument('--labels-script',help='Rekognitionが返すラベル名の台本(JSON)')
+    parser.add_argument('--slack-retries',type=int,default=0,help='Slackがイベントを再送する回数')
+    parser.add_argument('--inline',action='store_true',help='インライン判定モード(INLINE_JUDGE=true)で実行する')
+    parser.add_argument('--raw-labels-storage',default='zlib',choices=['zlib','s3','none'],help='RAW_LABELS_STORAGE')
+    parser.add_argument('--slack-rate-limit',action='store_true',help='Slackのレート制限の待ち時間も再現する')
+    parser.add_argument('--json',help='計測結果を保存するJSONファイル')
+    parser.add_argument('--verbose',action='store_true',help='ハンドラーのログとSlackへの投稿を表示する')
+    args = parser.parse_args(argv)
+
+    try:
+        from moto import mock_aws
+        import yaml  # noqa: F401
+    except ImportError as e:
+        print(f'motoとPyYAMLが必要です(pip install moto PyYAML):{e}',file=sys.stderr)
+        return 2
+
+    #ハンドラーはimport時に環境変数を読むので、importより前に設定する
+    os.environ.update(EMULATOR_ENV)
+    os.environ['INLINE_JUDGE'] = 'true' if args.inline else 'false'
+    os.environ['RAW_LABELS_STORAGE'] = args.raw_labels_storage
+    sys.path.insert(0,ROOT_DIR)
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    script = collections.deque()
+    if args.labels_script:
+        with open(args.labels_script,encoding='utf-8') as f:
+            script.extend(json.load(f))
+
+    stats = CallStats()
+    file_server = FileServer(stats)
+    slack = FakeSlack(stats,file_server,verbose=args.verbose)
+    rekognition = RekognitionStub(stats)
+
+    try:
+        with mock_aws():
+            from src import slack_outbox
+            if not args.slack_rate_limit:
+                #レート制限の待ち時間は実行時間に含めない
+                slack_outbox.METHOD_RATES = {}
+                slack_outbox.DEFAULT_RATE = (1e9,1e9)
+
+            emulator = Emulator(stats,slack,rekognition,load_judge_prefix())
+            channels = [f'C{i + 1:04d}' for i in range(args.channels)]
+            games = play(emulator,channels,args.rounds,args.players,args.miss_every,script,args.slack_retries)
+
+            summary = stats.summary()
+            print_report(summary,games,emulator.repository.Repository)
+    finally:
+        file_server.close()
+
+    if args.json:
+        with open(args.json,'w',encoding='utf-8') as f:
+            json.dump({'stages':summary,'games':{c:int(g) for c,g in games.items()}},f,indent=2)
+        print(f'\n計測結果を保存しました:{args.json}')
+
+    return 1 if any(s['errors'] for s in summary.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
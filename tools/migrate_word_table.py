@@ -0,0 +1,102 @@
+#coding: UTF-8
+"""
+旧wordテーブル(ハッシュキー:id)のデータを、gameWordテーブル(ハッシュキー:gameId/レンジキー:id)へ移行する
+
+サービスを止めずに実行できる(オンライン移行)。
+  - 旧テーブルはページングしながらscanするので、1MBを超えても全件移行される
+  - 移行先への書き込みは attribute_not_exists の条件付きで行うので、
+    デプロイ後に新しいコードが書き込んだデータを上書きしない
+  - 何度実行しても結果は同じになる
+
+使い方:
+  python tools/migrate_word_table.py [--source word] [--dest gameWord] [--dry-run]
+"""
+import argparse
+import sys
+from logging import getLogger,StreamHandler,Formatter,DEBUG,INFO,WARNING,ERROR,CRITICAL
+
+import boto3
+from botocore.exceptions import ClientError
+
+logger = getLogger(__name__)
+logger.setLevel(INFO)
+loghandler = StreamHandler()
+loghandler.setFormatter(Formatter("%(asctime)s %(name)s %(levelname)8s %(message)s"))
+logger.addHandler(loghandler)
+
+
+def scan_all(table):
+    """
+    テーブルを全件scanする(ページング対応)
+
+    引数  :  table    Table        scan対象のテーブル
+    戻り値:  item     dict         1件ずつ返すジェネレータ
+    """
+    scan_args = {}
+    while True:
+        res = table.scan(**scan_args)
+        for item in res.get('Items'):
+            yield item
+
+        last_key = res.get('LastEvaluatedKey')
+        if not last_key:
+            break
+        scan_args['ExclusiveStartKey'] = last_key
+
+
+def migrate(source_name,dest_name,dry_run=False):
+    """
+    旧wordテーブルからgameWordテーブルへデータを移行する
+
+    引数  :  source_name    str      移行元テーブル名
+             dest_name      str      移行先テーブル名
+             dry_run        boolean  Trueの場合は書き込まない
+    戻り値:  result         dict     件数(copied/skipped/invalid)
+    """
+    logger.info(f'移行を開始します:{source_name} -> {dest_name}')
+
+    dynamodb = boto3.resource('dynamodb')
+    source_table = dynamodb.Table(source_name)
+    dest_table = dynamodb.Table(dest_name)
+
+    result = {'copied':0,'skipped':0,'invalid':0}
+
+    for item in scan_all(source_table):
+        if item.get('gameId') is None or item.get('id') is None:
+            logger.warning(f'gameIdまたはidがないため移行しません:{item}')
+            result['invalid'] += 1
+            continue
+
+        if dry_run:
+            result['copied'] += 1
+            continue
+
+        try:
+            dest_table.put_item(
+                Item=item,
+                ConditionExpression='attribute_not_exists(gameId)',
+            )
+            result['copied'] += 1
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            #移行済み、または新しいコードが書き込み済み
+            result['skipped'] += 1
+
+    logger.info(f'移行が完了しました:{result}')
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='wordテーブルをgameWordテーブルへ移行する')
+    parser.add_argument('--source',default='word',help='移行元テーブル名')
+    parser.add_argument('--dest',default='gameWord',help='移行先テーブル名')
+    parser.add_argument('--dry-run',action='store_true',help='書き込まずに件数だけ数える')
+    args = parser.parse_args(argv)
+
+    migrate(args.source,args.dest,args.dry_run)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())